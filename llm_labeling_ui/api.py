@@ -1,20 +1,46 @@
+import asyncio
+import hashlib
+import json
 import math
 import os
-from functools import lru_cache
-from typing import List
+import time
+from typing import AsyncIterator, Dict, List, Optional
+from uuid import UUID
 from pathlib import Path
-from fastapi import APIRouter, FastAPI, HTTPException
-from fastapi.responses import FileResponse, StreamingResponse
-from fastapi.staticfiles import StaticFiles
-import openai
+from fastapi import APIRouter, FastAPI, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import (
+    ORJSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+import httpx
 from loguru import logger
 
 from llm_labeling_ui.db_schema import (
+    JOB_FINISHED_STATUSES,
+    JOB_QUEUED,
     DBManager,
     Folder,
+    Job,
     PromptTemp,
     Conversation as DBConversation,
 )
+from llm_labeling_ui import metrics
+from llm_labeling_ui.datasets import (
+    CURRENT_DATASET,
+    Dataset,
+    DatasetPool,
+    dataset_page,
+)
+from llm_labeling_ui.filters import FilterSyntaxError, parse_filter
+from llm_labeling_ui.page_cache import PageCache
+from llm_labeling_ui.static_files import PrecompressedStaticFiles
+from llm_labeling_ui.utils import TokenCounter
+from llm_labeling_ui.write_buffer import WriteBehindBuffer
 from llm_labeling_ui.schema import (
     ChatMessage,
     ChatRequest,
@@ -23,20 +49,82 @@ from llm_labeling_ui.schema import (
     Config,
     GetConversionsRequest,
     GetConversionsResponse,
+    GetConversationSummariesResponse,
     Conversation,
     CountTokensResponse,
     CountTokensRequest,
     SplitConversationRequest,
+    SubmitJobRequest,
+    ConversationSelection,
+    BulkDeleteRequest,
+    BulkTagRequest,
+    BulkMoveRequest,
+    BulkResponse,
+    PatchConversationRequest,
+    PatchConversationResponse,
+    ClusterRun,
+    ClusterGroup,
+    GetClusterGroupsRequest,
+    GetClusterGroupsResponse,
+    GetConversationClusterGroupRequest,
+    GetConversationClusterGroupResponse,
 )
 
 error503 = "OpenAI server is busy, try again later"
 
 
+async def iter_sse_content(response: httpx.Response) -> AsyncIterator[str]:
+    """
+    Yield message content of an OpenAI chat completion event stream, events may be
+    split across network chunks. Events that are not valid json are logged and skipped.
+    """
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:") :].strip()
+        if data == "[DONE]":
+            break
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Skip malformed chat completion event {data[:200]!r}: {e}")
+            continue
+        if not isinstance(event, dict):
+            logger.warning(f"Skip unexpected chat completion event {data[:200]!r}")
+            continue
+        choices = event.get("choices") or [{}]
+        content = choices[0].get("delta", {}).get("content")
+        if content:
+            yield content
+
+
+def make_etag(*parts) -> str:
+    return '"' + hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest() + '"'
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match", "")
+    return etag in [it.strip() for it in if_none_match.split(",")]
+
+
 class Api:
-    def __init__(self, app: FastAPI, config: Config, db: DBManager, tokenizer=None):
+    def __init__(
+        self,
+        app: FastAPI,
+        config: Config,
+        db: Optional[DBManager],
+        tokenizer=None,
+        datasets: Optional[DatasetPool] = None,
+    ):
+        """
+        Args:
+            db: Database of all requests, None when serving a directory of datasets
+            datasets: Databases selected by the dataset of each request, see datasets.py
+        """
         self.router = APIRouter()
         self.app = app
-        self.db = db
+        self._db = db
+        self.datasets = datasets
         self.tokenizer = tokenizer
         self.config = config
         if self.tokenizer is not None:
@@ -45,10 +133,37 @@ class Api:
             self.tokenizer = AutoTokenizer.from_pretrained(
                 self.tokenizer, trust_remote_code=True
             )
+        # shared by all requests, the web page recounts every message on each edit
+        self.token_counter = TokenCounter(self.tokenizer, max_size=100000)
 
-        self.app.mount(
-            "/static", StaticFiles(directory=config.web_app_dir), name="static"
+        self.http_client = httpx.AsyncClient(
+            base_url=config.openai_api_base,
+            timeout=httpx.Timeout(config.chat_timeout, connect=10),
+            limits=httpx.Limits(max_connections=config.chat_concurrency),
         )
+        # created on first request, inside the event loop of the worker
+        self.chat_semaphore = None
+        # encoded folders and prompt templates by (db, table) write generation
+        self.json_cache: Dict[tuple, tuple] = {}
+        # encoded conversation pages and hot conversations
+        self.page_cache = PageCache(max_bytes=config.page_cache_mb * 1024 * 1024)
+        self.app.add_event_handler("shutdown", self.page_cache.close)
+        self.app.add_event_handler("shutdown", self.http_client.aclose)
+
+        # autosave sends the whole conversation on every edit, coalesce them per id
+        self._write_buffer = None
+        if db is not None and config.write_delay > 0:
+            self._write_buffer = WriteBehindBuffer(db, delay=config.write_delay)
+            self.app.add_event_handler("shutdown", self._write_buffer.close)
+        if datasets is not None:
+            # DatasetMiddleware opens the dataset of each request from the pool
+            self.app.state.datasets = datasets
+            self.app.add_event_handler("shutdown", datasets.close)
+
+        self.static_files = PrecompressedStaticFiles(
+            directory=config.web_app_dir, cache_dir=config.static_cache_dir
+        )
+        self.app.mount("/static", self.static_files, name="static")
 
         self.add_api_route(
             "/",
@@ -56,6 +171,31 @@ class Api:
             methods=["GET"],
         )
 
+        self.add_api_route(
+            "/api/datasets",
+            self.get_datasets,
+            methods=["GET"],
+        )
+
+        self.add_api_route(
+            "/api/ready",
+            self.ready,
+            methods=["GET"],
+        )
+
+        self.add_api_route(
+            "/metrics",
+            self.metrics,
+            methods=["GET"],
+            response_class=PlainTextResponse,
+        )
+
+        self.add_api_route(
+            "/api/write_stats",
+            self.write_stats,
+            methods=["GET"],
+        )
+
         self.add_api_route(
             "/api/models",
             self.models,
@@ -91,6 +231,20 @@ class Api:
             response_model=GetConversionsResponse,
         )
 
+        self.add_api_route(
+            "/api/conversation_summaries",
+            self.get_conversation_summaries,
+            methods=["POST"],
+            response_model=GetConversationSummariesResponse,
+        )
+
+        self.add_api_route(
+            "/api/conversation/{conversation_id}",
+            self.get_conversation,
+            methods=["GET"],
+            response_model=DBConversation,
+        )
+
         self.add_api_route(
             "/api/create_conversation",
             self.create_conversation,
@@ -112,6 +266,13 @@ class Api:
             # response_model=Conversation,
         )
 
+        self.add_api_route(
+            "/api/patch_conversation",
+            self.patch_conversation,
+            methods=["POST"],
+            response_model=PatchConversationResponse,
+        )
+
         self.add_api_route(
             "/api/delete_conversation",
             self.delete_conversation,
@@ -119,6 +280,27 @@ class Api:
             # response_model=Conversation,
         )
 
+        self.add_api_route(
+            "/api/bulk_delete_conversations",
+            self.bulk_delete_conversations,
+            methods=["POST"],
+            response_model=BulkResponse,
+        )
+
+        self.add_api_route(
+            "/api/bulk_tag_conversations",
+            self.bulk_tag_conversations,
+            methods=["POST"],
+            response_model=BulkResponse,
+        )
+
+        self.add_api_route(
+            "/api/bulk_move_conversations",
+            self.bulk_move_conversations,
+            methods=["POST"],
+            response_model=BulkResponse,
+        )
+
         self.add_api_route(
             "/api/count_tokens",
             self.count_tokens,
@@ -126,93 +308,486 @@ class Api:
             response_model=CountTokensResponse,
         )
 
-    def main(self):
-        return FileResponse(os.path.join(self.config.web_app_dir, "index.html"))
+        self.add_api_route(
+            "/api/cluster_runs",
+            self.get_cluster_runs,
+            methods=["GET"],
+            response_model=List[ClusterRun],
+        )
+
+        self.add_api_route(
+            "/api/cluster_groups",
+            self.get_cluster_groups,
+            methods=["POST"],
+            response_model=GetClusterGroupsResponse,
+        )
+
+        self.add_api_route(
+            "/api/conversation_cluster_group",
+            self.get_conversation_cluster_group,
+            methods=["POST"],
+            response_model=GetConversationClusterGroupResponse,
+        )
+
+        self.add_api_route(
+            "/api/jobs",
+            self.submit_job,
+            methods=["POST"],
+            response_model=Job,
+        )
+
+        self.add_api_route(
+            "/api/jobs",
+            self.get_jobs,
+            methods=["GET"],
+            response_model=List[Job],
+        )
+
+        self.add_api_route(
+            "/api/jobs/{job_id}",
+            self.get_job,
+            methods=["GET"],
+            response_model=Job,
+        )
+
+        self.add_api_route(
+            "/api/jobs/{job_id}/cancel",
+            self.cancel_job,
+            methods=["POST"],
+            response_model=Job,
+        )
+
+        self.add_api_route(
+            "/api/jobs/{job_id}/events",
+            self.job_events,
+            methods=["GET"],
+        )
+
+    def _dataset(self) -> Optional[Dataset]:
+        if self.datasets is None:
+            return None
+        # held open by DatasetMiddleware until the response is sent
+        dataset = CURRENT_DATASET.get()
+        if dataset is None:
+            raise HTTPException(
+                400, "No dataset selected, use /datasets/<name>/api/..."
+            )
+        return dataset
+
+    @property
+    def db(self) -> DBManager:
+        dataset = self._dataset()
+        return self._db if dataset is None else dataset.db
+
+    @property
+    def write_buffer(self) -> Optional[WriteBehindBuffer]:
+        dataset = self._dataset()
+        return self._write_buffer if dataset is None else dataset.write_buffer
+
+    async def main(self, request: Request) -> Response:
+        dataset = CURRENT_DATASET.get()
+        if dataset is None:
+            # compressed variant, ETag and no-cache, the page links to the current bundles
+            return await self.static_files.get_response("index.html", request.scope)
+
+        index_path = Path(self.config.web_app_dir) / "index.html"
+        stat = index_path.stat()
+        etag = make_etag(stat.st_mtime_ns, stat.st_size, dataset.name)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if not_modified(request, etag):
+            return Response(status_code=304, headers=headers)
+        html = dataset_page(index_path.read_text(encoding="utf-8"), dataset.name)
+        return Response(content=html, media_type="text/html", headers=headers)
+
+    def get_datasets(self) -> dict:
+        if self.datasets is None:
+            return {"datasets": [], "converting": []}
+        return {
+            "datasets": self.datasets.names(),
+            "converting": self.datasets.pending_names(),
+        }
+
+    def ready(self):
+        if self.datasets is not None and CURRENT_DATASET.get() is None:
+            return {"status": "ok", "pid": os.getpid()}
+        try:
+            self.db.ping()
+        except Exception as e:
+            raise HTTPException(503, "Database is not ready: " + str(e))
+        return {"status": "ok", "pid": os.getpid()}
+
+    def metrics(self) -> PlainTextResponse:
+        return PlainTextResponse(
+            metrics.render(), media_type="text/plain; version=0.0.4"
+        )
+
+    def write_stats(self) -> dict:
+        if self.write_buffer is None:
+            return {}
+        return self.write_buffer.stats()
+
+    def flush_writes(self):
+        """Write buffered updates before queries that read many conversations"""
+        if self.write_buffer is not None:
+            self.write_buffer.flush()
+
+    def _openai_headers(self, key: str, org: str) -> Dict[str, str]:
+        # credentials are per request, nothing global is mutated
+        api_key = key if key else os.environ.get("OPENAI_API_KEY")
+        api_org = org if org else os.environ.get("OPENAI_ORGANIZATION")
+        headers = {"Authorization": f"Bearer {api_key}"}
+        if api_org:
+            headers["OpenAI-Organization"] = api_org
+        return headers
+
+    async def models(self, req: ModelsRequest) -> List[dict]:
+        try:
+            response = await self.http_client.get(
+                "/models", headers=self._openai_headers(req.key, req.org)
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.error("Error in listing models from openAI: " + str(e))
+            raise HTTPException(503, error503)
 
-    def models(self, req: ModelsRequest) -> List[dict]:
-        api_key = req.key if req.key else os.environ.get("OPENAI_API_KEY")
-        api_org = req.org if req.org else os.environ.get("OPENAI_ORGANIZATION")
-        all_models = openai.Model.list(api_key, organization=api_org)
         res = []
-        for it in all_models.data:
-            if it.id in OpenAIModelID:
+        for it in response.json()["data"]:
+            if it["id"] in OpenAIModelID:
                 res.append(
                     {
-                        "id": it.id,
-                        "name": OpenAIModelID[it.id],
+                        "id": it["id"],
+                        "name": OpenAIModelID[it["id"]],
                     }
                 )
         return res
 
-    def chat(self, req: ChatRequest):
+    async def chat(self, req: ChatRequest):
         messages = req.messages
         if req.prompt:
             messages.insert(0, ChatMessage(role="system", content=req.prompt))
 
-        if req.key:
-            openai.api_key = req.key
-        else:
-            openai.api_key = os.environ.get("OPENAI_API_KEY")
-
-        if req.org:
-            openai.organization = req.org
-        else:
-            openai.organization = os.environ.get("OPENAI_ORGANIZATION")
+        start = time.perf_counter()
+        if self.chat_semaphore is None:
+            self.chat_semaphore = asyncio.Semaphore(self.config.chat_concurrency)
+        try:
+            await asyncio.wait_for(
+                self.chat_semaphore.acquire(), timeout=self.config.chat_timeout
+            )
+        except asyncio.TimeoutError:
+            raise HTTPException(503, error503)
 
-        def gen():
+        try:
+            upstream_request = self.http_client.build_request(
+                "POST",
+                "/chat/completions",
+                headers=self._openai_headers(req.key, req.org),
+                json={
+                    "model": req.model.id,
+                    "messages": [it.dict() for it in messages],
+                    "max_tokens": 1000,
+                    "temperature": req.temperature,
+                    "stream": True,
+                },
+            )
+            response = await self.http_client.send(upstream_request, stream=True)
+            if response.status_code != 200:
+                try:
+                    error = await response.aread()
+                finally:
+                    await response.aclose()
+                raise httpx.HTTPStatusError(
+                    f"{response.status_code} {error.decode(errors='replace')}",
+                    request=upstream_request,
+                    response=response,
+                )
+        except httpx.HTTPError as e:
+            self.chat_semaphore.release()
+            logger.error("Error in creating campaigns from openAI: " + str(e))
+            raise HTTPException(503, error503)
+        except BaseException:
+            # cancelled while waiting for openAI
+            self.chat_semaphore.release()
+            raise
+        metrics.CHAT_STREAMS_IN_FLIGHT.inc()
+
+        closed = False
+
+        async def close(status: str):
+            nonlocal closed
+            if closed:
+                return
+            closed = True
             try:
-                stream_response = openai.ChatCompletion.create(
-                    model=req.model.id,
-                    messages=[it.dict() for it in messages],
-                    max_tokens=1000,
-                    temperature=req.temperature,
-                    stream=True,
+                await response.aclose()
+            finally:
+                self.chat_semaphore.release()
+                metrics.CHAT_STREAMS_IN_FLIGHT.dec()
+                metrics.CHAT_STREAM_SECONDS.observe(
+                    status, value=time.perf_counter() - start
                 )
-            except Exception as e:
-                logger.error("Error in creating campaigns from openAI:", str(e))
-                raise HTTPException(503, error503)
 
+        async def gen():
+            status = "ok"
+            first_chunk = True
             try:
-                for chunk in stream_response:
-                    current_content = chunk["choices"][0]["delta"].get("content", "")
-                    yield current_content
-
-            except Exception as e:
+                async for content in iter_sse_content(response):
+                    if first_chunk:
+                        first_chunk = False
+                        metrics.CHAT_FIRST_CHUNK_SECONDS.observe(
+                            value=time.perf_counter() - start
+                        )
+                    if req.sse:
+                        yield f"data: {json.dumps({'content': content}, ensure_ascii=False)}\n\n"
+                    else:
+                        yield content
+                if req.sse:
+                    yield "data: [DONE]\n\n"
+            except httpx.HTTPError as e:
+                # status is already sent, the client sees a truncated stream
+                status = "error"
                 logger.error("OpenAI Response (Streaming) Error: " + str(e))
-                raise HTTPException(503, error503)
+            except asyncio.CancelledError:
+                status = "cancelled"
+                raise
+            finally:
+                await close(status)
+
+        # gen() never runs if the client disconnects before the body starts, the
+        # background task still closes the upstream response and frees the slot
+        return StreamingResponse(
+            content=gen(),
+            media_type="text/event-stream",
+            background=BackgroundTask(close, "cancelled"),
+        )
 
-        return StreamingResponse(content=gen(), media_type="text/event-stream")
+    def _cached_json(self, request: Request, table: str, query) -> Response:
+        """
+        Serve a whole table from memory, reloaded when its write generation changes.
+        Returns 304 if the client already has the current version.
+        """
+        db_url = str(self.db.engine.url)
+        generation = self.db.get_write_generations()[table]
+        etag = make_etag(db_url, table, generation)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if not_modified(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        cached = self.json_cache.get((db_url, table))
+        if cached is None or cached[0] != generation:
+            body = ORJSONResponse(jsonable_encoder(query())).body
+            cached = (generation, body)
+            self.json_cache[(db_url, table)] = cached
+        return Response(
+            content=cached[1], media_type="application/json", headers=headers
+        )
 
-    def get_folders(self) -> List[Folder]:
-        return self.db.get_folders()
+    def _generation(self, db: DBManager) -> tuple:
+        """Changes on every write of conversations or cluster results of db"""
+        generations = db.get_write_generations()
+        return (
+            str(db.engine.url),
+            generations["conversation"],
+            generations["cluster_member"],
+        )
 
-    def get_prompt_temps(self) -> List[PromptTemp]:
-        return self.db.get_prompt_temps()
+    def get_folders(self, request: Request) -> List[Folder]:
+        return self._cached_json(request, "folder", self.db.get_folders)
+
+    def get_prompt_temps(self, request: Request) -> List[PromptTemp]:
+        return self._cached_json(request, "prompttemp", self.db.get_prompt_temps)
+
+    def _count_conversations(
+        self, db: DBManager, req: GetConversionsRequest, generation: tuple
+    ) -> int:
+        # shared by all pages of a filter
+        key = ("count", generation[0], req.json(exclude={"page", "pageSize"}))
+        count = self.page_cache.get_or_load(
+            "count",
+            key,
+            generation,
+            lambda: str(
+                db.count_conversations(
+                    req.searchTerm,
+                    req.messageCountFilterCount,
+                    req.messageCountFilterMode,
+                    cluster_run_id=req.clusterRunId,
+                    cluster_group_id=req.clusterGroupId,
+                    filter_expr=req.filter,
+                )
+            ).encode(),
+        )
+        return int(count)
 
-    def get_conversations(self, req: GetConversionsRequest) -> GetConversionsResponse:
-        conversions_count = self.db.count_conversations(
-            req.searchTerm, req.messageCountFilterCount, req.messageCountFilterMode
+    def _conversations_page(
+        self, db: DBManager, req: GetConversionsRequest, generation: tuple
+    ) -> bytes:
+        conversions_count = self._count_conversations(db, req, generation)
+        total_pages = math.ceil(conversions_count / req.pageSize)
+        # conversations are spliced as stored json, see DBManager.get_conversations_json
+        conversations = db.get_conversations_json(
+            page=req.page,
+            page_size=req.pageSize,
+            search_term=req.searchTerm,
+            messageCountFilterCount=req.messageCountFilterCount,
+            messageCountFilterMode=req.messageCountFilterMode,
+            cluster_run_id=req.clusterRunId,
+            cluster_group_id=req.clusterGroupId,
+            filter_expr=req.filter,
+        )
+        head = json.dumps(
+            {
+                "page": req.page,
+                "totalPages": total_pages,
+                "totalConversations": conversions_count,
+            }
         )
+        return head[:-1].encode() + b', "conversations": ' + conversations + b"}"
+
+    def _summaries_page(
+        self, db: DBManager, req: GetConversionsRequest, generation: tuple
+    ) -> bytes:
+        conversions_count = self._count_conversations(db, req, generation)
         total_pages = math.ceil(conversions_count / req.pageSize)
-        return GetConversionsResponse(
-            conversations=self.db.get_conversations(
+        res = GetConversationSummariesResponse(
+            conversations=db.get_conversation_summaries(
                 page=req.page,
                 page_size=req.pageSize,
                 search_term=req.searchTerm,
                 messageCountFilterCount=req.messageCountFilterCount,
                 messageCountFilterMode=req.messageCountFilterMode,
+                cluster_run_id=req.clusterRunId,
+                cluster_group_id=req.clusterGroupId,
+                filter_expr=req.filter,
             ),
             page=req.page,
             totalPages=total_pages,
             totalConversations=conversions_count,
         )
+        return ORJSONResponse(jsonable_encoder(res)).body
+
+    def _cached_page(
+        self, kind: str, load, req: GetConversionsRequest, request: Request
+    ):
+        """
+        Serve a page from the page cache and prefetch the next one, reviewers mostly
+        page through conversations in order.
+        """
+        self._check_filter(req.filter)
+        self.flush_writes()
+        db = self.db
+        generation = self._generation(db)
+        etag = make_etag(*generation, kind, req.json())
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if not_modified(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        key = (kind, generation[0], req.json())
+        body = self.page_cache.get_or_load(
+            kind, key, generation, lambda: load(db, req, generation)
+        )
+        count = self._count_conversations(db, req, generation)
+        if (req.page + 1) * req.pageSize < count:
+            next_req = req.copy(update={"page": req.page + 1})
+            # the prefetch may outlive the request, keep its dataset open
+            dataset = CURRENT_DATASET.get()
+            if dataset is not None:
+                self.datasets.retain(dataset)
+
+            def load_next() -> bytes:
+                try:
+                    return load(db, next_req, generation)
+                finally:
+                    if dataset is not None:
+                        self.datasets.release(dataset)
+
+            scheduled = self.page_cache.prefetch(
+                kind, (kind, generation[0], next_req.json()), generation, load_next
+            )
+            if not scheduled and dataset is not None:
+                self.datasets.release(dataset)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def get_conversations(
+        self, req: GetConversionsRequest, request: Request
+    ) -> Response:
+        return self._cached_page(
+            "conversations", self._conversations_page, req, request
+        )
+
+    def get_conversation_summaries(
+        self, req: GetConversionsRequest, request: Request
+    ) -> GetConversationSummariesResponse:
+        return self._cached_page("summaries", self._summaries_page, req, request)
+
+    def get_conversation(
+        self, conversation_id: str, request: Request
+    ) -> DBConversation:
+        db = self.db
+        pending = None
+        if self.write_buffer is not None:
+            pending = self.write_buffer.get(conversation_id)
+        if pending is not None:
+            # the generation does not cover buffered updates yet, no ETag or cache
+            conv = self._load_conversation(db, conversation_id)
+            conv.data = pending
+            return conv
+
+        generation = self._generation(db)
+        etag = make_etag(*generation, "conversation", conversation_id)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if not_modified(request, etag):
+            return Response(status_code=304, headers=headers)
+        body = self.page_cache.get_or_load(
+            "conversation",
+            ("conversation", generation[0], conversation_id),
+            generation,
+            lambda: ORJSONResponse(
+                jsonable_encoder(self._load_conversation(db, conversation_id))
+            ).body,
+        )
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def _load_conversation(self, db: DBManager, conversation_id: str) -> DBConversation:
+        try:
+            conv = db.get_conversation(conversation_id)
+        except ValueError:
+            conv = None
+        if conv is None:
+            raise HTTPException(404, f"Conversation {conversation_id} not found")
+        return conv
 
     def update_conversation(self, req: Conversation):
+        if self.write_buffer is not None:
+            self.write_buffer.put(str(req.id), req.dict())
+            return "ok", 200
         db_req = DBConversation(id=req.id, data=req.dict())
         self.db.update_conversation(db_req)
         return "ok", 200
         # return Conversation(**db_res.data)
 
+    def patch_conversation(
+        self, req: PatchConversationRequest
+    ) -> PatchConversationResponse:
+        # ops are based on the latest saved content
+        self.flush_writes()
+        try:
+            version = self.db.patch_conversation(
+                req.id, [it.dict(exclude_none=True) for it in req.ops], req.version
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            raise HTTPException(400, "Invalid patch: " + str(e))
+
+        if version is None:
+            current_version = self.db.get_conversation_version(req.id)
+            if current_version is None:
+                raise HTTPException(404, f"Conversation {req.id} not found")
+            if req.version is not None and current_version != req.version:
+                raise HTTPException(
+                    409, f"Conversation changed, version {current_version}"
+                )
+            raise HTTPException(400, "Invalid patch: message index out of range")
+        return PatchConversationResponse(version=version)
+
     def create_conversation(self, req: Conversation):
         db_req = DBConversation(id=req.id, data=req.dict())
         self.db.create_conversation(db_req)
@@ -220,6 +795,7 @@ class Api:
         # return Conversation(**db_res.data)
 
     def split_conversation(self, req: SplitConversationRequest):
+        self.flush_writes()
         try:
             db_req = DBConversation(
                 id=req.conversation.id, data=req.conversation.dict()
@@ -231,21 +807,126 @@ class Api:
         # return Conversation(**db_res.data)
 
     def delete_conversation(self, req: Conversation):
+        if self.write_buffer is not None:
+            self.write_buffer.discard([str(req.id)])
         self.db.delete_conversation(req.id)
         return "ok", 200
 
-    def count_tokens(self, req: CountTokensRequest) -> CountTokensResponse:
-        @lru_cache(maxsize=512)
-        def cached_count_tokens(text: str) -> int:
-            if self.tokenizer is None:
-                return 0
-            else:
-                return len(self.tokenizer(text)["input_ids"])
-
+    def _check_filter(self, expr: str):
+        try:
+            parse_filter(expr)
+        except FilterSyntaxError as e:
+            raise HTTPException(400, f"Invalid filter: {e}")
+
+    def _check_selection(self, req: ConversationSelection):
+        if req.is_empty():
+            raise HTTPException(400, "Select conversations by ids or a filter")
+        self._check_filter(req.filter)
+        if req.ids is not None:
+            try:
+                [UUID(it) for it in req.ids]
+            except ValueError as e:
+                raise HTTPException(400, "Invalid conversation id: " + str(e))
+        # buffered whole conversation writes would undo the bulk change
+        self.flush_writes()
+
+    def bulk_delete_conversations(self, req: BulkDeleteRequest) -> BulkResponse:
+        self._check_selection(req)
+        count = self.db.bulk_delete_conversations(req.ids, **req.filters())
+        return BulkResponse(count=count)
+
+    def bulk_tag_conversations(self, req: BulkTagRequest) -> BulkResponse:
+        self._check_selection(req)
+        count = self.db.bulk_set_tags(req.setTags, req.ids, **req.filters())
+        return BulkResponse(count=count)
+
+    def bulk_move_conversations(self, req: BulkMoveRequest) -> BulkResponse:
+        self._check_selection(req)
+        count = self.db.bulk_move_conversations(req.folderId, req.ids, **req.filters())
+        return BulkResponse(count=count)
+
+    async def count_tokens(self, req: CountTokensRequest) -> CountTokensResponse:
+        counts = await run_in_threadpool(
+            self.token_counter.count, [req.prompt] + req.messages
+        )
         return CountTokensResponse(
-            promptTokenCount=cached_count_tokens(req.prompt),
-            messagesTokenCounts=[cached_count_tokens(it) for it in req.messages],
+            promptTokenCount=counts[0],
+            messagesTokenCounts=counts[1:],
+        )
+
+    def get_cluster_runs(self) -> List[ClusterRun]:
+        return [
+            ClusterRun(id=it.id, name=it.name, meta=it.meta)
+            for it in self.db.get_cluster_runs()
+        ]
+
+    def get_cluster_groups(
+        self, req: GetClusterGroupsRequest
+    ) -> GetClusterGroupsResponse:
+        groups = self.db.get_cluster_groups_by_size(
+            req.runId, min_size=req.minSize, page=req.page, page_size=req.pageSize
         )
+        return GetClusterGroupsResponse(
+            groups=[ClusterGroup(groupId=it[0], size=it[1]) for it in groups]
+        )
+
+    def get_conversation_cluster_group(
+        self, req: GetConversationClusterGroupRequest
+    ) -> GetConversationClusterGroupResponse:
+        group_id = self.db.get_conversation_cluster_group(req.runId, req.conversationId)
+        if group_id is None:
+            return GetConversationClusterGroupResponse(groupId=None, conversationIds=[])
+        return GetConversationClusterGroupResponse(
+            groupId=group_id,
+            conversationIds=self.db.get_cluster_group(req.runId, group_id),
+        )
+
+    def submit_job(self, req: SubmitJobRequest) -> Job:
+        from llm_labeling_ui.jobs import JOBS
+
+        if req.name not in JOBS:
+            raise HTTPException(
+                400, f"Unknown job {req.name}, choose from {list(JOBS)}"
+            )
+        if self.db.count_jobs(JOB_QUEUED) >= self.config.max_queued_jobs:
+            raise HTTPException(429, "Too many queued jobs, try again later")
+        return self.db.create_job(req.name, req.params)
+
+    def get_jobs(self) -> List[Job]:
+        return self.db.get_jobs()
+
+    def get_job(self, job_id: int) -> Job:
+        job = self.db.get_job(job_id)
+        if job is None:
+            raise HTTPException(404, f"Job {job_id} not found")
+        return job
+
+    def cancel_job(self, job_id: int) -> Job:
+        job = self.db.cancel_job(job_id)
+        if job is None:
+            raise HTTPException(404, f"Job {job_id} not found")
+        return job
+
+    async def job_events(self, job_id: int) -> StreamingResponse:
+        """Server sent events with the job state whenever its progress changes"""
+        job = await run_in_threadpool(self.get_job, job_id)
+
+        async def gen():
+            last = None
+            current = job
+            while True:
+                state = current.json()
+                if state != last:
+                    last = state
+                    yield f"data: {state}\n\n"
+                if current.status in JOB_FINISHED_STATUSES:
+                    break
+                await asyncio.sleep(0.5)
+                current = await run_in_threadpool(self.db.get_job, job_id)
+                if current is None:
+                    break
+
+        return StreamingResponse(content=gen(), media_type="text/event-stream")
 
     def add_api_route(self, path: str, endpoint, **kwargs):
         return self.app.add_api_route(path, endpoint, **kwargs)
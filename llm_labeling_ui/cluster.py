@@ -1,5 +1,10 @@
 import math
-from typing import List
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Optional, Tuple
 import pandas as pd
 import numpy as np
 from loguru import logger
@@ -8,79 +13,162 @@ from more_itertools import flatten
 from transformers import AutoTokenizer, AutoModel
 import torch
 
+# Embedding matrix of the current clustering run, opened as a read-only memmap
+# in every worker process so buckets are never pickled to the pool.
+_EMBEDDINGS = None
+
+
+def _init_embeddings(embedding_path: str):
+    global _EMBEDDINGS
+    _EMBEDDINGS = np.load(embedding_path, mmap_mode="r")
+
+
+def _dbscan_predict(
+    X: np.ndarray, metric: str, eps: float, min_samples: int, n_jobs: int = None
+) -> List[List[int]]:
+    # metric = "euclidean"
+    # metric = "cosine"
+    clusterer = DBSCAN(eps=eps, min_samples=min_samples, metric=metric, n_jobs=n_jobs)
+    # clusterer = OPTICS(
+    #     min_samples=min_samples,
+    #     max_eps=eps,
+    #     metric=metric,
+    #     cluster_method="dbscan",
+    # ).fit(X.tolist())
+    y_db = clusterer.fit_predict(X)
+
+    unique_labels = np.unique(y_db)
+    res = []
+    for label in unique_labels:
+        if label == -1:
+            continue
+        indexes = np.where(y_db == label)[0]
+        res.append(indexes.tolist())
+    return res
+
+
+def _cluster_bucket(
+    rows: np.ndarray,
+    metric: str,
+    eps: float,
+    min_samples: int,
+    max_samples: int,
+    recluster_samples: int,
+    n_jobs: int = None,
+) -> Tuple[List[List[int]], List[List[int]], float]:
+    """
+    Cluster one bucket of the embedding matrix.
+
+    Args:
+        rows: Row numbers of the bucket in the embedding matrix.
+
+    Returns: (row groups to keep, sizes of the reclustered groups, elapsed seconds)
+    """
+    start = time.time()
+    X = np.asarray(_EMBEDDINGS[rows])
+    index_groups = _dbscan_predict(X, metric, eps, min_samples, n_jobs)
+    row_groups = []
+    reclustered = []
+    for index_group in index_groups:
+        if len(index_group) <= max_samples:
+            row_groups.append(rows[index_group].tolist())
+        elif len(index_group) >= recluster_samples:
+            sub_rows = rows[index_group]
+            sub_index_groups = _dbscan_predict(
+                X[index_group], metric, eps * 4 / 5, min_samples, n_jobs
+            )
+            if len(sub_index_groups):
+                reclustered.append(
+                    [len(index_group)] + [len(it) for it in sub_index_groups]
+                )
+            for it in sub_index_groups:
+                if len(it) <= max_samples:
+                    row_groups.append(sub_rows[it].tolist())
+    return row_groups, reclustered, time.time() - start
+
 
 def _inter_run_dbscan_cluster(
     df: pd.DataFrame,
+    embedding_path: str,
     metric: str,
     eps: float,
     min_samples: int,
     max_samples: int,
     recluster_samples: int,
     bucket_size: int,
+    jobs: int = 1,
 ) -> List[List[str]]:
     """
     Run DBSCAN clustering on a dataframe's embedding column.
 
     Args:
-        df:
+        df: Dataframe with column name: id, row. row is the row number in the embedding matrix.
+        embedding_path: .npy file of the embedding matrix, opened as memmap.
         eps: DBSCAN eps. The maximum distance between two samples for one to be considered
             as in the neighborhood of the other.
         min_samples:
         max_samples: If the number of samples in a cluster exceeds max_samples, multiply eps by 2/3 and cluster again.
         bucket_size: The maximum amount of data for a single cluster
+        jobs: Number of worker processes used to cluster buckets concurrently.
 
     Returns: The returned clustering results, the data of each group is between [min_samples, max_samples].
     """
-
-    def predict(X, eps) -> List[List[int]]:
-        # metric = "euclidean"
-        # metric = "cosine"
-        clusterer = DBSCAN(eps=eps, min_samples=min_samples, metric=metric)
-        # clusterer = OPTICS(
-        #     min_samples=min_samples,
-        #     max_eps=eps,
-        #     metric=metric,
-        #     cluster_method="dbscan",
-        # ).fit(X.tolist())
-        y_db = clusterer.fit_predict(X.tolist())
-
-        unique_labels = np.unique(y_db)
-        res = []
-        for label in unique_labels:
-            if label == -1:
-                continue
-            indexes = np.where(y_db == label)[0]
-            res.append(indexes.tolist())
-        return res
-
     total_buckets = math.ceil(len(df) / bucket_size)
-    all_id_groups: List[List[str]] = []
-    for i, bucket in enumerate(np.array_split(df, total_buckets)):
-        logger.info(f"Processing bucket {i + 1}/{total_buckets}, size: {len(bucket)}")
-        index_groups = predict(bucket["embedding"], eps)
+    if total_buckets == 0:
+        return []
+    buckets = np.array_split(df["row"].to_numpy(), total_buckets)
+    row_to_id = dict(zip(df["row"].tolist(), df["id"].tolist()))
+
+    def log_bucket(i, rows, row_groups, reclustered, elapsed):
         logger.info(
-            f"bucket groups: {len(index_groups)}. {sorted([len(it) for it in index_groups], reverse=True)}"
+            f"Bucket {i + 1}/{total_buckets} done in {elapsed:.2f}s, size: {len(rows)}, "
+            f"groups: {len(row_groups)}. {sorted([len(it) for it in row_groups], reverse=True)}"
         )
-        for index_group in index_groups:
-            id_group = bucket.iloc[index_group].id.tolist()
-            if len(id_group) <= max_samples:
-                all_id_groups.append(id_group)
-            elif len(id_group) >= recluster_samples:
-                large_sub_bucket = bucket[bucket["id"].isin(id_group)]
-                sub_index_groups = predict(
-                    large_sub_bucket["embedding"], eps=eps * 4 / 5
-                )
-                sub_id_groups = [
-                    large_sub_bucket.iloc[sub_index_group].id.tolist()
-                    for sub_index_group in sub_index_groups
-                ]
-                if len(sub_id_groups):
-                    logger.info(
-                        f"Group size: {len(large_sub_bucket)} > recluster_samples({recluster_samples}), recluster {len(sub_id_groups)} sub groups: {[len(it) for it in sub_id_groups]}"
-                    )
-                for it in sub_id_groups:
-                    if len(it) <= max_samples:
-                        all_id_groups.append(it)
+        for it in reclustered:
+            logger.info(
+                f"Group size: {it[0]} > recluster_samples({recluster_samples}), recluster {len(it) - 1} sub groups: {it[1:]}"
+            )
+
+    results = {}
+    if jobs == 1 or total_buckets == 1:
+        _init_embeddings(embedding_path)
+        for i, rows in enumerate(buckets):
+            logger.info(f"Processing bucket {i + 1}/{total_buckets}, size: {len(rows)}")
+            results[i] = _cluster_bucket(
+                rows, metric, eps, min_samples, max_samples, recluster_samples, jobs
+            )
+            log_bucket(i, rows, *results[i])
+    else:
+        workers = min(jobs, total_buckets) if jobs > 0 else None
+        logger.info(f"Processing {total_buckets} buckets with {workers} workers")
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_embeddings,
+            initargs=(embedding_path,),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _cluster_bucket,
+                    rows,
+                    metric,
+                    eps,
+                    min_samples,
+                    max_samples,
+                    recluster_samples,
+                    1,
+                ): i
+                for i, rows in enumerate(buckets)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                results[i] = future.result()
+                log_bucket(i, buckets[i], *results[i])
+
+    # merge in bucket order so the result does not depend on worker scheduling
+    all_id_groups: List[List[str]] = []
+    for i in range(total_buckets):
+        for row_group in results[i][0]:
+            all_id_groups.append([row_to_id[row] for row in row_group])
     return all_id_groups
 
 
@@ -94,6 +182,7 @@ def run_dbscan_cluster(
     recluster_samples: int,
     epochs: int,
     bucket_size: int,
+    jobs: int = 1,
 ) -> List[List[str]]:
     """
     Run DBSCAN clustering on a dataframe's embedding column.
@@ -106,33 +195,256 @@ def run_dbscan_cluster(
         max_samples: If the number of samples in a cluster exceeds max_samples, multiply eps by 0.5 and cluster again.
         epochs: Number of times all data is clustered.
         bucket_size: The maximum amount of data for a single cluster
+        jobs: Number of worker processes used to cluster buckets concurrently. -1 means all cpus.
 
     Returns: The returned clustering results, the data of each group is between [min_samples, max_samples].
     """
+    tmp_dir = tempfile.mkdtemp(prefix="llm_labeling_ui_cluster_")
+    embedding_path = os.path.join(tmp_dir, "embedding.npy")
+    np.save(embedding_path, np.stack(df["embedding"].to_numpy()).astype(np.float32))
+    df = pd.DataFrame({"id": df["id"].to_numpy(), "row": np.arange(len(df))})
+
     all_id_groups: List[List[str]] = []
-    for iter in range(epochs):
-        total_samples_count = len(df)
-        logger.info(
-            f"Running DBSCAN clustering epoch: {iter + 1}/{epochs}, total samples: {total_samples_count}"
-        )
-        id_groups = _inter_run_dbscan_cluster(
-            df, metric, eps, min_samples, max_samples, recluster_samples, bucket_size
-        )
-        new_eps = eps * eps_decay
-        logger.info(f"Decay eps: {eps} -> {new_eps}")
-        eps = new_eps
-        clustered_ids = set(flatten(id_groups))
-        unclustered_ids = set(df.id.tolist()) - clustered_ids
-        df = df[df.id.isin(unclustered_ids)]
-        df = df.sample(frac=1)
-        all_id_groups.extend(id_groups)
-        if len(df) == total_samples_count:
-            logger.warning(f"DBSCAN clustering early stop at epoch: {iter + 1}")
-            break
+    try:
+        for iter in range(epochs):
+            total_samples_count = len(df)
+            logger.info(
+                f"Running DBSCAN clustering epoch: {iter + 1}/{epochs}, total samples: {total_samples_count}"
+            )
+            id_groups = _inter_run_dbscan_cluster(
+                df,
+                embedding_path,
+                metric,
+                eps,
+                min_samples,
+                max_samples,
+                recluster_samples,
+                bucket_size,
+                jobs,
+            )
+            new_eps = eps * eps_decay
+            logger.info(f"Decay eps: {eps} -> {new_eps}")
+            eps = new_eps
+            clustered_ids = set(flatten(id_groups))
+            unclustered_ids = set(df.id.tolist()) - clustered_ids
+            df = df[df.id.isin(unclustered_ids)]
+            df = df.sample(frac=1)
+            all_id_groups.extend(id_groups)
+            if len(df) == total_samples_count:
+                logger.warning(f"DBSCAN clustering early stop at epoch: {iter + 1}")
+                break
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
     return all_id_groups
 
 
+def k_distance_elbow(k_distances: np.ndarray) -> float:
+    """
+    Find the elbow of a k-distance curve, a good starting point of DBSCAN eps.
+
+    Args:
+        k_distances: Distance of every sample to its k-th nearest neighbor.
+
+    Returns: The k-distance at the point of the sorted curve farthest below the chord
+        from its first to its last point.
+    """
+    y = np.sort(k_distances)
+    if len(y) < 3 or y[-1] == y[0]:
+        return float(y[-1]) if len(y) else 0.0
+    x = np.linspace(0, 1, len(y))
+    y_norm = (y - y[0]) / (y[-1] - y[0])
+    return float(y[np.argmax(x - y_norm)])
+
+
+SWEEP_SIZE_BINS = [1, 2, 3, 4, 6, 11, 21, 51, 101, np.inf]
+SWEEP_SIZE_LABELS = ["1", "2", "3", "4-5", "6-10", "11-20", "21-50", "51-100", ">100"]
+
+
+def run_dbscan_sweep(
+    X: np.ndarray,
+    metric: str,
+    eps_list: List[float],
+    min_samples_list: List[int],
+    max_samples: int,
+    n_neighbors: int,
+    jobs: int = 1,
+) -> pd.DataFrame:
+    """
+    Estimate DBSCAN results for a grid of eps/min_samples from a single k-nearest-neighbor search.
+
+    A sample is a core sample when its min_samples-th neighbor (itself included, as in sklearn)
+    is within eps. Groups are the connected components of core samples linked by kNN edges within
+    eps, border samples join the group of their nearest core neighbor. This matches DBSCAN exactly
+    as long as no sample has more than n_neighbors samples within eps. Samples whose last
+    neighbor is within eps are counted in the saturated column and logged as a warning.
+
+    Args:
+        X: Embedding matrix
+        eps_list: DBSCAN eps values to evaluate
+        min_samples_list: DBSCAN min_samples values to evaluate
+        max_samples: Groups larger than max_samples are not counted in coverage, same as `cluster run`.
+        n_neighbors: Number of nearest neighbors to compute, at least max(min_samples_list).
+
+    Returns: One row per eps/min_samples with group count, coverage and group size histogram.
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components
+    from sklearn.neighbors import NearestNeighbors
+
+    n_neighbors = min(max(n_neighbors, max(min_samples_list)), len(X))
+    logger.info(f"Computing {n_neighbors} nearest neighbors of {len(X)} samples")
+    start = time.time()
+    distances, indices = (
+        NearestNeighbors(n_neighbors=n_neighbors, metric=metric, n_jobs=jobs)
+        .fit(X)
+        .kneighbors(X)
+    )
+    logger.info(f"Nearest neighbors done in {time.time() - start:.2f}s")
+
+    elbows = {
+        min_samples: k_distance_elbow(distances[:, min(min_samples, n_neighbors) - 1])
+        for min_samples in min_samples_list
+    }
+    for min_samples, elbow in elbows.items():
+        logger.info(f"k-distance elbow of min_samples {min_samples}: eps={elbow:.4f}")
+
+    rows = []
+    n = len(X)
+    # samples whose last neighbor is still within eps may have more neighbors than were
+    # searched, their core status and edges can be missing from the estimate
+    saturated = {
+        eps: int((distances[:, -1] <= eps).sum()) if n_neighbors < n else 0
+        for eps in eps_list
+    }
+    for eps in sorted(eps_list):
+        if saturated[eps]:
+            logger.warning(
+                f"eps={eps}: {saturated[eps]} samples have all {n_neighbors} nearest "
+                "neighbors within eps, results are not exact, increase --neighbors"
+            )
+    for min_samples in sorted(min_samples_list):
+        for eps in sorted(eps_list):
+            if min_samples > n_neighbors:
+                core = np.zeros(n, dtype=bool)
+            else:
+                core = distances[:, min_samples - 1] <= eps
+            within = distances <= eps
+            edges = within & core[:, None] & core[indices]
+            graph = csr_matrix(
+                (np.ones(edges.sum()), (np.nonzero(edges)[0], indices[edges])),
+                shape=(n, n),
+            )
+            _, labels = connected_components(graph, directed=False)
+            labels = np.where(core, labels, -1)
+
+            border_mask = within & core[indices]
+            border = ~core & border_mask.any(axis=1)
+            nearest_core = indices[np.arange(n), border_mask.argmax(axis=1)]
+            labels[border] = labels[nearest_core[border]]
+
+            sizes = np.bincount(labels[labels != -1])
+            sizes = sizes[sizes > 0]
+            kept = sizes[sizes <= max_samples]
+            hist, _ = np.histogram(sizes, bins=SWEEP_SIZE_BINS)
+            rows.append(
+                {
+                    "eps": eps,
+                    "min_samples": min_samples,
+                    "groups": len(sizes),
+                    "kept_groups": len(kept),
+                    "coverage": kept.sum() / n if n else 0.0,
+                    "clustered": sizes.sum() / n if n else 0.0,
+                    "oversized_groups": len(sizes) - len(kept),
+                    "largest_group": int(sizes.max()) if len(sizes) else 0,
+                    "elbow_eps": elbows[min_samples],
+                    "saturated": saturated[eps],
+                    "size_histogram": " ".join(
+                        f"{label}:{count}"
+                        for label, count in zip(SWEEP_SIZE_LABELS, hist)
+                        if count
+                    ),
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def group_medoids(
+    df: pd.DataFrame, id_groups: List[List[str]], metric: str
+) -> List[Optional[str]]:
+    """
+    Find the medoid of every group, the member with the smallest total distance to the others.
+
+    Args:
+        df: Dataframe with column name: id, embedding. Members missing from df, e.g. after
+            prune_embedding, are skipped.
+        id_groups: Cluster groups
+
+    Returns: Medoid id of every group, in the same order as id_groups. None for groups
+        without any member in df.
+    """
+    from sklearn.metrics import pairwise_distances
+
+    id_to_row = pd.Series(np.arange(len(df)), index=df["id"].to_numpy())
+    embeddings = df["embedding"].to_numpy()
+    medoids = []
+    for group in id_groups:
+        members = [it for it in group if it in id_to_row.index]
+        if not members:
+            medoids.append(None)
+            continue
+        X = np.stack(embeddings[id_to_row[members].to_numpy()])
+        medoids.append(
+            members[int(pairwise_distances(X, metric=metric).sum(1).argmin())]
+        )
+    return medoids
+
+
+def assign_to_groups(
+    medoid_X: np.ndarray,
+    group_sizes: List[int],
+    X: np.ndarray,
+    metric: str,
+    eps: float,
+    max_samples: int,
+    n_neighbors: int = 5,
+) -> np.ndarray:
+    """
+    Attach new samples to the group of their nearest medoid.
+
+    Args:
+        medoid_X: Medoid embedding of every group
+        group_sizes: Current size of every group, updated in place as samples are attached.
+        X: Embedding of the new samples
+        eps: A sample is attached only if a medoid is within eps.
+        max_samples: Groups are not grown beyond max_samples, the next nearest medoid is tried instead.
+        n_neighbors: Number of nearest medoids to try for every sample.
+
+    Returns: Group index of every new sample, -1 if it is not attached.
+    """
+    from sklearn.neighbors import NearestNeighbors
+
+    labels = np.full(len(X), -1)
+    if len(medoid_X) == 0 or len(X) == 0:
+        return labels
+
+    n_neighbors = min(n_neighbors, len(medoid_X))
+    distances, indices = (
+        NearestNeighbors(n_neighbors=n_neighbors, metric=metric)
+        .fit(medoid_X)
+        .kneighbors(X)
+    )
+    for i in np.argsort(distances[:, 0], kind="stable"):
+        for distance, group_index in zip(distances[i], indices[i]):
+            if distance > eps:
+                break
+            if group_sizes[group_index] < max_samples:
+                labels[i] = group_index
+                group_sizes[group_index] += 1
+                break
+    return labels
+
+
 # Sentences we want sentence embeddings for
 class EmbeddingModel:
     def __init__(self, model_id, device):
@@ -161,3 +473,46 @@ class EmbeddingModel:
             sentence_embeddings, p=2, dim=0
         )
         return sentence_embeddings.cpu().tolist()
+
+    def batch(self, texts_list: List[List[str]]) -> List[List[float]]:
+        return [self(texts) for texts in texts_list]
+
+
+class HashingEmbeddingModel:
+    """
+    CPU friendly embedding: character n-gram counts hashed into a sparse vector, then
+    reduced to a dense l2 normalized vector by sparse random projection. No fitting is
+    needed, so embedding created in different runs are comparable.
+    """
+
+    def __init__(
+        self,
+        dim: int = 256,
+        ngram_range: Tuple[int, int] = (2, 4),
+        n_features: int = 2**20,
+        seed: int = 0,
+    ):
+        from scipy.sparse import csr_matrix
+        from sklearn.feature_extraction.text import HashingVectorizer
+        from sklearn.random_projection import SparseRandomProjection
+
+        self.vectorizer = HashingVectorizer(
+            analyzer="char",
+            ngram_range=ngram_range,
+            n_features=n_features,
+            alternate_sign=False,
+            norm="l2",
+        )
+        # random projection only uses the input shape to draw its components
+        self.projection = SparseRandomProjection(
+            n_components=dim, dense_output=True, random_state=seed
+        ).fit(csr_matrix((1, n_features)))
+
+    def __call__(self, texts: List[str]) -> List[float]:
+        return self.batch([texts])[0]
+
+    def batch(self, texts_list: List[List[str]]) -> List[List[float]]:
+        from sklearn.preprocessing import normalize
+
+        X = self.vectorizer.transform(["\n".join(texts) for texts in texts_list])
+        return normalize(self.projection.transform(X)).astype(np.float32).tolist()
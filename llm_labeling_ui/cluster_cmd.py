@@ -2,8 +2,8 @@ from enum import Enum
 import json
 import math
 import random
-from typing import List
-from more_itertools import flatten
+from typing import Dict, List, Optional, Sequence
+from more_itertools import chunked, flatten
 
 import typer
 from pathlib import Path
@@ -14,7 +14,7 @@ from rich.prompt import Confirm
 from rich import print
 from rich.markdown import Markdown
 
-from llm_labeling_ui.db_schema import DBManager
+from llm_labeling_ui.db_schema import Conversation, DBManager
 from llm_labeling_ui.utils import interactive_view_conversations
 
 app = typer.Typer(
@@ -24,6 +24,34 @@ app = typer.Typer(
 )
 
 
+class DBSCANMetric(str, Enum):
+    euclidean = "euclidean"
+    cosine = "cosine"
+    manhattan = "manhattan"
+
+
+class EmbeddingBackend(str, Enum):
+    transformer = "transformer"
+    hashing = "hashing"
+
+
+def _load_embedding_model(
+    backend: EmbeddingBackend, model_id: str, device: str, dim: int
+):
+    from llm_labeling_ui.cluster import EmbeddingModel, HashingEmbeddingModel
+
+    if backend == EmbeddingBackend.hashing:
+        return HashingEmbeddingModel(dim=dim)
+    return EmbeddingModel(model_id, device)
+
+
+def _user_messages(conv: Conversation, max_messages: int) -> List[str]:
+    messages = [m["content"] for m in conv.data["messages"] if m["role"] == "user"]
+    if max_messages == -1:
+        return messages
+    return messages[:max_messages]
+
+
 @app.command(help="Create embedding")
 def create_embedding(
     db_path: Path = typer.Option(..., exists=True, dir_okay=False),
@@ -32,10 +60,15 @@ def create_embedding(
         dir_okay=False,
         help="Parquet file with column name: id, embedding. If None, embedding will be saved in the same directory as db_path, with parquet file suffix.",
     ),
+    backend: EmbeddingBackend = typer.Option(
+        EmbeddingBackend.transformer,
+        help="transformer: huggingface model of model_id. hashing: character n-gram hashing with random projection, fast on cpu.",
+    ),
     model_id: str = typer.Option(
         "BAAI/bge-large-zh-v1.5",
         help="Embedding model id on huggingface. https://huggingface.co/models?pipeline_tag=feature-extraction",
     ),
+    dim: int = typer.Option(256, help="Embedding size of hashing backend"),
     max_messages: int = typer.Option(
         1, help="Number of messages used to create embedding. -1 means all messages."
     ),
@@ -44,17 +77,18 @@ def create_embedding(
     if save_path is None:
         save_path = db_path.with_suffix(".parquet")
 
-    from llm_labeling_ui.cluster import EmbeddingModel
     import pandas as pd
 
     db = DBManager(db_path)
-    model = EmbeddingModel(model_id, device)
+    model = _load_embedding_model(backend, model_id, device, dim)
 
     if save_path.exists():
         exists_df = pd.read_parquet(save_path)
         logger.info(f"Load exists embedding: {len(exists_df)}")
+        exists_ids = set(exists_df["id"].tolist())
     else:
         exists_df = None
+        exists_ids = set()
 
     res = []
     total = db.count_conversations()
@@ -63,19 +97,9 @@ def create_embedding(
     for convs in track(
         db.gen_conversations(page_size), total=math.ceil(total / page_size)
     ):
-        for conv in convs:
-            if exists_df is not None:
-                if str(conv.id) in exists_df["id"].values:
-                    continue
-
-            messages = []
-            for msg in conv.data["messages"]:
-                if msg["role"] == "user":
-                    messages.append(msg["content"])
-            if max_messages == -1:
-                max_messages = len(messages)
-            messages = messages[:max_messages]
-            vector = model(messages)
+        convs = [it for it in convs if str(it.id) not in exists_ids]
+        vectors = model.batch([_user_messages(it, max_messages) for it in convs])
+        for conv, vector in zip(convs, vectors):
             res.append({"id": str(conv.id), "embedding": vector})
 
     df = pd.DataFrame(res)
@@ -87,6 +111,97 @@ def create_embedding(
     df.to_parquet(save_path)
 
 
+@app.command(
+    help="Compare throughput and cluster agreement of embedding backends on a sample of the db"
+)
+def benchmark_embedding(
+    db_path: Path = typer.Option(..., exists=True, dir_okay=False),
+    model_id: str = typer.Option(
+        "BAAI/bge-large-zh-v1.5", help="Embedding model id of transformer backend"
+    ),
+    dim: int = typer.Option(256, help="Embedding size of hashing backend"),
+    max_messages: int = typer.Option(
+        1, help="Number of messages used to create embedding. -1 means all messages."
+    ),
+    device: str = typer.Option("cpu"),
+    sample_size: int = typer.Option(2000, help="Number of conversations to embed"),
+    label_tag: str = typer.Option(
+        None,
+        help="Tag key holding a reference label of each conversation, e.g. a manual duplicate group id",
+    ),
+    metric: DBSCANMetric = typer.Option(
+        "euclidean", help="DBSCAN metric. euclidean or cosine"
+    ),
+    eps: float = typer.Option(0.5, help="DBSCAN eps of transformer embedding"),
+    hashing_eps: float = typer.Option(0.5, help="DBSCAN eps of hashing embedding"),
+    min_samples: int = typer.Option(3, help="DBSCAN min_samples"),
+):
+    import time
+    import numpy as np
+    from rich.table import Table
+    from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+    from llm_labeling_ui.cluster import _dbscan_predict
+
+    db = DBManager(db_path)
+    convs = db.get_conversations(0, sample_size)
+    texts_list = [_user_messages(it, max_messages) for it in convs]
+    logger.info(f"Benchmark on {len(convs)} conversations")
+
+    labels = {}
+    rows = []
+    for backend, backend_eps in [
+        (EmbeddingBackend.transformer, eps),
+        (EmbeddingBackend.hashing, hashing_eps),
+    ]:
+        model = _load_embedding_model(backend, model_id, device, dim)
+        start = time.time()
+        X = np.array(model.batch(texts_list), dtype=np.float32)
+        elapsed = time.time() - start
+
+        backend_labels = np.full(len(X), -1)
+        groups = _dbscan_predict(X, metric.value, backend_eps, min_samples)
+        for label, group in enumerate(groups):
+            backend_labels[group] = label
+        labels[backend] = backend_labels
+        rows.append(
+            {
+                "backend": backend.value,
+                "seconds": elapsed,
+                "conversations/s": len(X) / elapsed if elapsed else 0.0,
+                "groups": len(groups),
+                "clustered": float(np.mean(backend_labels != -1)) if len(X) else 0.0,
+            }
+        )
+
+    def agreement(a: np.ndarray, b: np.ndarray) -> str:
+        # noise samples are kept as their own singleton clusters
+        a = np.where(a == -1, -np.arange(1, len(a) + 1), a)
+        b = np.where(b == -1, -np.arange(1, len(b) + 1), b)
+        return f"ARI {adjusted_rand_score(a, b):.4f} / NMI {normalized_mutual_info_score(a, b):.4f}"
+
+    reference = labels[EmbeddingBackend.transformer]
+    for row, backend_labels in zip(rows, labels.values()):
+        row["vs transformer"] = agreement(reference, backend_labels)
+
+    if label_tag:
+        tag_values = [it.data.get("tags", {}).get(label_tag) for it in convs]
+        codes = {v: i for i, v in enumerate(sorted({str(v) for v in tag_values}))}
+        tag_labels = np.array(
+            [codes[str(v)] if v is not None else -1 for v in tag_values]
+        )
+        for row, backend_labels in zip(rows, labels.values()):
+            row[f"vs tag {label_tag}"] = agreement(tag_labels, backend_labels)
+
+    table = Table(title=f"Embedding benchmark on {len(convs)} conversations")
+    for column in rows[0].keys():
+        table.add_column(column)
+    for row in rows:
+        table.add_row(
+            *[f"{v:.4f}" if isinstance(v, float) else str(v) for v in row.values()]
+        )
+    print(table)
+
+
 @app.command(help="Remove embedding not exists in db")
 def prune_embedding(
     embedding: Path = typer.Option(..., exists=True, dir_okay=False),
@@ -110,12 +225,6 @@ def prune_embedding(
         df.to_parquet(embedding)
 
 
-class DBSCANMetric(str, Enum):
-    euclidean = "euclidean"
-    cosine = "cosine"
-    manhattan = "manhattan"
-
-
 @app.command(help="DBSCAN embedding cluster")
 def run(
     embedding: Path = typer.Option(
@@ -152,6 +261,10 @@ def run(
     bucket_size: int = typer.Option(
         20000, help="The maximum amount of data for a single cluster"
     ),
+    jobs: int = typer.Option(
+        1,
+        help="Number of worker processes used to cluster buckets concurrently. -1 means all cpus.",
+    ),
 ):
     import pandas as pd
     from llm_labeling_ui.cluster import run_dbscan_cluster
@@ -160,6 +273,8 @@ def run(
         save_path = embedding.with_suffix(".cluster.json")
 
     exist_groups = []
+    exist_noise = []
+    exist_medoids = None
     if save_path.exists():
         assert not (
             force and resume
@@ -171,7 +286,11 @@ def run(
             logger.warning(f"Resume clustering, save result to {save_path}")
 
             with open(save_path, "r", encoding="utf-8") as fr:
-                exist_groups = json.load(fr)["groups"]
+                exist_result = json.load(fr)
+            exist_groups = exist_result["groups"]
+            exist_noise = exist_result.get("noise", [])
+            if len(exist_result.get("medoids", [])) == len(exist_groups):
+                exist_medoids = exist_result["medoids"]
         else:
             logger.error(
                 f"Cluster result exists: {save_path}, use --force to overwrite or --resume to resume"
@@ -193,7 +312,7 @@ def run(
     logger.info(f"Embedding size: {len(df['embedding'].iloc[0])}")
     id_groups = run_dbscan_cluster(
         df,
-        metric,
+        metric.value,
         eps,
         eps_decay,
         min_samples,
@@ -201,36 +320,284 @@ def run(
         recluster_samples,
         epochs,
         bucket_size,
+        jobs,
     )
+    # medoids of the new groups are computed by cluster assign when it needs them
+    medoids = None
+    if exist_medoids is not None:
+        medoids = [None] * len(id_groups) + exist_medoids
     id_groups.extend(exist_groups)
+    # earlier noise ids are clustered again if they are still in the parquet file
+    noise_ids = sorted(
+        (set(df.id.tolist()) | set(exist_noise)) - set(flatten(id_groups))
+    )
+    _save_cluster_result(
+        save_path,
+        id_groups,
+        noise_ids,
+        medoids,
+        {
+            "metric": metric.value,
+            "eps": eps,
+            "eps_decay": eps_decay,
+            "min_samples": min_samples,
+            "max_samples": max_samples,
+            "recluster_samples": recluster_samples,
+            "epochs": epochs,
+            "bucket_size": bucket_size,
+            "jobs": jobs,
+        },
+    )
     logger.info(
         f"Total samples: {total_samples_count}, cluster group count: {len(id_groups)}, samples in clusters: {sum([len(it) for it in id_groups])}"
     )
+
+
+def _save_cluster_result(
+    save_path: Path,
+    id_groups: List[List[str]],
+    noise_ids: List[str],
+    medoids: Optional[List[str]],
+    meta: Dict,
+):
+    result = {"groups": id_groups, "noise": noise_ids}
+    if medoids is not None:
+        result["medoids"] = medoids
+    result["meta"] = {
+        **meta,
+        "total_groups": len(id_groups),
+        "total_samples_in_groups": sum([len(it) for it in id_groups]),
+    }
     with open(save_path, "w", encoding="utf-8") as fw:
-        json.dump(
-            {
-                "groups": id_groups,
-                "meta": {
-                    "eps": eps,
-                    "min_samples": min_samples,
-                    "max_samples": max_samples,
-                    "recluster_samples": recluster_samples,
-                    "epochs": epochs,
-                    "bucket_size": bucket_size,
-                    "total_groups": len(id_groups),
-                    "total_samples_in_groups": sum([len(it) for it in id_groups]),
-                },
-            },
-            fw,
-            ensure_ascii=False,
-            indent=2,
+        json.dump(result, fw, ensure_ascii=False, indent=2)
+
+
+@app.command(
+    help="Attach new embeddings to existing cluster groups, and only cluster the remainder"
+)
+def assign(
+    embedding: Path = typer.Option(
+        ...,
+        exists=True,
+        dir_okay=False,
+        help="Parquet file with column name: id, embedding.",
+    ),
+    cluster_path: Path = typer.Option(
+        None,
+        dir_okay=False,
+        help="Cluster result of cluster run. If None, load it from the same directory as parquet file",
+    ),
+    metric: DBSCANMetric = typer.Option(
+        None, help="DBSCAN metric. If None, use the value of the cluster result"
+    ),
+    eps: float = typer.Option(
+        None,
+        help="Max distance to a group medoid to attach to the group, also used to cluster the remainder. If None, use the value of the cluster result",
+    ),
+    min_samples: int = typer.Option(
+        None, help="DBSCAN min_samples. If None, use the value of the cluster result"
+    ),
+    max_samples: int = typer.Option(
+        None,
+        help="max samples to keep in a cluster. If None, use the value of the cluster result",
+    ),
+    jobs: int = typer.Option(
+        1,
+        help="Number of worker processes used to cluster buckets concurrently. -1 means all cpus.",
+    ),
+):
+    import numpy as np
+    import pandas as pd
+    from llm_labeling_ui.cluster import (
+        assign_to_groups,
+        group_medoids,
+        run_dbscan_cluster,
+    )
+
+    if cluster_path is None:
+        cluster_path = embedding.with_suffix(".cluster.json")
+    if not cluster_path.exists():
+        logger.error(f"cluster_path not exists: {cluster_path}, use cluster run first")
+        return
+
+    with open(cluster_path, "r", encoding="utf-8") as fr:
+        cluster_result = json.load(fr)
+    id_groups: List[List[str]] = cluster_result["groups"]
+    noise_ids: List[str] = cluster_result.get("noise", [])
+    medoids: List[str] = cluster_result.get("medoids", [])
+    meta: Dict = cluster_result.get("meta", {})
+    if "noise" not in cluster_result:
+        logger.warning(
+            "Cluster result has no noise ids, all embedding not in groups are treated as new"
         )
 
+    meta["metric"] = metric.value if metric else meta.get("metric", "euclidean")
+    meta["eps"] = eps if eps is not None else meta.get("eps", 0.5)
+    meta["min_samples"] = (
+        min_samples if min_samples is not None else meta.get("min_samples", 3)
+    )
+    meta["max_samples"] = (
+        max_samples if max_samples is not None else meta.get("max_samples", 10)
+    )
+    meta["jobs"] = jobs
+    logger.info(f"Cluster params: {meta}")
 
-@app.command(help="View cluster result")
-def view(
+    df = pd.read_parquet(embedding)
+    known_ids = set(flatten(id_groups)) | set(noise_ids)
+    new_df = df[~df.id.isin(known_ids)]
+    logger.info(f"Total samples: {len(df)}, new samples: {len(new_df)}")
+    if len(new_df) == 0:
+        return
+
+    if len(medoids) != len(id_groups):
+        medoids = [None] * len(id_groups)
+    embeddings = df.set_index("id")["embedding"]
+    # groups without a medoid yet (e.g. from cluster run --resume), or whose medoid was
+    # pruned from the parquet file
+    stale = [i for i, it in enumerate(medoids) if it not in embeddings.index]
+    if stale:
+        logger.info(f"Building medoid index of {len(stale)} groups")
+        stale_groups = [id_groups[i] for i in stale]
+        for i, medoid in zip(stale, group_medoids(df, stale_groups, meta["metric"])):
+            medoids[i] = medoid
+    indexed = [i for i, it in enumerate(medoids) if it is not None]
+    if len(indexed) != len(id_groups):
+        logger.warning(
+            f"{len(id_groups) - len(indexed)} groups have no embedding in {embedding}, "
+            "no new samples are attached to them"
+        )
+
+    medoid_X = (
+        np.stack(embeddings.loc[[medoids[i] for i in indexed]].to_numpy())
+        if indexed
+        else np.empty((0, len(new_df["embedding"].iloc[0])))
+    )
+    labels = assign_to_groups(
+        medoid_X,
+        [len(id_groups[i]) for i in indexed],
+        np.stack(new_df["embedding"].to_numpy()),
+        meta["metric"],
+        meta["eps"],
+        meta["max_samples"],
+    )
+    # medoid index -> group index
+    labels = np.array([indexed[it] if it != -1 else -1 for it in labels], dtype=int)
+    changed_groups = sorted(set(labels[labels != -1].tolist()))
+    for conv_id, label in zip(new_df["id"].tolist(), labels.tolist()):
+        if label != -1:
+            id_groups[label].append(conv_id)
+    for group_index, medoid in zip(
+        changed_groups,
+        group_medoids(df, [id_groups[i] for i in changed_groups], meta["metric"]),
+    ):
+        medoids[group_index] = medoid
+    logger.info(
+        f"Attach {int((labels != -1).sum())} new samples to {len(changed_groups)} exists groups"
+    )
+
+    remain_df = new_df[labels == -1]
+    if len(remain_df) > 0:
+        logger.info(f"Clustering remain {len(remain_df)} new samples")
+        new_groups = run_dbscan_cluster(
+            remain_df,
+            meta["metric"],
+            meta["eps"],
+            meta.get("eps_decay", 0.995),
+            meta["min_samples"],
+            meta["max_samples"],
+            meta.get("recluster_samples", 80),
+            meta.get("epochs", 5),
+            meta.get("bucket_size", 20000),
+            jobs,
+        )
+        id_groups.extend(new_groups)
+        medoids.extend(group_medoids(df, new_groups, meta["metric"]))
+        noise_ids.extend(sorted(set(remain_df.id.tolist()) - set(flatten(new_groups))))
+        logger.info(f"New cluster group count: {len(new_groups)}")
+
+    _save_cluster_result(cluster_path, id_groups, noise_ids, medoids, meta)
+    logger.info(
+        f"Total samples: {len(df)}, cluster group count: {len(id_groups)}, samples in clusters: {sum([len(it) for it in id_groups])}"
+    )
+
+
+@app.command(
+    help="Estimate DBSCAN results for a grid of eps/min_samples from one nearest neighbor search"
+)
+def sweep(
+    embedding: Path = typer.Option(
+        ...,
+        exists=True,
+        dir_okay=False,
+        help="Parquet file with column name: id, embedding.",
+    ),
+    save_path: Path = typer.Option(
+        None,
+        dir_okay=False,
+        help="If None, sweep result will be saved in the same directory as parquet file, with .sweep.csv suffix",
+    ),
+    metric: DBSCANMetric = typer.Option(
+        "euclidean", help="DBSCAN metric. euclidean or cosine"
+    ),
+    eps: List[float] = typer.Option(
+        [0.3, 0.4, 0.5, 0.6, 0.7], help="DBSCAN eps to evaluate, can be repeated"
+    ),
+    min_samples: List[int] = typer.Option(
+        [2, 3, 5], help="DBSCAN min_samples to evaluate, can be repeated"
+    ),
+    max_samples: int = typer.Option(
+        10,
+        help="max samples to keep in a cluster",
+    ),
+    neighbors: int = typer.Option(
+        32,
+        help="Number of nearest neighbors to compute. Results are exact when no sample has more neighbors within eps.",
+    ),
+    sample_size: int = typer.Option(
+        20000,
+        help="Number of random samples to sweep on, should match bucket_size of cluster run. -1 means all samples.",
+    ),
+    jobs: int = typer.Option(1, help="Number of jobs for nearest neighbor search"),
+):
+    import numpy as np
+    import pandas as pd
+    from rich.table import Table
+    from llm_labeling_ui.cluster import run_dbscan_sweep
+
+    if save_path is None:
+        save_path = embedding.with_suffix(".sweep.csv")
+
+    df = pd.read_parquet(embedding)
+    logger.info(f"Total samples: {len(df)}")
+    if sample_size != -1 and len(df) > sample_size:
+        df = df.sample(n=sample_size, random_state=0)
+        logger.info(f"Sweep on {sample_size} random samples")
+
+    X = np.stack(df["embedding"].to_numpy()).astype(np.float32)
+    result = run_dbscan_sweep(
+        X, metric.value, eps, min_samples, max_samples, neighbors, jobs
+    )
+
+    table = Table(title=f"DBSCAN sweep on {len(X)} samples")
+    for column in result.columns:
+        table.add_column(column)
+    for _, row in result.iterrows():
+        table.add_row(
+            *[f"{v:.4f}" if isinstance(v, float) else str(v) for v in row.tolist()]
+        )
+    print(table)
+
+    result.to_csv(save_path, index=False)
+    logger.info(f"Save sweep result to {save_path}")
+
+
+@app.command(help="Save cluster result file into db, so it can be queried by index")
+def import_result(
     db_path: Path = typer.Option(..., exists=True, dir_okay=False),
     cluster_path: Path = typer.Option(None, dir_okay=False),
+    name: str = typer.Option(
+        None, help="Name of the cluster run, default to file name"
+    ),
 ):
     if cluster_path is None:
         cluster_path = db_path.with_suffix(".cluster.json")
@@ -241,10 +608,80 @@ def view(
 
     with open(cluster_path, "r", encoding="utf-8") as fr:
         cluster_result = json.load(fr)
-    id_groups: List[List[str]] = cluster_result["groups"]
-    id_groups.sort(key=lambda it: len(it), reverse=True)
 
     db = DBManager(db_path)
+    cluster_run = db.create_cluster_run(
+        name or cluster_path.name,
+        cluster_result["groups"],
+        cluster_result.get("meta", {}),
+    )
+    logger.info(
+        f"Save {len(cluster_result['groups'])} groups as cluster run {cluster_run.id}"
+    )
+
+
+@app.command(help="List cluster runs saved in db")
+def list_runs(
+    db_path: Path = typer.Option(..., exists=True, dir_okay=False),
+):
+    db = DBManager(db_path)
+    for it in db.get_cluster_runs():
+        print(
+            f"{it.id}: {it.name}, created at {it.created_at}, groups: {it.meta.get('total_groups')}"
+        )
+
+
+class _DBClusterGroups(Sequence):
+    """Groups of a cluster run in db, largest first, members are loaded on access."""
+
+    def __init__(self, db: DBManager, run_id: int):
+        self.db = db
+        self.run_id = run_id
+        self.group_ids = [it[0] for it in db.get_cluster_groups_by_size(run_id)]
+
+    def __len__(self) -> int:
+        return len(self.group_ids)
+
+    def __getitem__(self, index: int) -> List[str]:
+        return self.db.get_cluster_group(self.run_id, self.group_ids[index])
+
+
+def _load_id_groups(
+    db: DBManager, db_path: Path, cluster_path: Optional[Path], run_id: Optional[int]
+) -> Optional[List[List[str]]]:
+    if run_id is not None:
+        return db.get_cluster_id_groups(run_id)
+
+    if cluster_path is None:
+        cluster_path = db_path.with_suffix(".cluster.json")
+        logger.info(f"cluster_path is None, try to load {cluster_path}")
+    if not cluster_path.exists():
+        logger.error(f"cluster_path not exists: {cluster_path}")
+        return None
+
+    with open(cluster_path, "r", encoding="utf-8") as fr:
+        cluster_result = json.load(fr)
+    return cluster_result["groups"]
+
+
+@app.command(help="View cluster result")
+def view(
+    db_path: Path = typer.Option(..., exists=True, dir_okay=False),
+    cluster_path: Path = typer.Option(None, dir_okay=False),
+    run_id: int = typer.Option(
+        None,
+        help="Cluster run saved in db by import-result, used instead of cluster_path",
+    ),
+):
+    db = DBManager(db_path)
+    if run_id is not None:
+        interactive_view_conversations(db, _DBClusterGroups(db, run_id), max_messages=1)
+        return
+
+    id_groups = _load_id_groups(db, db_path, cluster_path, None)
+    if id_groups is None:
+        return
+    id_groups.sort(key=lambda it: len(it), reverse=True)
     interactive_view_conversations(db, id_groups, max_messages=1)
 
 
@@ -268,47 +705,75 @@ def dedup(
     tokenizer: str = typer.Option(
         None, help="Tokenizer name. Used when strategy is max_messages_length"
     ),
+    run_id: int = typer.Option(
+        None,
+        help="Cluster run saved in db by import-result, used instead of cluster_path",
+    ),
     run: bool = typer.Option(False, help="Run delete"),
+    batch_size: int = typer.Option(
+        1000, help="Number of groups loaded from db at once when --run"
+    ),
+    jobs: int = typer.Option(
+        4, help="Number of tokenizer threads. Used when strategy is max_messages_length"
+    ),
 ):
+    token_counter = None
     if strategy == DedupStrategy.max_messages_length:
         assert (
             tokenizer is not None
         ), "tokenizer must be specified when strategy is max_messages_length"
         from transformers import AutoTokenizer
+        from llm_labeling_ui.utils import TokenCounter
 
         tokenizer = AutoTokenizer.from_pretrained(tokenizer, trust_remote_code=True)
+        token_counter = TokenCounter(tokenizer, max_size=10000000, workers=jobs)
 
-    if cluster_path is None:
-        cluster_path = db_path.with_suffix(".cluster.json")
-        logger.info(f"cluster_path is None, try to load {cluster_path}")
-    if not cluster_path.exists():
-        logger.error(f"cluster_path not exists: {cluster_path}")
+    db = DBManager(db_path)
+    id_groups = _load_id_groups(db, db_path, cluster_path, run_id)
+    if id_groups is None:
         return
-
-    with open(cluster_path, "r", encoding="utf-8") as fr:
-        cluster_result = json.load(fr)
-    id_groups: List[List[str]] = cluster_result["groups"]
     logger.info(f"Total groups: {len(id_groups)}")
 
-    db = DBManager(db_path)
     total_conversations = db.count_conversations()
     deleted_count = 0
     if not run:
         random.shuffle(id_groups)
+        # preview shows one group at a time, no need to load ahead
+        batch_size = 1
+
+    ids_to_delete = []
+    for group_batch in track(
+        list(chunked(id_groups, batch_size)),
+        description="dedup",
+        disable=not run,
+    ):
+        convs_by_id = {
+            str(it.id): it
+            for it in db.get_conversations_by_ids(list(flatten(group_batch)))
+        }
+        if strategy == DedupStrategy.max_messages_length:
+            token_counts = dict(
+                zip(
+                    convs_by_id.keys(),
+                    token_counter.count(
+                        [it.merged_text() for it in convs_by_id.values()]
+                    ),
+                )
+            )
+
+        for group in group_batch:
+            convs = [convs_by_id[it] for it in group if it in convs_by_id]
+            if strategy == DedupStrategy.max_messages_count:
+                convs.sort(key=lambda it: it.messages_count(), reverse=True)
+            elif strategy == DedupStrategy.max_messages_length:
+                convs.sort(key=lambda it: token_counts[str(it.id)], reverse=True)
+
+            convs_to_keep = convs[:cluster_keep]
+            convs_to_delete = convs[cluster_keep:]
+            if run:
+                ids_to_delete.extend([it.id for it in convs_to_delete])
+                continue
 
-    for group in track(id_groups, disable=not run):
-        convs = db.get_conversations_by_ids(group)
-        if strategy == DedupStrategy.max_messages_count:
-            convs.sort(key=lambda it: it.messages_count(), reverse=True)
-        elif strategy == DedupStrategy.max_messages_length:
-            convs.sort(key=lambda it: it.token_count(tokenizer), reverse=True)
-
-        convs_to_keep = convs[:cluster_keep]
-        convs_to_delete = convs[cluster_keep:]
-        if run:
-            db.delete_conversation([it.id for it in convs_to_delete])
-            deleted_count += len(convs_to_delete)
-        else:
             print(Markdown(f"# Conversations to keep: ({len(convs_to_keep)})"))
 
             for c in convs_to_keep:
@@ -325,6 +790,10 @@ def dedup(
             else:
                 exit(0)
 
+    if run:
+        db.delete_conversation(ids_to_delete)
+        deleted_count = len(ids_to_delete)
+
     db.vacuum()
     print(
         f"Total conversations: {total_conversations}, delete {deleted_count} conversations, remain {total_conversations - deleted_count} conversations"
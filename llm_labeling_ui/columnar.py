@@ -0,0 +1,126 @@
+"""
+Conversations as Arrow record batches, for analytics in pyarrow / pandas and for
+Parquet export and import.
+
+Columns:
+    id, created_at, updated_at
+    name, prompt, folder_id
+    roles, contents: list columns, one item per message
+    tags: json text of the tags object
+    message_count, char_count: number of messages, characters of prompt and messages
+    extra: json text of the other conversation fields (model, temperature...)
+
+Importing a batch rebuilds the conversation data from these columns, message fields
+other than role and content are not kept.
+"""
+import json
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID, uuid4
+
+import orjson
+import pyarrow as pa
+
+# conversation data fields with their own column
+_COLUMN_FIELDS = ["id", "name", "prompt", "folderId", "messages", "tags"]
+
+SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("created_at", pa.timestamp("us")),
+        ("updated_at", pa.timestamp("us")),
+        ("name", pa.string()),
+        ("prompt", pa.string()),
+        ("folder_id", pa.string()),
+        ("roles", pa.list_(pa.string())),
+        ("contents", pa.list_(pa.string())),
+        ("tags", pa.string()),
+        ("message_count", pa.int32()),
+        ("char_count", pa.int64()),
+        ("extra", pa.string()),
+    ]
+)
+
+
+def _dumps(obj) -> Optional[str]:
+    return None if obj is None else json.dumps(obj, ensure_ascii=False)
+
+
+def rows_to_record_batch(
+    rows: List[Tuple[UUID, datetime, Optional[datetime], Optional[str]]]
+) -> pa.RecordBatch:
+    """Record batch of (id, created_at, updated_at, data json text) rows"""
+    columns: Dict[str, list] = {it: [] for it in SCHEMA.names}
+    # list columns are built from flat values and offsets
+    offsets = [0]
+    roles = []
+    contents = []
+    for conv_id, created_at, updated_at, text in rows:
+        data = orjson.loads(text) if text else {}
+        messages = data.get("messages") or []
+        prompt = data.get("prompt")
+
+        columns["id"].append(str(conv_id))
+        columns["created_at"].append(created_at)
+        columns["updated_at"].append(updated_at)
+        columns["name"].append(data.get("name"))
+        columns["prompt"].append(prompt)
+        columns["folder_id"].append(data.get("folderId"))
+        columns["tags"].append(_dumps(data.get("tags")))
+        char_count = len(prompt or "")
+        for m in messages:
+            roles.append(m.get("role"))
+            contents.append(m.get("content"))
+            char_count += len(m.get("content") or "")
+        offsets.append(len(roles))
+        columns["message_count"].append(len(messages))
+        columns["char_count"].append(char_count)
+        extra = {k: v for k, v in data.items() if k not in _COLUMN_FIELDS}
+        columns["extra"].append(_dumps(extra) if extra else None)
+
+    arrays = []
+    offsets = pa.array(offsets, pa.int32())
+    lists = {"roles": roles, "contents": contents}
+    for field in SCHEMA:
+        if field.name in lists:
+            values = pa.array(lists[field.name], pa.string())
+            arrays.append(pa.ListArray.from_arrays(offsets, values))
+        else:
+            arrays.append(pa.array(columns[field.name], field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=SCHEMA)
+
+
+def record_batch_to_rows(
+    batch: pa.RecordBatch,
+) -> List[Tuple[UUID, datetime, Optional[datetime], Dict]]:
+    """
+    (id, created_at, updated_at, data) of the conversations of a record batch. Columns
+    may be missing, e.g. a file written by pandas with only id, roles and contents,
+    conversations without id get a new one.
+    """
+    columns = batch.to_pydict()
+    for name in SCHEMA.names:
+        columns.setdefault(name, [None] * batch.num_rows)
+
+    rows = []
+    for i, conv_id in enumerate(columns["id"]):
+        conv_id = UUID(conv_id) if conv_id else uuid4()
+        extra = columns["extra"][i]
+        data = json.loads(extra) if extra else {}
+        data["id"] = str(conv_id)
+        for field in ["name", "prompt"]:
+            if columns[field][i] is not None:
+                data[field] = columns[field][i]
+        # chatbot-ui writes folderId as null outside of folders
+        data["folderId"] = columns["folder_id"][i]
+        data["messages"] = [
+            {"role": role, "content": content}
+            for role, content in zip(
+                columns["roles"][i] or [], columns["contents"][i] or []
+            )
+        ]
+        if columns["tags"][i] is not None:
+            data["tags"] = json.loads(columns["tags"][i])
+        created_at = columns["created_at"][i] or datetime.utcnow()
+        rows.append((conv_id, created_at, columns["updated_at"][i], data))
+    return rows
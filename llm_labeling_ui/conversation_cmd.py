@@ -9,7 +9,14 @@ from loguru import logger
 from rich.progress import track
 
 from llm_labeling_ui.db_schema import DBManager, Conversation
-from llm_labeling_ui.utils import interactive_view_conversations, parse_tag
+from llm_labeling_ui.filters import FILTER_HELP, quote
+from llm_labeling_ui.utils import (
+    ConversationCursor,
+    check_filter,
+    interactive_view_conversations,
+    merge_filters,
+    parse_tag,
+)
 
 app = typer.Typer(
     add_completion=False,
@@ -74,13 +81,95 @@ def remove_duplicate(
         db.vacuum()
 
 
+@app.command(
+    help="Find near duplicate conversations with MinHash LSH, save groups as cluster result"
+)
+def near_dedup(
+    db_path: Path = typer.Option(..., exists=True, dir_okay=False),
+    save_path: Path = typer.Option(
+        None,
+        dir_okay=False,
+        help="If None, save to the same directory as db_path with .cluster.json suffix, so cluster view/dedup can use it directly",
+    ),
+    role: str = typer.Option(
+        "all", help="role of messages to compare. user, assistant, system, all"
+    ),
+    max_messages: int = typer.Option(
+        -1, help="Number of messages to compare. -1 means all messages."
+    ),
+    ngram: int = typer.Option(5, help="Character n-gram size of shingles"),
+    num_perm: int = typer.Option(128, help="Number of MinHash permutations"),
+    bands: int = typer.Option(
+        32, help="Number of LSH bands, num_perm must be divisible by bands"
+    ),
+    threshold: float = typer.Option(
+        0.7, help="Min estimated jaccard similarity of near duplicates"
+    ),
+    force: bool = typer.Option(False, help="force overwrite save_path if exists"),
+):
+    import json
+    import math
+    from llm_labeling_ui.minhash import MinHash, MinHashLSH
+
+    assert role in ["user", "assistant", "system", "all"]
+    if save_path is None:
+        save_path = db_path.with_suffix(".cluster.json")
+    if save_path.exists() and not force:
+        raise FileExistsError(f"{save_path} exists, use --force to overwrite")
+
+    db = DBManager(db_path)
+    total = db.count_conversations()
+    logger.info(f"Total conversations: {total}")
+
+    minhash = MinHash(num_perm=num_perm, ngram=ngram)
+    lsh = MinHashLSH(num_perm=num_perm, bands=bands, threshold=threshold)
+    page_size = 1000
+    for convs in track(
+        db.iter_conversations(page_size),
+        total=math.ceil(total / page_size),
+        description="hashing",
+    ):
+        for conv in convs:
+            text = conv.merged_text(max_messages=max_messages, role=role)
+            lsh.add(str(conv.id), minhash(text))
+
+    id_groups = lsh.groups()
+    logger.info(
+        f"Found {len(id_groups)} near duplicate groups, samples in groups: {sum([len(it) for it in id_groups])}"
+    )
+    with open(save_path, "w", encoding="utf-8") as fw:
+        json.dump(
+            {
+                "groups": id_groups,
+                "meta": {
+                    "method": "minhash_lsh",
+                    "role": role,
+                    "max_messages": max_messages,
+                    "ngram": ngram,
+                    "num_perm": num_perm,
+                    "bands": bands,
+                    "threshold": threshold,
+                    "total_groups": len(id_groups),
+                    "total_samples_in_groups": sum([len(it) for it in id_groups]),
+                },
+            },
+            fw,
+            ensure_ascii=False,
+            indent=2,
+        )
+    logger.info(f"Save near duplicate groups to {save_path}")
+
+
 @app.command(help="View conversation contain certain strings")
 def view(
     db_path: Path = typer.Option(..., exists=True, dir_okay=False),
     search: List[str] = typer.Option([""], help="string to search"),
+    filter_expr: str = typer.Option(
+        "", "--filter", help=FILTER_HELP, callback=check_filter
+    ),
 ):
     db = DBManager(db_path)
-    conversations = db.all_conversations(search_term=search)
+    conversations = ConversationCursor(db, search_term=search, filter_expr=filter_expr)
     logger.info(f"Total conversations: {len(conversations)}")
     interactive_view_conversations(db, conversations, max_messages=5)
 
@@ -96,29 +185,32 @@ def delete(
     role: str = typer.Option(
         "all", help="role to search. user, assistant, system, all"
     ),
+    filter_expr: str = typer.Option(
+        "", "--filter", help=FILTER_HELP, callback=check_filter
+    ),
 ):
-    tags = parse_tag(tag)
-    db = DBManager(db_path)
-    conversations = db.all_conversations()
-    logger.info(f"Total conversations: {len(conversations)}")
     assert role in ["user", "assistant", "system", "all"]
+    # --search and --role are shorthands of a filter term, tag keys may contain
+    # characters the filter syntax does not allow and are passed as is
+    search_filter = ""
+    if search:
+        search_filter = f"{'text' if role == 'all' else role}:{quote(search)}"
+    filters = {
+        "tags": parse_tag(tag),
+        "filter_expr": merge_filters(filter_expr, search_filter),
+    }
 
-    conversation_to_remove = []
-    for it in track(conversations, description="finding duplicate"):
-        if not it.contain_tags(tags):
-            continue
-        merged_text = it.merged_text(role=role)
-        if search in merged_text:
-            conversation_to_remove.append(it)
-
-    logger.info(f"Found {len(conversation_to_remove)} conversations to remove")
+    db = DBManager(db_path)
+    logger.info(f"Total conversations: {db.count_conversations()}")
+    count = db.count_conversations(**filters)
+    logger.info(f"Found {count} conversations to remove")
 
     if run:
-        for it in track(conversation_to_remove, description="removing conversations"):
-            db.delete_conversation(it.id)
+        db.bulk_delete_conversations(**filters)
         db.vacuum()
     else:
-        if len(conversation_to_remove) > 0:
+        if count > 0:
+            conversation_to_remove = ConversationCursor(db, **filters)
             interactive_view_conversations(db, conversation_to_remove, max_messages=5)
 
 
@@ -129,7 +221,11 @@ def delete_string(
     run: bool = typer.Option(False, help="run the command"),
 ):
     db = DBManager(db_path)
-    conversations = db.all_conversations(search_term=string)
+    if run:
+        conversations = db.all_conversations(search_term=string)
+    else:
+        # the preview only reads the conversations it shows
+        conversations = ConversationCursor(db, search_term=string)
     logger.info(
         f"Total conversations {db.count_conversations()}, contains [{string}]: {len(conversations)}"
     )
@@ -220,3 +316,77 @@ def replace_string(
         db.vacuum()
     else:
         interactive_view_conversations(db, matched_conversations)
+
+
+@app.command(
+    help="Apply the replace / delete rules of a json rule file to all conversations "
+    "in one pass, see llm_labeling_ui/rules.py for the file format"
+)
+def apply_rules(
+    db_path: Path = typer.Option(..., exists=True, dir_okay=False),
+    rules_path: Path = typer.Option(..., exists=True, dir_okay=False),
+    batch_size: int = typer.Option(
+        500, help="Conversations read and written per transaction"
+    ),
+    preview: int = typer.Option(5, help="Number of changed conversations to print"),
+    run: bool = typer.Option(False, help="run the command"),
+):
+    import math
+
+    from rich import print
+    from rich.markup import escape
+    from rich.table import Table
+
+    from llm_labeling_ui.rules import RuleSet, diff_snippet, load_rules
+
+    try:
+        rule_set = RuleSet(load_rules(rules_path))
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="--rules-path")
+    logger.info(f"Loaded {len(rule_set.rules)} rules from {rules_path}")
+
+    db = DBManager(db_path)
+    total = db.count_conversations()
+    changed = 0
+    for convs in track(
+        db.iter_conversation_pages(batch_size),
+        total=math.ceil(total / batch_size),
+        description="applying rules" if run else "applying rules (dry run)",
+    ):
+        datas = {}
+        for conv in convs:
+            changes = rule_set.apply_conversation(conv.data)
+            if not changes:
+                continue
+            changed += 1
+            datas[str(conv.id)] = conv.data
+            if changed <= preview:
+                print(f"Conversation {conv.id}".center(100, "-"))
+                for field, old, new in changes:
+                    old, new = diff_snippet(old, new)
+                    print(f"[bold]{field}[/bold]")
+                    print(f"[red]- {escape(old)}[/red]")
+                    print(f"[green]+ {escape(new)}[/green]")
+        # written page by page, the server can take the db lock between pages
+        if run and datas:
+            db.update_conversations_data(datas)
+
+    table = Table(title=f"Rule hits on {total} conversations")
+    table.add_column("rule")
+    table.add_column("role")
+    table.add_column("matches", justify="right")
+    table.add_column("conversations", justify="right")
+    for i, rule in enumerate(rule_set.rules):
+        table.add_row(
+            escape(rule.label()),
+            rule.role,
+            str(rule_set.hits[i]),
+            str(rule_set.conversation_hits[i]),
+        )
+    print(table)
+
+    if run:
+        logger.info(f"Updated {changed} conversations")
+        db.vacuum()
+    else:
+        logger.info(f"{changed} conversations would be changed, add --run to apply")
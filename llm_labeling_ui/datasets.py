@@ -0,0 +1,262 @@
+"""
+Serve a directory of datasets from one server.
+
+Every `<name>.sqlite` file in the directory is a dataset, selected by the
+`/datasets/<name>/...` path prefix (see DatasetMiddleware). Databases are opened on
+first use and kept in a bounded LRU, idle ones are closed. A dataset is never closed
+while a request uses it. New `<name>.json` files are converted to sqlite once by the job
+worker, see convert_json_datasets.
+"""
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from loguru import logger
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from llm_labeling_ui.db_schema import DBManager
+from llm_labeling_ui.write_buffer import WriteBehindBuffer
+
+DATASET_PREFIX = "/datasets/"
+DATASET_NAME_RE = re.compile(r"^[\w.-]+$")
+
+# dataset of the current request, set by DatasetMiddleware
+CURRENT_DATASET: ContextVar[Optional["Dataset"]] = ContextVar(
+    "current_dataset", default=None
+)
+
+
+# the bundled web page calls /api/..., prefixed with the dataset of the page, so every
+# tab keeps writing to the dataset it was opened on
+_API_BASE_SCRIPT = (
+    "<script>(function(){var base=%s,fetch=window.fetch;"
+    "window.fetch=function(url,init){"
+    'if(typeof url==="string"&&url.indexOf("/api/")===0)url=base+url;'
+    "return fetch.call(this,url,init)}})()</script>"
+)
+
+
+def dataset_page(html: str, name: str) -> str:
+    """index.html of the web page, calling the api of dataset name"""
+    script = _API_BASE_SCRIPT % json.dumps(DATASET_PREFIX + name)
+    head = html.find("<head>")
+    if head == -1:
+        return script + html
+    return html[: head + len("<head>")] + script + html[head + len("<head>") :]
+
+
+def dataset_paths(data_dir: Path) -> Dict[str, Path]:
+    return {it.stem: it for it in sorted(data_dir.glob("*.sqlite"))}
+
+
+def convert_json_datasets(data_dir: Path):
+    """
+    Create `<name>.sqlite` for every `<name>.json` which does not have one yet. The db is
+    written to a temporary file and renamed when complete, so a half written dataset is
+    never opened.
+    """
+    for json_p in sorted(data_dir.glob("*.json")):
+        db_path = json_p.with_suffix(".sqlite")
+        if db_path.exists():
+            continue
+        tmp_path = json_p.with_suffix(".sqlite.tmp")
+        tmp_path.unlink(missing_ok=True)
+        logger.info(f"create db at {db_path}")
+        try:
+            db = DBManager(tmp_path).create_from_json_file(json_p)
+            db.close()
+        except Exception as e:
+            logger.error(f"Failed to convert {json_p}: {e}")
+            tmp_path.unlink(missing_ok=True)
+            continue
+        tmp_path.rename(db_path)
+        db = DBManager(db_path)
+        db.enable_wal()
+        db.close()
+
+
+class Dataset:
+    def __init__(self, name: str, db: DBManager, write_delay: float):
+        self.name = name
+        self.db = db
+        self.write_buffer = None
+        if write_delay > 0:
+            self.write_buffer = WriteBehindBuffer(db, delay=write_delay)
+        self.last_used = time.monotonic()
+        # requests and background work using the dataset, see DatasetPool.use
+        self.refs = 0
+
+    def close(self):
+        if self.write_buffer is not None:
+            self.write_buffer.close()
+        self.db.close()
+
+
+class DatasetPool:
+    """
+    LRU of open datasets. At most max_open datasets are kept open, datasets not used for
+    idle_seconds are closed by a background thread. Datasets in use are not closed, if
+    all of them are in use the pool grows beyond max_open until they are released.
+    """
+
+    def __init__(
+        self,
+        data_dir: Path,
+        max_open: int = 8,
+        idle_seconds: float = 600,
+        write_delay: float = 0,
+        slow_query_seconds: float = 0.5,
+    ):
+        self.data_dir = data_dir
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        self.write_delay = write_delay
+        self.slow_query_seconds = slow_query_seconds
+        self.datasets: "OrderedDict[str, Dataset]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.reaper = threading.Thread(
+            target=self._close_idle_loop, name="dataset-reaper", daemon=True
+        )
+        self.reaper.start()
+
+    def names(self) -> List[str]:
+        return list(dataset_paths(self.data_dir).keys())
+
+    def pending_names(self) -> List[str]:
+        """json datasets not converted to sqlite yet"""
+        return [
+            it.stem
+            for it in sorted(self.data_dir.glob("*.json"))
+            if not it.with_suffix(".sqlite").exists()
+        ]
+
+    def acquire(self, name: str) -> Optional[Dataset]:
+        """
+        Open dataset name, or get it from the pool, and hold it until release. Returns
+        None if there is no such dataset.
+        """
+        with self.lock:
+            dataset = self.datasets.get(name)
+            if dataset is not None:
+                self.datasets.move_to_end(name)
+                dataset.refs += 1
+                return dataset
+
+            if not DATASET_NAME_RE.match(name):
+                return None
+            db_path = self.data_dir / f"{name}.sqlite"
+            if not db_path.exists():
+                return None
+            logger.info(f"open dataset {name}")
+            dataset = Dataset(
+                name,
+                DBManager(db_path, slow_query_seconds=self.slow_query_seconds),
+                self.write_delay,
+            )
+            dataset.refs = 1
+            self.datasets[name] = dataset
+            # least recently used first
+            unused = [it for it in self.datasets.values() if it.refs == 0]
+            evicted = unused[: max(len(self.datasets) - self.max_open, 0)]
+            for it in evicted:
+                del self.datasets[it.name]
+        for it in evicted:
+            logger.info(f"close dataset {it.name}")
+            it.close()
+        return dataset
+
+    def retain(self, dataset: Dataset):
+        """Hold an acquired dataset once more, e.g. for work outliving the request"""
+        with self.lock:
+            dataset.refs += 1
+
+    def release(self, dataset: Dataset):
+        with self.lock:
+            dataset.refs -= 1
+            dataset.last_used = time.monotonic()
+            # the pool was closed meanwhile
+            close = dataset.refs == 0 and self.datasets.get(dataset.name) is not dataset
+        if close:
+            dataset.close()
+
+    @contextmanager
+    def use(self, name: str) -> Iterator[Optional[Dataset]]:
+        """acquire and release dataset name"""
+        dataset = self.acquire(name)
+        try:
+            yield dataset
+        finally:
+            if dataset is not None:
+                self.release(dataset)
+
+    def close_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = [
+                name
+                for name, it in self.datasets.items()
+                if it.refs == 0 and now - it.last_used > self.idle_seconds
+            ]
+            evicted = [self.datasets.pop(name) for name in idle]
+        for it in evicted:
+            logger.info(f"close idle dataset {it.name}")
+            it.close()
+
+    def _close_idle_loop(self):
+        while not self.closed.wait(min(60, self.idle_seconds)):
+            self.close_idle()
+
+    def close(self):
+        """Close unused datasets now, the others when they are released"""
+        self.closed.set()
+        with self.lock:
+            evicted = [it for it in self.datasets.values() if it.refs == 0]
+            self.datasets.clear()
+        for it in evicted:
+            it.close()
+
+
+class DatasetMiddleware:
+    """
+    Strip the `/datasets/<name>` prefix from the path and make <name> the dataset of the
+    request, held open until the response is sent. Requests without the prefix have no
+    dataset, the api refuses them with 400 when serving a directory of datasets.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or not path.startswith(DATASET_PREFIX):
+            await self.app(scope, receive, send)
+            return
+
+        name, _, rest = path[len(DATASET_PREFIX) :].partition("/")
+        scope = dict(scope, path="/" + rest)
+        # set by Api when --data is a directory
+        pool: Optional[DatasetPool] = getattr(scope["app"].state, "datasets", None)
+        if pool is None:
+            await self.app(scope, receive, send)
+            return
+
+        with pool.use(name) as dataset:
+            if dataset is None:
+                response = JSONResponse(
+                    {"detail": f"Dataset {name} not found"}, status_code=404
+                )
+                await response(scope, receive, send)
+                return
+            token = CURRENT_DATASET.set(dataset)
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                CURRENT_DATASET.reset(token)
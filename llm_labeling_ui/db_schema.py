@@ -4,15 +4,33 @@ from datetime import datetime
 import math
 from pathlib import Path
 import random
-from typing import Iterator, Optional, Dict, List, Union
+import re
+import time
+from typing import Any, Iterator, Optional, Dict, List, Tuple, Union
 from uuid import UUID, uuid4
 
 import sqlmodel
 from loguru import logger
+from more_itertools import chunked
 from rich.progress import track
-from sqlalchemy import Column, select, func, text
+from sqlalchemy import (
+    Column,
+    Index,
+    Text,
+    bindparam,
+    delete,
+    event,
+    insert,
+    select,
+    func,
+    text,
+    type_coerce,
+    update,
+)
 from sqlmodel import SQLModel, Field, create_engine, Session, JSON, col
 
+from llm_labeling_ui.filters import filter_clause, sqlite_regexp, tag_clause
+from llm_labeling_ui.metrics import DB_QUERY_SECONDS, DB_SLOW_QUERIES
 from llm_labeling_ui.utils import (
     MESSAGE_FILTER_EQUAL,
     MESSAGE_FILTER_GREATER,
@@ -20,6 +38,58 @@ from llm_labeling_ui.utils import (
     MESSAGE_FILTER_NONE,
 )
 
+SQLITE_MAX_VARIABLES = 500
+
+# top level conversation fields that can be changed by patch_conversation
+PATCH_FIELDS = ["name", "prompt", "temperature", "folderId"]
+# ops patch_conversation compiles into json_set/json_remove, others need read-modify-write
+SQL_PATCH_OPS = ["set_content", "set_tag", "set_field"]
+
+
+def conversation_version(updated_at: Optional[datetime]) -> str:
+    return updated_at.isoformat() if updated_at else "0"
+
+
+def apply_patch_ops(data: Dict, ops: List[Dict]) -> Dict:
+    """
+    Apply patch ops to conversation data in place.
+
+    Ops:
+        {"op": "set_content", "index": 0, "content": "..."}
+        {"op": "insert_message", "index": 0, "message": {"role": "user", "content": "..."}}
+        {"op": "delete_message", "index": 0}
+        {"op": "set_tag", "key": "lang", "value": "en"}, value None removes the tag
+        {"op": "set_field", "field": "name", "value": "..."}, field in PATCH_FIELDS
+    """
+    messages = data.setdefault("messages", [])
+    for op in ops:
+        name = op["op"]
+        if name == "set_content":
+            if not 0 <= op["index"] < len(messages):
+                raise ValueError(f"message index out of range: {op['index']}")
+            messages[op["index"]]["content"] = op["content"]
+        elif name == "insert_message":
+            if not 0 <= op["index"] <= len(messages):
+                raise ValueError(f"message index out of range: {op['index']}")
+            messages.insert(op["index"], op["message"])
+        elif name == "delete_message":
+            if not 0 <= op["index"] < len(messages):
+                raise ValueError(f"message index out of range: {op['index']}")
+            messages.pop(op["index"])
+        elif name == "set_tag":
+            tags = data.setdefault("tags", {})
+            if op.get("value") is None:
+                tags.pop(op["key"], None)
+            else:
+                tags[op["key"]] = op["value"]
+        elif name == "set_field":
+            if op["field"] not in PATCH_FIELDS:
+                raise ValueError(f"field can not be patched: {op['field']}")
+            data[op["field"]] = op.get("value")
+        else:
+            raise ValueError(f"unknown patch op: {name}")
+    return data
+
 
 class TimestampModel(SQLModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -94,14 +164,157 @@ class PromptTemp(UUIDIDModel, TimestampModel, table=True):
     folderId: Optional[UUID] = None
 
 
+class ClusterRun(TimestampModel, table=True):
+    __tablename__ = "cluster_run"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str
+    meta: Dict = Field(default={}, sa_column=Column(JSON))
+
+
+class ClusterMember(SQLModel, table=True):
+    __tablename__ = "cluster_member"
+    __table_args__ = (
+        Index("ix_cluster_member_conversation", "run_id", "conversation_id"),
+    )
+
+    run_id: int = Field(foreign_key="cluster_run.id", primary_key=True)
+    group_id: int = Field(primary_key=True)
+    conversation_id: UUID = Field(primary_key=True)
+
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_CANCELLING = "cancelling"
+JOB_CANCELLED = "cancelled"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_FINISHED_STATUSES = [JOB_CANCELLED, JOB_DONE, JOB_FAILED]
+
+
+class Job(TimestampModel, table=True):
+    """Background job run by the server's job worker, see llm_labeling_ui/jobs.py"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str
+    params: Dict = Field(default={}, sa_column=Column(JSON))
+    status: str = Field(default=JOB_QUEUED, index=True)
+    done: int = 0
+    total: int = 0
+    message: str = ""
+    result: Dict = Field(default={}, sa_column=Column(JSON))
+
+
+class WriteGeneration(SQLModel, table=True):
+    """
+    Write counter per table, bumped once per insert, update or delete statement that
+    changed rows, in the same transaction, by every DBManager (also those of other
+    processes and the cli). Used to build ETags and to invalidate caches.
+    """
+
+    __tablename__ = "write_generation"
+
+    name: str = Field(primary_key=True)
+    value: int = 0
+
+
+GENERATION_TABLES = ["conversation", "folder", "prompttemp", "cluster_member"]
+# target table of a write statement
+_WRITE_TABLE_RE = re.compile(
+    r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?"
+    r"|DELETE\s+FROM)\s+[\"`\[]?(\w+)",
+    re.IGNORECASE,
+)
+
+
 class DBManager:
-    def __init__(self, db_path: Path):
+    def __init__(self, db_path: Path, slow_query_seconds: float = 0.5):
         self.engine = create_engine(
             f"sqlite:///{db_path}",
             json_serializer=lambda obj: json.dumps(obj, ensure_ascii=False),
+            # wait for locks held by other processes instead of failing immediately
+            connect_args={"timeout": 30},
         )
+        self.slow_query_seconds = slow_query_seconds
+        event.listen(self.engine, "before_cursor_execute", self._before_execute)
+        event.listen(self.engine, "after_cursor_execute", self._after_execute)
+        event.listen(self.engine, "after_cursor_execute", self._bump_generation)
+        event.listen(self.engine, "connect", self._register_functions)
+        # only creates missing tables, an initialized db is not written to, so read only
+        # files work
         SQLModel.metadata.create_all(self.engine)
 
+    @staticmethod
+    def _register_functions(dbapi_connection, connection_record):
+        # `x REGEXP pattern` of filter expressions
+        dbapi_connection.create_function("regexp", 2, sqlite_regexp)
+
+    @staticmethod
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        # on the execution context, so nothing is left behind when a statement fails
+        context.query_start = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context.query_start
+        DB_QUERY_SECONDS.observe(statement.split(None, 1)[0].upper(), value=elapsed)
+        if elapsed < self.slow_query_seconds:
+            return
+
+        DB_SLOW_QUERIES.inc()
+        plan = ""
+        if not executemany and statement.lstrip().upper().startswith("SELECT"):
+            # raw dbapi cursor, so the EXPLAIN itself is not timed
+            explain_cursor = conn.connection.cursor()
+            try:
+                explain_cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+                plan = "\n".join(row[-1] for row in explain_cursor.fetchall())
+            except Exception as e:
+                plan = f"failed to explain: {e}"
+            finally:
+                explain_cursor.close()
+        logger.warning(
+            f"slow query {elapsed * 1000:.1f}ms: {statement}\nquery plan:\n{plan}"
+        )
+
+    @staticmethod
+    def _bump_generation(conn, cursor, statement, parameters, context, executemany):
+        m = _WRITE_TABLE_RE.match(statement)
+        if m is None or m.group(1).lower() not in GENERATION_TABLES:
+            return
+        if cursor.rowcount == 0:
+            return
+        # raw dbapi cursor in the transaction of the write, so both commit together
+        bump_cursor = conn.connection.cursor()
+        try:
+            bump_cursor.execute(
+                "INSERT INTO write_generation (name, value) VALUES (?, 1) "
+                "ON CONFLICT (name) DO UPDATE SET value = value + 1",
+                (m.group(1).lower(),),
+            )
+        finally:
+            bump_cursor.close()
+
+    def get_write_generations(self) -> Dict[str, int]:
+        with Session(self.engine) as session:
+            rows = session.execute(select(WriteGeneration.name, WriteGeneration.value))
+            # tables are added on their first write
+            return {**{it: 0 for it in GENERATION_TABLES}, **dict(rows.all())}
+
+    def enable_wal(self):
+        """
+        Switch the db file to write-ahead logging, so readers in other processes are not
+        blocked by a writer. The setting is persistent.
+        """
+        with self.engine.connect() as conn:
+            conn.execute(text("PRAGMA journal_mode=WAL"))
+
+    def ping(self):
+        with self.engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+    def close(self):
+        self.engine.dispose()
+
     def create_from_json_file(self, json_p: Path) -> "DBManager":
         from llm_labeling_ui.schema import ChatBotUIHistory
 
@@ -131,6 +344,7 @@ class DBManager:
         min_messages: int,
         max_messages: int,
         tags: Dict = {},
+        filter_expr: str = "",
     ):
         from llm_labeling_ui.schema import (
             ChatBotUIHistory,
@@ -141,21 +355,17 @@ class DBManager:
         chatbot_ui_history.folders = self.get_folders()
         chatbot_ui_history.prompts = self.get_prompt_temps()
         with Session(self.engine) as session:
-            statement = sqlmodel.select(Conversation)
+            messages_count = func.json_array_length(Conversation.data, "$.messages")
+            statement = sqlmodel.select(Conversation).where(
+                messages_count >= min_messages, messages_count < max_messages
+            )
+            statement = self._filter(statement, tags=tags, filter_expr=filter_expr)
             results = session.exec(statement).all()
 
-            if tags:
-                _new_results = []
-                for it in results:
-                    if it.contain_tags(tags):
-                        _new_results.append(it)
-                results = _new_results
-
             logger.info(f"Shuffling {len(results)} conversations")
             random.shuffle(results)
             for it in track(results):
-                if min_messages <= it.messages_count() < max_messages:
-                    chatbot_ui_history.history.append(UIConversation(**it.data))
+                chatbot_ui_history.history.append(UIConversation(**it.data))
 
             if count == -1:
                 count = len(results)
@@ -184,6 +394,9 @@ class DBManager:
         search_term: Union[str, List[str]] = "",
         messageCountFilterCount: int = 0,
         messageCountFilterMode: str = MESSAGE_FILTER_NONE,
+        cluster_run_id: Optional[int] = None,
+        cluster_group_id: Optional[int] = None,
+        filter_expr: str = "",
     ) -> List[Conversation]:
         limit = page_size
         offset = page * page_size
@@ -195,24 +408,173 @@ class DBManager:
                 .limit(limit)
             )
             statement = self._filter(
-                statement, search_term, messageCountFilterCount, messageCountFilterMode
+                statement,
+                search_term,
+                messageCountFilterCount,
+                messageCountFilterMode,
+                cluster_run_id,
+                cluster_group_id,
+                filter_expr=filter_expr,
             )
             convs = session.exec(statement).all()
             return convs
 
+    def get_conversations_json(
+        self,
+        page: int,
+        page_size: int = 50,
+        search_term: Union[str, List[str]] = "",
+        messageCountFilterCount: int = 0,
+        messageCountFilterMode: str = MESSAGE_FILTER_NONE,
+        cluster_run_id: Optional[int] = None,
+        cluster_group_id: Optional[int] = None,
+        filter_expr: str = "",
+    ) -> bytes:
+        """
+        Same result as get_conversations, encoded as a json array. The stored data column is
+        spliced into the output as is, without decoding it or building Conversation objects.
+        """
+        with Session(self.engine) as session:
+            # page over ids first, so the sort does not carry the data column of every row
+            page_ids = (
+                select(Conversation.id)
+                .order_by(Conversation.created_at.desc())
+                .offset(page * page_size)
+                .limit(page_size)
+            )
+            page_ids = self._filter(
+                page_ids,
+                search_term,
+                messageCountFilterCount,
+                messageCountFilterMode,
+                cluster_run_id,
+                cluster_group_id,
+                filter_expr=filter_expr,
+            )
+            statement = (
+                select(
+                    Conversation.id,
+                    Conversation.created_at,
+                    Conversation.updated_at,
+                    type_coerce(Conversation.data, Text),
+                )
+                .where(Conversation.id.in_(page_ids))
+                .order_by(Conversation.created_at.desc())
+            )
+            items = []
+            for conv_id, created_at, updated_at, data in session.execute(statement):
+                head = json.dumps(
+                    {
+                        "id": str(conv_id),
+                        "created_at": created_at.isoformat(),
+                        "updated_at": updated_at.isoformat() if updated_at else None,
+                    }
+                )
+                items.append(f'{head[:-1]}, "data": {data or "{}"}}}')
+            return ("[" + ",".join(items) + "]").encode("utf-8")
+
+    def get_conversation_summaries(
+        self,
+        page: int,
+        page_size: int = 50,
+        search_term: Union[str, List[str]] = "",
+        messageCountFilterCount: int = 0,
+        messageCountFilterMode: str = MESSAGE_FILTER_NONE,
+        cluster_run_id: Optional[int] = None,
+        cluster_group_id: Optional[int] = None,
+        filter_expr: str = "",
+    ) -> List[Dict]:
+        """
+        Same filter and order as get_conversations, but only the fields a conversation list
+        needs are extracted in sql, messages are never loaded.
+        """
+        with Session(self.engine) as session:
+            statement = (
+                select(
+                    Conversation.id,
+                    Conversation.created_at,
+                    Conversation.updated_at,
+                    func.json_extract(Conversation.data, "$.name"),
+                    func.json_array_length(Conversation.data, "$.messages"),
+                    func.json_extract(Conversation.data, "$.tags"),
+                    func.json_extract(Conversation.data, "$.folderId"),
+                )
+                .order_by(Conversation.created_at.desc())
+                .offset(page * page_size)
+                .limit(page_size)
+            )
+            statement = self._filter(
+                statement,
+                search_term,
+                messageCountFilterCount,
+                messageCountFilterMode,
+                cluster_run_id,
+                cluster_group_id,
+                filter_expr=filter_expr,
+            )
+            summaries = []
+            for row in session.execute(statement):
+                (
+                    conv_id,
+                    created_at,
+                    updated_at,
+                    name,
+                    messages_count,
+                    tags,
+                    folder_id,
+                ) = row
+                summaries.append(
+                    {
+                        "id": str(conv_id),
+                        "created_at": created_at,
+                        "updated_at": updated_at,
+                        "name": name or "",
+                        "messageCount": messages_count or 0,
+                        "tags": json.loads(tags) if tags else {},
+                        "folderId": folder_id,
+                    }
+                )
+            return summaries
+
+    def get_conversation(self, id: str) -> Optional[Conversation]:
+        with Session(self.engine) as session:
+            return session.get(Conversation, UUID(id))
+
+    def get_conversation_ids(self, page: int, page_size: int, **filters) -> List[str]:
+        """
+        Ids of a page of the conversations selected by the _filter arguments, in the order
+        of get_conversations (ties broken by id, so pages do not overlap).
+        """
+        with Session(self.engine) as session:
+            statement = (
+                select(Conversation.id)
+                .order_by(Conversation.created_at.desc(), Conversation.id)
+                .offset(page * page_size)
+                .limit(page_size)
+            )
+            statement = self._filter(statement, **filters)
+            return [str(it) for it, in session.execute(statement)]
+
     def get_conversations_by_ids(
         self,
         ids: List[str],
     ) -> List[Conversation]:
+        convs = []
         with Session(self.engine) as session:
-            statement = sqlmodel.select(Conversation).where(Conversation.id.in_(ids))
-            convs = session.exec(statement).all()
+            # stay below sqlite's max number of host parameters
+            for chunk in chunked(ids, SQLITE_MAX_VARIABLES):
+                statement = sqlmodel.select(Conversation).where(
+                    Conversation.id.in_(chunk)
+                )
+                convs.extend(session.exec(statement).all())
             return convs
 
     def all_conversations(
-        self, search_term: Union[str, List[str]] = ""
+        self, search_term: Union[str, List[str]] = "", filter_expr: str = ""
     ) -> List[Conversation]:
-        return self.get_conversations(0, 1000000000, search_term=search_term)
+        return self.get_conversations(
+            0, 1000000000, search_term=search_term, filter_expr=filter_expr
+        )
 
     def gen_conversations(self, batch_size) -> Iterator[List[Conversation]]:
         total = self.count_conversations()
@@ -220,16 +582,39 @@ class DBManager:
         for page in range(total_pages):
             yield self.get_conversations(page, batch_size)
 
+    def iter_conversations(self, batch_size: int) -> Iterator[List[Conversation]]:
+        """
+        Stream all conversations with one query, unlike gen_conversations which pays an OFFSET
+        scan per page. The read stays open while iterating, so do not write to the db meanwhile.
+        """
+        with Session(self.engine) as session:
+            statement = sqlmodel.select(Conversation).execution_options(
+                yield_per=batch_size
+            )
+            for convs in session.exec(statement).partitions(batch_size):
+                yield list(convs)
+
     def count_conversations(
         self,
         search_term: str = "",
         messageCountFilterCount: int = 0,
         messageCountFilterMode: str = MESSAGE_FILTER_NONE,
+        cluster_run_id: Optional[int] = None,
+        cluster_group_id: Optional[int] = None,
+        tags: Optional[Dict] = None,
+        filter_expr: str = "",
     ) -> int:
         with Session(self.engine) as session:
             statement = select(func.count(Conversation.id))
             statement = self._filter(
-                statement, search_term, messageCountFilterCount, messageCountFilterMode
+                statement,
+                search_term,
+                messageCountFilterCount,
+                messageCountFilterMode,
+                cluster_run_id,
+                cluster_group_id,
+                tags=tags,
+                filter_expr=filter_expr,
             )
             convs = session.exec(statement).all()
             return convs[0][0]
@@ -245,6 +630,109 @@ class DBManager:
             session.refresh(exist_conv)
             # return exist_conv
 
+    def patch_conversation(
+        self, id: str, ops: List[Dict], version: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Apply patch ops (see apply_patch_ops) to a conversation in one UPDATE.
+
+        Args:
+            version: conversation_version of the conversation the ops are based on.
+                If it no longer matches, nothing is written. None skips the check.
+
+        Returns: New version, None if nothing was written because the conversation does not
+            exist, the version does not match or a message index is out of range.
+        """
+        now = datetime.utcnow()
+        where = [Conversation.id == UUID(id)]
+        if version is not None:
+            if version == "0":
+                where.append(Conversation.updated_at.is_(None))
+            else:
+                where.append(Conversation.updated_at == datetime.fromisoformat(version))
+
+        with Session(self.engine) as session:
+            if all(op["op"] in SQL_PATCH_OPS for op in ops):
+                data = Conversation.data
+                for op in ops:
+                    if op["op"] == "set_content":
+                        index = int(op["index"])
+                        if index < 0:
+                            raise ValueError(f"message index out of range: {index}")
+                        path = f"$.messages[{index}].content"
+                        value = op["content"]
+                        # json_set ignores paths past the end of an array
+                        where.append(
+                            func.json_type(Conversation.data, f"$.messages[{index}]")
+                            == "object"
+                        )
+                    elif op["op"] == "set_tag":
+                        path = "$.tags." + json.dumps(op["key"], ensure_ascii=False)
+                        value = op.get("value")
+                    else:
+                        if op["field"] not in PATCH_FIELDS:
+                            raise ValueError(f"field can not be patched: {op['field']}")
+                        path = f"$.{op['field']}"
+                        value = op.get("value")
+
+                    if value is None and op["op"] == "set_tag":
+                        data = func.json_remove(data, path)
+                    else:
+                        data = func.json_set(
+                            data, path, func.json(json.dumps(value, ensure_ascii=False))
+                        )
+            else:
+                statement = sqlmodel.select(Conversation).where(*where)
+                conv = session.exec(statement).first()
+                if conv is None:
+                    return None
+                data = apply_patch_ops(copy.deepcopy(conv.data), ops)
+
+            statement = (
+                update(Conversation)
+                .where(*where)
+                .values(data=data, updated_at=now)
+                .execution_options(synchronize_session=False)
+            )
+            if session.execute(statement).rowcount == 0:
+                return None
+            session.commit()
+        return conversation_version(now)
+
+    def get_conversation_version(self, id: str) -> Optional[str]:
+        with Session(self.engine) as session:
+            statement = select(Conversation.updated_at).where(
+                Conversation.id == UUID(id)
+            )
+            res = session.execute(statement).first()
+            return conversation_version(res[0]) if res else None
+
+    def update_conversations_data(self, datas: Dict[str, Dict]) -> List[str]:
+        """
+        Replace the data of many conversations in one transaction, returns the ids
+        that don't exist (e.g. deleted in the meantime) and were skipped
+        """
+        now = datetime.utcnow()
+        table = Conversation.__table__
+        statement = (
+            update(table)
+            .where(table.c.id == bindparam("b_id", type_=table.c.id.type))
+            .values(data=bindparam("b_data", type_=table.c.data.type), updated_at=now)
+        )
+        ids = {UUID(id): id for id in datas}
+        with Session(self.engine) as session:
+            existing = set()
+            for chunk in chunked(ids, 500):
+                rows = session.execute(select(table.c.id).where(table.c.id.in_(chunk)))
+                existing.update(rows.scalars())
+            if existing:
+                session.execute(
+                    statement,
+                    [{"b_id": it, "b_data": datas[ids[it]]} for it in existing],
+                )
+            session.commit()
+        return [id for uuid, id in ids.items() if uuid not in existing]
+
     def bucket_update_conversation(self, convs: List[Conversation]):
         with Session(self.engine) as session:
             session.bulk_update_mappings(Conversation, convs)
@@ -285,19 +773,415 @@ class DBManager:
             id = [id]
 
         with Session(self.engine) as session:
-            statement = select(Conversation).where(Conversation.id.in_(id))
-            results = session.exec(statement).all()
-            for r in results:
-                session.delete(r[0])
+            for chunk in chunked(id, SQLITE_MAX_VARIABLES):
+                statement = (
+                    delete(Conversation)
+                    .where(Conversation.id.in_(chunk))
+                    .execution_options(synchronize_session=False)
+                )
+                session.execute(statement)
+                session.execute(
+                    delete(ClusterMember)
+                    .where(ClusterMember.conversation_id.in_(chunk))
+                    .execution_options(synchronize_session=False)
+                )
+            session.commit()
+
+    def create_cluster_run(
+        self, name: str, id_groups: List[List[str]], meta: Dict = {}
+    ) -> ClusterRun:
+        with Session(self.engine) as session:
+            cluster_run = ClusterRun(name=name, meta=meta)
+            session.add(cluster_run)
+            session.flush()
+            members = [
+                {
+                    "run_id": cluster_run.id,
+                    "group_id": group_id,
+                    "conversation_id": UUID(conversation_id),
+                }
+                for group_id, group in enumerate(id_groups)
+                for conversation_id in group
+            ]
+            for chunk in chunked(members, 10000):
+                session.execute(insert(ClusterMember), chunk)
+            session.commit()
+            session.refresh(cluster_run)
+            return cluster_run
+
+    def get_cluster_runs(self) -> List[ClusterRun]:
+        with Session(self.engine) as session:
+            statement = sqlmodel.select(ClusterRun).order_by(ClusterRun.id)
+            return session.exec(statement).all()
+
+    def delete_cluster_run(self, run_id: int):
+        with Session(self.engine) as session:
+            session.execute(delete(ClusterMember).where(ClusterMember.run_id == run_id))
+            session.execute(delete(ClusterRun).where(ClusterRun.id == run_id))
+            session.commit()
+
+    def get_cluster_groups_by_size(
+        self,
+        run_id: int,
+        min_size: int = 1,
+        page: int = 0,
+        page_size: int = -1,
+    ) -> List[Tuple[int, int]]:
+        """
+        Returns: (group_id, size) of groups in a cluster run, largest first.
+        """
+        with Session(self.engine) as session:
+            size = func.count(ClusterMember.conversation_id)
+            statement = (
+                select(ClusterMember.group_id, size)
+                .where(ClusterMember.run_id == run_id)
+                .group_by(ClusterMember.group_id)
+                .having(size >= min_size)
+                .order_by(size.desc(), ClusterMember.group_id)
+            )
+            if page_size != -1:
+                statement = statement.offset(page * page_size).limit(page_size)
+            return [tuple(it) for it in session.execute(statement).all()]
+
+    def get_cluster_group(self, run_id: int, group_id: int) -> List[str]:
+        with Session(self.engine) as session:
+            statement = select(ClusterMember.conversation_id).where(
+                ClusterMember.run_id == run_id, ClusterMember.group_id == group_id
+            )
+            return [str(it[0]) for it in session.execute(statement).all()]
+
+    def get_conversation_cluster_group(
+        self, run_id: int, conversation_id: str
+    ) -> Optional[int]:
+        with Session(self.engine) as session:
+            statement = select(ClusterMember.group_id).where(
+                ClusterMember.run_id == run_id,
+                ClusterMember.conversation_id == UUID(conversation_id),
+            )
+            res = session.execute(statement).first()
+            return res[0] if res else None
+
+    def get_cluster_id_groups(self, run_id: int) -> List[List[str]]:
+        with Session(self.engine) as session:
+            statement = (
+                select(ClusterMember.group_id, ClusterMember.conversation_id)
+                .where(ClusterMember.run_id == run_id)
+                .order_by(ClusterMember.group_id)
+            )
+            groups: Dict[int, List[str]] = {}
+            for group_id, conversation_id in session.execute(statement):
+                groups.setdefault(group_id, []).append(str(conversation_id))
+            return list(groups.values())
+
+    def iter_conversation_pages(
+        self, batch_size: int, filter_expr: str = ""
+    ) -> Iterator[List[Conversation]]:
+        """
+        Page through all conversations matching filter_expr by id, each page is read
+        in its own short transaction so the caller can write between pages.
+        """
+        last_id = None
+        while True:
+            with Session(self.engine) as session:
+                statement = (
+                    sqlmodel.select(Conversation)
+                    .order_by(Conversation.id)
+                    .limit(batch_size)
+                )
+                if last_id is not None:
+                    statement = statement.where(Conversation.id > last_id)
+                statement = self._filter(statement, filter_expr=filter_expr)
+                convs = session.exec(statement).all()
+            if not convs:
+                return
+            last_id = convs[-1].id
+            yield convs
+
+    def iter_record_batches(self, batch_size: int = 10000, **filters) -> Iterator:
+        """
+        Stream the conversations selected by the _filter arguments as pyarrow record
+        batches, see llm_labeling_ui/columnar.py for the columns. The next page is read
+        from sqlite in a background thread while the current one is converted.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        from llm_labeling_ui.columnar import rows_to_record_batch
+
+        def read_page(last_id: Optional[UUID]) -> List:
+            with Session(self.engine) as session:
+                statement = (
+                    select(
+                        Conversation.id,
+                        Conversation.created_at,
+                        Conversation.updated_at,
+                        type_coerce(Conversation.data, Text),
+                    )
+                    .order_by(Conversation.id)
+                    .limit(batch_size)
+                )
+                if last_id is not None:
+                    statement = statement.where(Conversation.id > last_id)
+                statement = self._filter(statement, **filters)
+                return session.execute(statement).all()
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="arrow") as executor:
+            rows = read_page(None)
+            while rows:
+                next_rows = executor.submit(read_page, rows[-1][0])
+                yield rows_to_record_batch(rows)
+                rows = next_rows.result()
+
+    def to_arrow(self, batch_size: int = 10000, **filters):
+        """The conversations selected by the _filter arguments as a pyarrow Table"""
+        import pyarrow as pa
+
+        from llm_labeling_ui.columnar import SCHEMA
+
+        return pa.Table.from_batches(
+            self.iter_record_batches(batch_size, **filters), schema=SCHEMA
+        )
+
+    def import_record_batches(self, batches, overwrite: bool = False) -> int:
+        """
+        Insert the conversations of pyarrow record batches, one transaction per batch.
+        Conversations whose id exists are replaced if overwrite, otherwise skipped.
+
+        Returns: Number of inserted or replaced conversations
+        """
+        from llm_labeling_ui.columnar import record_batch_to_rows
+
+        table = Conversation.__table__
+        statement = insert(table).prefix_with(
+            "OR REPLACE" if overwrite else "OR IGNORE"
+        )
+        count = 0
+        for batch in batches:
+            rows = record_batch_to_rows(batch)
+            if not rows:
+                continue
+            with Session(self.engine) as session:
+                count += session.execute(
+                    statement,
+                    [
+                        {
+                            "id": conv_id,
+                            "created_at": created_at,
+                            "updated_at": updated_at,
+                            "data": data,
+                        }
+                        for conv_id, created_at, updated_at, data in rows
+                    ],
+                ).rowcount
+                session.commit()
+        return count
+
+    def set_conversation_tags(self, key: str, values: Dict[str, Any]):
+        """
+        Set tag key of many conversations in one transaction, values by conversation id.
+        Only the tag is written, concurrent edits of other fields are kept.
+        """
+        now = datetime.utcnow()
+        table = Conversation.__table__
+        statement = (
+            update(table)
+            .where(table.c.id == bindparam("b_id", type_=table.c.id.type))
+            .values(
+                data=func.json_set(
+                    table.c.data,
+                    "$.tags." + json.dumps(key, ensure_ascii=False),
+                    func.json(bindparam("b_value")),
+                ),
+                updated_at=now,
+            )
+        )
+        with Session(self.engine) as session:
+            session.execute(
+                statement,
+                [
+                    {"b_id": UUID(id), "b_value": json.dumps(value, ensure_ascii=False)}
+                    for id, value in values.items()
+                ],
+            )
             session.commit()
 
+    def create_job(self, name: str, params: Dict) -> Job:
+        with Session(self.engine) as session:
+            job = Job(name=name, params=params)
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+            return job
+
+    def get_job(self, id: int) -> Optional[Job]:
+        with Session(self.engine) as session:
+            return session.get(Job, id)
+
+    def get_jobs(self, limit: int = 100) -> List[Job]:
+        with Session(self.engine) as session:
+            statement = sqlmodel.select(Job).order_by(Job.id.desc()).limit(limit)
+            return session.exec(statement).all()
+
+    def count_jobs(self, status: str) -> int:
+        with Session(self.engine) as session:
+            statement = select(func.count(Job.id)).where(Job.status == status)
+            return session.execute(statement).scalar()
+
+    def claim_job(self) -> Optional[Job]:
+        """Mark the oldest queued job as running and return it"""
+        with Session(self.engine) as session:
+            statement = (
+                select(Job.id).where(Job.status == JOB_QUEUED).order_by(Job.id).limit(1)
+            )
+            job_id = session.execute(statement).scalar()
+            if job_id is None:
+                return None
+            # the job may have been cancelled in the meantime
+            statement = (
+                update(Job)
+                .where(Job.id == job_id, Job.status == JOB_QUEUED)
+                .values(status=JOB_RUNNING, updated_at=datetime.utcnow())
+                .execution_options(synchronize_session=False)
+            )
+            if session.execute(statement).rowcount == 0:
+                return None
+            session.commit()
+        return self.get_job(job_id)
+
+    def update_job(self, id: int, **values) -> Optional[str]:
+        """Update job fields, returns the status after the update"""
+        with Session(self.engine) as session:
+            job = session.get(Job, id)
+            if job is None:
+                return None
+            for k, v in values.items():
+                setattr(job, k, v)
+            job.updated_at = datetime.utcnow()
+            session.add(job)
+            session.commit()
+            return job.status
+
+    def cancel_job(self, id: int) -> Optional[Job]:
+        """Queued jobs are cancelled at once, running jobs stop at their next progress update"""
+        with Session(self.engine) as session:
+            for status, new_status in [
+                (JOB_QUEUED, JOB_CANCELLED),
+                (JOB_RUNNING, JOB_CANCELLING),
+            ]:
+                session.execute(
+                    update(Job)
+                    .where(Job.id == id, Job.status == status)
+                    .values(status=new_status, updated_at=datetime.utcnow())
+                    .execution_options(synchronize_session=False)
+                )
+            session.commit()
+        return self.get_job(id)
+
+    def fail_interrupted_jobs(self):
+        """Jobs left running by a job worker that was killed"""
+        with Session(self.engine) as session:
+            session.execute(
+                update(Job)
+                .where(Job.status.in_([JOB_RUNNING, JOB_CANCELLING]))
+                .values(status=JOB_FAILED, message="interrupted")
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+
+    def _bulk_statements(self, statement, ids: Optional[List[str]], filters: Dict):
+        """
+        statement restricted to the selected conversations: ids if given (split to stay
+        below sqlite's max number of host parameters), and the _filter arguments.
+        """
+        if ids is None:
+            return [self._filter(statement, **filters)]
+        return [
+            self._filter(
+                statement.where(Conversation.id.in_([UUID(it) for it in chunk])),
+                **filters,
+            )
+            for chunk in chunked(ids, SQLITE_MAX_VARIABLES)
+        ]
+
+    def _bulk_update(self, data, ids: Optional[List[str]], filters: Dict) -> int:
+        statement = (
+            update(Conversation)
+            .values(data=data, updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        count = 0
+        with Session(self.engine) as session:
+            for it in self._bulk_statements(statement, ids, filters):
+                count += session.execute(it).rowcount
+            session.commit()
+        return count
+
+    def bulk_set_tags(
+        self, values: Dict[str, Any], ids: Optional[List[str]] = None, **filters
+    ) -> int:
+        """
+        Set tags of the selected conversations in one transaction, a None value removes
+        the tag. Conversations are selected by ids and/or the _filter arguments.
+
+        Returns: Number of updated conversations
+        """
+        data = Conversation.data
+        for k, v in values.items():
+            path = "$.tags." + json.dumps(k, ensure_ascii=False)
+            if v is None:
+                data = func.json_remove(data, path)
+            else:
+                data = func.json_set(
+                    data, path, func.json(json.dumps(v, ensure_ascii=False))
+                )
+        return self._bulk_update(data, ids, filters)
+
+    def bulk_move_conversations(
+        self, folder_id: Optional[str], ids: Optional[List[str]] = None, **filters
+    ) -> int:
+        """Set folderId of the selected conversations, None moves them out of folders"""
+        data = func.json_set(
+            Conversation.data, "$.folderId", func.json(json.dumps(folder_id))
+        )
+        return self._bulk_update(data, ids, filters)
+
+    def bulk_delete_conversations(
+        self, ids: Optional[List[str]] = None, **filters
+    ) -> int:
+        """Delete the selected conversations and their cluster memberships"""
+        count = 0
+        with Session(self.engine) as session:
+            for selected in self._bulk_statements(
+                select(Conversation.id), ids, filters
+            ):
+                session.execute(
+                    delete(ClusterMember)
+                    .where(ClusterMember.conversation_id.in_(selected))
+                    .execution_options(synchronize_session=False)
+                )
+                count += session.execute(
+                    delete(Conversation)
+                    .where(Conversation.id.in_(selected))
+                    .execution_options(synchronize_session=False)
+                ).rowcount
+            session.commit()
+        return count
+
     def vacuum(self):
         with Session(self.engine) as session:
             session.execute(text("VACUUM"))
 
     def _filter(
-        self, statement, search_term, messageCountFilterCount, messageCountFilterMode
+        self,
+        statement,
+        search_term="",
+        messageCountFilterCount=0,
+        messageCountFilterMode=MESSAGE_FILTER_NONE,
+        cluster_run_id=None,
+        cluster_group_id=None,
+        tags: Optional[Dict] = None,
+        filter_expr: str = "",
     ):
+        """filter_expr is a filter expression, see llm_labeling_ui/filters.py"""
         if messageCountFilterMode == MESSAGE_FILTER_EQUAL:
             statement = statement.where(
                 func.json_array_length(Conversation.data.op("->>")("messages"))
@@ -321,4 +1205,19 @@ class DBManager:
             for s in search_term:
                 statement = statement.where(col(Conversation.data).contains(s))
 
+        if cluster_run_id is not None:
+            members = select(ClusterMember.conversation_id).where(
+                ClusterMember.run_id == cluster_run_id
+            )
+            if cluster_group_id is not None:
+                members = members.where(ClusterMember.group_id == cluster_group_id)
+            statement = statement.where(Conversation.id.in_(members))
+
+        for k, v in (tags or {}).items():
+            statement = statement.where(tag_clause(Conversation.data, k, v))
+
+        clause = filter_clause(Conversation.__table__, filter_expr)
+        if clause is not None:
+            statement = statement.where(clause)
+
         return statement
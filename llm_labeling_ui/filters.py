@@ -0,0 +1,309 @@
+"""
+Conversation filter expressions, compiled into one SQL WHERE clause.
+
+    user:"hello world" and not assistant~"(?i)as an ai" and tag.lang=en
+    (messages>=4 or length<2000) and created>=2023-06-01
+
+Terms are `field op value`, combined with and / or / not and parentheses, terms next
+to each other are and-ed. Values are bare words or double quoted strings (`\\"` is a
+quote inside them).
+
+Fields:
+    text, name, prompt (or system), user, assistant
+        `:` contains (case sensitive), `~` python regex search. text is the prompt and
+        all messages, user / assistant are messages of that role.
+    tag.<key>
+        `=`, `!=`, `<`, `<=`, `>`, `>=`. Bare true / false / numbers are json values,
+        `tag.key=null` matches conversations without the tag.
+    messages, length
+        Number of messages, and number of characters of prompt and messages.
+    created, updated
+        Compared to an ISO date or datetime, e.g. created>=2023-06-01T12:00
+"""
+import functools
+import json
+import re
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from sqlalchemy import and_, exists, func, literal, not_, or_, select
+
+TEXT_FIELDS = ["text", "name", "prompt", "system", "user", "assistant"]
+NUMBER_FIELDS = ["messages", "length"]
+DATE_FIELDS = ["created", "updated"]
+COMPARE_OPS = ["=", "!=", "<", "<=", ">", ">="]
+
+FILTER_HELP = (
+    "filter expression, e.g. 'user:hello and tag.lang=en and messages>=4', "
+    "see llm_labeling_ui/filters.py"
+)
+
+_TOKEN_RE = re.compile(
+    r"""\s*(?:
+    (?P<paren>[()])
+    |(?P<field>[A-Za-z_][\w.-]*)\s*(?P<op>!=|>=|<=|[:~=<>])\s*
+        (?P<value>"(?:[^"\\]|\\.)*"|[^\s()"]+)
+    |(?P<word>[A-Za-z_]\w*)
+    )""",
+    re.VERBOSE,
+)
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+def quote(value: str) -> str:
+    """value as a quoted filter string"""
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _unquote(value: str) -> str:
+    if not value.startswith('"'):
+        return value
+    return re.sub(r'\\(["\\])', r"\1", value[1:-1])
+
+
+def _tag_value(value: str) -> Any:
+    if value.startswith('"'):
+        return _unquote(value)
+    if value in ["true", "false", "null"]:
+        return json.loads(value)
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _tokenize(expr: str) -> List[Tuple[str, ...]]:
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        m = _TOKEN_RE.match(expr, pos)
+        if m is None or m.end() == pos:
+            raise FilterSyntaxError(f"invalid filter at {pos}: {expr[pos:pos + 20]!r}")
+        if m.group("paren"):
+            tokens.append((m.group("paren"),))
+        elif m.group("field"):
+            tokens.append(("term", m.group("field"), m.group("op"), m.group("value")))
+        else:
+            word = m.group("word").lower()
+            if word not in ["and", "or", "not"]:
+                start = m.start("word")
+                raise FilterSyntaxError(
+                    f"expected a term like field:value at {start}: "
+                    f"{expr[start:start + 20]!r}"
+                )
+            tokens.append((word,))
+        pos = m.end()
+    return tokens
+
+
+def _check_term(field: str, op: str, value: str) -> Tuple:
+    """Validated term node ("term", field, op, value)"""
+    if field in TEXT_FIELDS:
+        if op not in [":", "~"]:
+            raise FilterSyntaxError(f"{field} supports : and ~, got {op}")
+        text = _unquote(value)
+        if op == "~":
+            try:
+                re.compile(text)
+            except re.error as e:
+                raise FilterSyntaxError(f"invalid regex {text!r}: {e}")
+        return ("term", "system" if field == "prompt" else field, op, text)
+    is_tag = field.startswith("tag.") and len(field) > 4
+    if field not in NUMBER_FIELDS + DATE_FIELDS and not is_tag:
+        raise FilterSyntaxError(
+            f"unknown field {field}, expected one of "
+            f"{', '.join(TEXT_FIELDS + NUMBER_FIELDS + DATE_FIELDS)} or tag.<key>"
+        )
+    if op not in COMPARE_OPS:
+        raise FilterSyntaxError(f"{field} supports {', '.join(COMPARE_OPS)}, got {op}")
+    if field in NUMBER_FIELDS:
+        try:
+            return ("term", field, op, int(_unquote(value)))
+        except ValueError:
+            raise FilterSyntaxError(f"{field} expects an integer, got {value}")
+    if field in DATE_FIELDS:
+        try:
+            return ("term", field, op, datetime.fromisoformat(_unquote(value)))
+        except ValueError:
+            raise FilterSyntaxError(f"{field} expects an ISO date, got {value}")
+    return ("term", field, op, _tag_value(value))
+
+
+@functools.lru_cache(maxsize=256)
+def parse_filter(expr: str) -> Optional[Tuple]:
+    """
+    Parse a filter expression into nested tuples: ("and", a, b), ("or", a, b),
+    ("not", a) and ("term", field, op, value). None for an empty expression.
+    """
+    tokens = _tokenize(expr)
+    if not tokens:
+        return None
+    pos = 0
+
+    def peek() -> str:
+        return tokens[pos][0] if pos < len(tokens) else ""
+
+    def parse_or():
+        nonlocal pos
+        node = parse_and()
+        while peek() == "or":
+            pos += 1
+            node = ("or", node, parse_and())
+        return node
+
+    def parse_and():
+        nonlocal pos
+        node = parse_not()
+        while peek() in ["and", "not", "(", "term"]:
+            if peek() == "and":
+                pos += 1
+            node = ("and", node, parse_not())
+        return node
+
+    def parse_not():
+        nonlocal pos
+        token = peek()
+        if token == "not":
+            pos += 1
+            return ("not", parse_not())
+        if token == "(":
+            pos += 1
+            node = parse_or()
+            if peek() != ")":
+                raise FilterSyntaxError("missing )")
+            pos += 1
+            return node
+        if token == "term":
+            pos += 1
+            return _check_term(*tokens[pos - 1][1:])
+        raise FilterSyntaxError(f"expected a term, got {token or 'end of filter'}")
+
+    node = parse_or()
+    if pos != len(tokens):
+        raise FilterSyntaxError(f"unexpected {tokens[pos][0]}")
+    return node
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_regex(pattern: str) -> "re.Pattern":
+    return re.compile(pattern)
+
+
+def sqlite_regexp(pattern: str, value: Optional[str]) -> bool:
+    """`value REGEXP pattern` of sqlite, registered on every connection by DBManager"""
+    if value is None:
+        return False
+    return _compile_regex(pattern).search(value) is not None
+
+
+def _compare(value, op: str, other):
+    if op == "=":
+        return value == other
+    if op == "!=":
+        # missing values are not equal either
+        return or_(value.is_(None), value != other)
+    if op == "<":
+        return value < other
+    if op == "<=":
+        return value <= other
+    if op == ">":
+        return value > other
+    return value >= other
+
+
+def tag_clause(data, key: str, value: Any, op: str = "="):
+    """Compare tag key of the data column with a json value"""
+    tag = func.json_extract(data, "$.tags." + json.dumps(key, ensure_ascii=False))
+    if value is None:
+        return tag.is_(None) if op == "=" else tag.isnot(None)
+    if isinstance(value, bool):
+        # json_extract returns 1/0 for json true/false
+        value = int(value)
+    elif isinstance(value, (dict, list)):
+        # and minified json text for objects and arrays
+        value = func.json(json.dumps(value, ensure_ascii=False))
+    return _compare(tag, op, value)
+
+
+def _text_match(value, op: str, text: str):
+    if op == ":":
+        return func.instr(value, text) > 0
+    return value.op("REGEXP")(text)
+
+
+def _messages(data, role: Optional[str], op: str, text: str):
+    messages = func.json_each(data, "$.messages").table_valued("value").alias()
+    statement = select(literal(1)).select_from(messages)
+    if role is not None:
+        statement = statement.where(
+            func.json_extract(messages.c.value, "$.role") == role
+        )
+    content = func.json_extract(messages.c.value, "$.content")
+    return exists(statement.where(_text_match(content, op, text)))
+
+
+def _length(data):
+    messages = func.json_each(data, "$.messages").table_valued("value").alias()
+    content_length = (
+        select(
+            func.coalesce(
+                func.sum(func.length(func.json_extract(messages.c.value, "$.content"))),
+                0,
+            )
+        )
+        .select_from(messages)
+        .scalar_subquery()
+    )
+    prompt_length = func.coalesce(func.length(func.json_extract(data, "$.prompt")), 0)
+    return prompt_length + content_length
+
+
+def _term_clause(table, field: str, op: str, value: Any):
+    data = table.c.data
+    if field == "name":
+        return _text_match(func.json_extract(data, "$.name"), op, value)
+    if field == "system":
+        return _text_match(func.json_extract(data, "$.prompt"), op, value)
+    if field in ["user", "assistant"]:
+        return _messages(data, field, op, value)
+    if field == "text":
+        return or_(
+            _text_match(func.json_extract(data, "$.prompt"), op, value),
+            _messages(data, None, op, value),
+        )
+    if field == "messages":
+        return _compare(func.json_array_length(data, "$.messages"), op, value)
+    if field == "length":
+        return _compare(_length(data), op, value)
+    if field == "created":
+        return _compare(table.c.created_at, op, value)
+    if field == "updated":
+        return _compare(table.c.updated_at, op, value)
+    return tag_clause(data, field[len("tag.") :], value, op)
+
+
+def filter_clause(table, expr: str):
+    """
+    WHERE clause of filter expr on the conversation table, None for an empty expr.
+    Raises FilterSyntaxError.
+    """
+
+    def build(node):
+        if node[0] == "term":
+            return _term_clause(table, *node[1:])
+        if node[0] == "not":
+            # sql NOT of NULL is NULL, a term on a missing field must still negate
+            return not_(func.coalesce(build(node[1]), False))
+        clauses = [build(node[1]), build(node[2])]
+        return and_(*clauses) if node[0] == "and" else or_(*clauses)
+
+    node = parse_filter(expr)
+    return None if node is None else build(node)
@@ -0,0 +1,335 @@
+"""
+Background jobs run by the server.
+
+Jobs are rows of the job table. The server keeps one job worker process running, which
+claims queued jobs one at a time, so heavy operations never run in the web workers and
+never run concurrently with each other. Jobs read and write in small transactions, letting
+interactive requests take the db lock between chunks.
+"""
+import hashlib
+import multiprocessing
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from loguru import logger
+from more_itertools import chunked
+
+from llm_labeling_ui.db_schema import (
+    JOB_CANCELLED,
+    JOB_CANCELLING,
+    JOB_DONE,
+    JOB_FAILED,
+    DBManager,
+    Job,
+)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobProgress:
+    """
+    Report progress of a running job, writes are throttled to one per min_interval.
+    Raises JobCancelled when the job was cancelled.
+    """
+
+    def __init__(self, db: DBManager, job_id: int, min_interval: float = 0.5):
+        self.db = db
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self.last_update = 0.0
+        self.total = 0
+
+    def __call__(self, done: int, total: Optional[int] = None, message: str = ""):
+        now = time.monotonic()
+        # a new total starts a new phase of the job, always written
+        if total is not None:
+            self.total = total
+        elif now - self.last_update < self.min_interval:
+            return
+        self.last_update = now
+        status = self.db.update_job(
+            self.job_id, done=done, total=self.total, message=message
+        )
+        if status == JOB_CANCELLING:
+            raise JobCancelled()
+
+
+def tag_lang(db: DBManager, params: Dict, progress: JobProgress) -> Dict:
+    """Same as `tag lang`, conversations which already have a lang tag are skipped"""
+    from llm_labeling_ui.lang_classification import LanguageClassifier
+
+    batch_size = params.get("batch_size", 256)
+    lang_classifier = LanguageClassifier()
+    total = db.count_conversations()
+    done = 0
+    tagged = 0
+    progress(done, total)
+    for convs in db.iter_conversation_pages(batch_size):
+        langs = {
+            str(conv.id): lang_classifier(conv.merged_text())
+            for conv in convs
+            if not conv.data.get("tags", {}).get("lang")
+        }
+        if langs:
+            db.set_conversation_tags("lang", langs)
+        tagged += len(langs)
+        done += len(convs)
+        progress(done, message=f"tagged {tagged}")
+    return {"tagged": tagged}
+
+
+def remove_duplicate(db: DBManager, params: Dict, progress: JobProgress) -> Dict:
+    """
+    Same as `conversation remove_duplicate`, the newest conversation of each duplicate
+    text is kept. Like the cli, duplicates are only counted unless params has
+    {"run": true}.
+    """
+    batch_size = params.get("batch_size", 500)
+    total = db.count_conversations()
+    done = 0
+    progress(done, total, message="finding duplicates")
+
+    # text digest -> (created_at, id) of the conversation to keep
+    kept = {}
+    ids_to_delete = []
+    for convs in db.iter_conversation_pages(batch_size):
+        for conv in convs:
+            digest = hashlib.blake2b(
+                conv.merged_text().encode("utf-8"), digest_size=16
+            ).digest()
+            current = (conv.created_at, str(conv.id))
+            other = kept.get(digest)
+            if other is None:
+                kept[digest] = current
+            elif current > other:
+                kept[digest] = current
+                ids_to_delete.append(other[1])
+            else:
+                ids_to_delete.append(current[1])
+        done += len(convs)
+        progress(done)
+
+    run = params.get("run", False)
+    if run:
+        deleted = 0
+        progress(deleted, len(ids_to_delete), message="removing duplicates")
+        for chunk in chunked(ids_to_delete, batch_size):
+            db.delete_conversation(chunk)
+            deleted += len(chunk)
+            progress(deleted)
+    return {"duplicates": len(ids_to_delete), "run": run}
+
+
+def cluster_dedup(db: DBManager, params: Dict, progress: JobProgress) -> Dict:
+    """
+    Same as `cluster dedup --run-id`, keep the first cluster_keep conversations of each
+    group ordered by strategy and delete the others, one transaction per batch of groups.
+    """
+    run_id = params["run_id"]
+    cluster_keep = params.get("cluster_keep", 1)
+    strategy = params.get("strategy", "max_messages_count")
+    batch_size = params.get("batch_size", 1000)
+
+    token_counter = None
+    if strategy == "max_messages_length":
+        from transformers import AutoTokenizer
+        from llm_labeling_ui.utils import TokenCounter
+
+        tokenizer = AutoTokenizer.from_pretrained(
+            params["tokenizer"], trust_remote_code=True
+        )
+        token_counter = TokenCounter(tokenizer, max_size=10000000)
+    elif strategy != "max_messages_count":
+        raise ValueError(f"unknown dedup strategy {strategy}")
+
+    id_groups = db.get_cluster_id_groups(run_id)
+    done = 0
+    deleted = 0
+    progress(done, len(id_groups))
+    for group_batch in chunked(id_groups, batch_size):
+        convs_by_id = {
+            str(it.id): it
+            for it in db.get_conversations_by_ids([i for g in group_batch for i in g])
+        }
+        if token_counter is not None:
+            sort_keys = dict(
+                zip(
+                    convs_by_id.keys(),
+                    token_counter.count(
+                        [it.merged_text() for it in convs_by_id.values()]
+                    ),
+                )
+            )
+        else:
+            sort_keys = {k: v.messages_count() for k, v in convs_by_id.items()}
+
+        ids_to_delete = []
+        for group in group_batch:
+            ids = sorted(
+                [it for it in group if it in convs_by_id],
+                key=lambda it: sort_keys[it],
+                reverse=True,
+            )
+            ids_to_delete.extend(ids[cluster_keep:])
+        db.delete_conversation(ids_to_delete)
+
+        deleted += len(ids_to_delete)
+        done += len(group_batch)
+        progress(done, message=f"deleted {deleted}")
+    return {"groups": len(id_groups), "deleted": deleted}
+
+
+JOBS: Dict[str, Callable[[DBManager, Dict, JobProgress], Dict]] = {
+    "tag_lang": tag_lang,
+    "remove_duplicate": remove_duplicate,
+    "cluster_dedup": cluster_dedup,
+}
+
+
+def run_job(db: DBManager, job: Job):
+    logger.info(f"job {job.id} {job.name} started, params: {job.params}")
+    progress = JobProgress(db, job.id)
+    try:
+        result = JOBS[job.name](db, job.params, progress)
+    except JobCancelled:
+        logger.info(f"job {job.id} {job.name} cancelled")
+        db.update_job(job.id, status=JOB_CANCELLED)
+        return
+    except Exception as e:
+        logger.error(f"job {job.id} {job.name} failed: {e}")
+        db.update_job(
+            job.id,
+            status=JOB_FAILED,
+            message=str(e),
+            result={"traceback": traceback.format_exc()},
+        )
+        return
+    logger.info(f"job {job.id} {job.name} done: {result}")
+    db.update_job(
+        job.id,
+        status=JOB_DONE,
+        done=progress.total,
+        total=progress.total,
+        message="",
+        result=result,
+    )
+
+
+def job_worker(data: Path, poll_interval: float = 1.0):
+    """
+    Run queued jobs of the db at data, or of every dataset when data is a directory.
+    In directory mode new json datasets are converted to sqlite here too, so the
+    conversion runs once and off the web workers.
+    """
+    if not data.is_dir():
+        db = DBManager(data)
+        db.fail_interrupted_jobs()
+        while True:
+            job = db.claim_job()
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+            run_job(db, job)
+
+    from llm_labeling_ui.datasets import convert_json_datasets, dataset_paths
+
+    dbs: Dict[str, DBManager] = {}
+    # file state of datasets without queued jobs at the last poll
+    idle: Dict[str, Tuple] = {}
+    while True:
+        convert_json_datasets(data)
+        claimed = False
+        paths = dataset_paths(data)
+        for name in set(dbs) - set(paths):
+            dbs.pop(name).close()
+            idle.pop(name, None)
+        for name, db_path in paths.items():
+            # submitting a job writes the db or its WAL file, unchanged files have none
+            state = _file_state(db_path)
+            if idle.get(name) == state:
+                continue
+            if name not in dbs:
+                dbs[name] = DBManager(db_path)
+                dbs[name].fail_interrupted_jobs()
+            db = dbs[name]
+            job = db.claim_job()
+            if job is None:
+                # as of before the claim, a job submitted meanwhile changes the state
+                idle[name] = state
+                continue
+            claimed = True
+            idle.pop(name, None)
+            run_job(db, job)
+        if not claimed:
+            time.sleep(poll_interval)
+
+
+def _file_state(db_path: Path) -> Tuple:
+    state = []
+    for path in [db_path, db_path.with_name(db_path.name + "-wal")]:
+        try:
+            stat = path.stat()
+            state.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            state.append(None)
+    return tuple(state)
+
+
+def start_job_worker(data: Path) -> multiprocessing.Process:
+    # spawn, the parent may hold db connections and threads
+    process = multiprocessing.get_context("spawn").Process(
+        target=job_worker, args=(data,), name="job-worker", daemon=True
+    )
+    process.start()
+    return process
+
+
+class JobWorkerSupervisor:
+    """
+    Keep a job worker process running, it is started again when it exits, e.g. after a
+    crash or the OOM killer. The job it was running is failed by fail_interrupted_jobs
+    of the new process. Restarts back off exponentially while the worker keeps dying
+    shortly after its start.
+    """
+
+    def __init__(self, data: Path, max_backoff: float = 60):
+        self.data = data
+        self.max_backoff = max_backoff
+        self.process: Optional[multiprocessing.Process] = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="job-worker-supervisor", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stopped.is_set():
+            self.process = start_job_worker(self.data)
+            started = time.monotonic()
+            while self.process.is_alive() and not self._stopped.is_set():
+                self.process.join(1)
+            if self._stopped.is_set():
+                break
+            if time.monotonic() - started > self.max_backoff:
+                backoff = 1.0
+            logger.error(
+                f"job worker exited with code {self.process.exitcode}, "
+                f"restarting in {backoff:.0f}s"
+            )
+            self._stopped.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def stop(self, timeout: float = 10):
+        self._stopped.set()
+        self._thread.join(timeout)
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
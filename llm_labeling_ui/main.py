@@ -1,3 +1,4 @@
+import math
 from datetime import datetime
 from pathlib import Path
 
@@ -11,7 +12,8 @@ from llm_labeling_ui.conversation_cmd import app as conversation_app
 from llm_labeling_ui.server_cmd import app as server_app
 from llm_labeling_ui.tag_cmd import app as tag_app
 from llm_labeling_ui.db_schema import DBManager
-from llm_labeling_ui.utils import parse_tag
+from llm_labeling_ui.filters import FILTER_HELP
+from llm_labeling_ui.utils import check_filter, parse_tag
 
 typer_app = Typer(add_completion=False, pretty_exceptions_show_locals=False)
 typer_app.add_typer(cluster_app, name="cluster")
@@ -53,6 +55,9 @@ def export(
     min_messages: int = typer.Option(0, help="min messages count. included"),
     max_messages: int = typer.Option(10000, help="max messages count. excluded"),
     count: int = typer.Option(-1, help="max conversations to export. -1 for all."),
+    filter_expr: str = typer.Option(
+        "", "--filter", help=FILTER_HELP, callback=check_filter
+    ),
     force: bool = typer.Option(False, help="force overwrite save_path if exists"),
 ):
     tags = parse_tag(tag)
@@ -73,7 +78,75 @@ def export(
         min_messages=min_messages,
         max_messages=max_messages,
         tags=tags,
+        filter_expr=filter_expr,
+    )
+
+
+@typer_app.command(help="Export conversations to a parquet file for analytics")
+def export_parquet(
+    db_path: Path = typer.Option(..., exists=True, dir_okay=False),
+    save_path: Path = typer.Option(
+        None, dir_okay=False, help="Defaults to db_path with .parquet suffix"
+    ),
+    filter_expr: str = typer.Option(
+        "", "--filter", help=FILTER_HELP, callback=check_filter
+    ),
+    batch_size: int = typer.Option(10000, help="Conversations per record batch"),
+    compression: str = typer.Option("zstd", help="Parquet compression codec"),
+    force: bool = typer.Option(False, help="force overwrite save_path if exists"),
+):
+    import pyarrow.parquet as pq
+
+    from llm_labeling_ui.columnar import SCHEMA
+
+    if save_path is None:
+        save_path = db_path.with_suffix(".parquet")
+    if save_path.exists() and not force:
+        raise FileExistsError(f"{save_path} exists, use --force to overwrite")
+
+    db = DBManager(db_path)
+    total = db.count_conversations(filter_expr=filter_expr)
+    logger.info(f"Exporting {total} conversations to {save_path}")
+    # written batch by batch, the whole db is never held in memory
+    with pq.ParquetWriter(save_path, SCHEMA, compression=compression) as writer:
+        for batch in track(
+            db.iter_record_batches(batch_size, filter_expr=filter_expr),
+            total=math.ceil(total / batch_size),
+            description="exporting",
+        ):
+            writer.write_batch(batch)
+
+
+@typer_app.command(help="Import conversations from a parquet file")
+def import_parquet(
+    parquet_path: Path = typer.Option(..., exists=True, dir_okay=False),
+    db_path: Path = typer.Option(
+        None,
+        dir_okay=False,
+        help="Created if not exists, defaults to parquet_path with .sqlite suffix",
+    ),
+    batch_size: int = typer.Option(10000, help="Conversations per transaction"),
+    overwrite: bool = typer.Option(
+        False, help="Replace conversations whose id exists, they are skipped by default"
+    ),
+):
+    import pyarrow.parquet as pq
+
+    if db_path is None:
+        db_path = parquet_path.with_suffix(".sqlite")
+    parquet_file = pq.ParquetFile(parquet_path)
+    total = parquet_file.metadata.num_rows
+    logger.info(f"Importing {total} conversations to {db_path}")
+    db = DBManager(db_path)
+    count = db.import_record_batches(
+        track(
+            parquet_file.iter_batches(batch_size),
+            total=math.ceil(total / batch_size),
+            description="importing",
+        ),
+        overwrite=overwrite,
     )
+    logger.info(f"Imported {count} conversations, {total - count} skipped")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,204 @@
+"""
+Minimal Prometheus text format metrics, kept in process memory.
+
+With several server workers each worker has its own values, a scrape of /metrics
+reports the worker that served it (see the pid in process_info).
+"""
+import abc
+import bisect
+import os
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def _format_labels(labelnames: Sequence[str], values: Sequence[str], **extra) -> str:
+    pairs = list(zip(labelnames, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = [
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    ]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class _Metric(abc.ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Sequence[str]) -> Tuple[str, ...]:
+        assert len(labels) == len(
+            self.labelnames
+        ), f"{self.name} expects {self.labelnames}"
+        return tuple(str(it) for it in labels)
+
+    @abc.abstractmethod
+    def samples(self) -> List[str]:
+        pass
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [
+                f"{self.name}{_format_labels(self.labelnames, k)} {v}"
+                for k, v in self.values.items()
+            ]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value: float):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: bucket counts (non cumulative, last one is +Inf), sum
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, *labels, value: float):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    labels = _format_labels(self.labelnames, key, le=le)
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {total[0]}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class _ProcessInfo(_Metric):
+    type = "gauge"
+
+    def samples(self) -> List[str]:
+        # at scrape time, gunicorn workers are forked after this module is imported
+        return [f"{self.name}{_format_labels(self.labelnames, [os.getpid()])} 1"]
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render() -> str:
+    return "\n".join(it.render() for it in REGISTRY) + "\n"
+
+
+PROCESS_INFO = _ProcessInfo(
+    "process_info", "Worker process serving this scrape", ["pid"]
+)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Latency of http requests until the response is sent",
+    ["method", "route", "status"],
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Http requests being served", ["route"]
+)
+
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Latency of sqlite statements", ["statement"]
+)
+DB_SLOW_QUERIES = Counter(
+    "db_slow_queries_total", "Statements slower than the slow query threshold"
+)
+
+TOKENIZER_SECONDS = Histogram(
+    "tokenizer_duration_seconds", "Latency of tokenizer batch calls"
+)
+TOKENIZER_TEXTS = Counter(
+    "tokenizer_texts_total", "Texts counted by count_tokens", ["cache"]
+)
+
+CHAT_STREAM_SECONDS = Histogram(
+    "chat_stream_duration_seconds",
+    "Duration of proxied chat streams",
+    ["status"],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+CHAT_FIRST_CHUNK_SECONDS = Histogram(
+    "chat_first_chunk_seconds",
+    "Time from the chat request to the first content chunk",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+CHAT_STREAMS_IN_FLIGHT = Gauge("chat_streams_in_flight", "Open chat streams")
+
+PAGE_CACHE_REQUESTS = Counter(
+    "page_cache_requests_total",
+    "Page cache lookups, result is hit or miss",
+    ["kind", "result"],
+)
+PAGE_CACHE_PREFETCHES = Counter(
+    "page_cache_prefetches_total", "Pages loaded ahead of the request", ["kind"]
+)
+PAGE_CACHE_BYTES = Gauge("page_cache_bytes", "Size of the cached responses")
@@ -0,0 +1,161 @@
+import time
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from llm_labeling_ui.metrics import HTTP_REQUEST_SECONDS, HTTP_REQUESTS_IN_FLIGHT
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CompressionMiddleware:
+    """
+    Compress responses with brotli (if the brotli package is installed) or gzip,
+    depending on the request's Accept-Encoding. Event streams, images, fonts and
+    responses that already have a Content-Encoding are sent as is.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 1024,
+        gzip_level: int = 6,
+        brotli_quality: int = 4,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            accept_encoding = Headers(scope=scope).get("Accept-Encoding", "")
+            encoding = None
+            if brotli is not None and "br" in accept_encoding:
+                encoding = "br"
+            elif "gzip" in accept_encoding:
+                encoding = "gzip"
+            if encoding is not None:
+                responder = _CompressionResponder(self, encoding)
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+class _CompressionResponder:
+    def __init__(self, middleware: CompressionMiddleware, encoding: str):
+        self.app = middleware.app
+        self.minimum_size = middleware.minimum_size
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor(quality=middleware.brotli_quality)
+        else:
+            # wbits 31: gzip container
+            self.compressor = zlib.compressobj(middleware.gzip_level, wbits=31)
+        self.send: Send = None
+        self.initial_message: Message = {}
+        self.started = False
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    def _compress(self, body: bytes, finish: bool) -> bytes:
+        if self.encoding == "br":
+            data = self.compressor.process(body)
+            return data + (
+                self.compressor.finish() if finish else self.compressor.flush()
+            )
+        data = self.compressor.compress(body)
+        return data + self.compressor.flush(
+            zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH
+        )
+
+    async def send_compressed(self, message: Message):
+        if message["type"] == "http.response.start":
+            # hold the headers until the first body chunk decides the encoding
+            self.initial_message = message
+            headers = Headers(raw=message["headers"])
+            content_type = headers.get("content-type", "")
+            self.passthrough = "content-encoding" in headers or content_type.startswith(
+                ("text/event-stream", "image/", "font/")
+            )
+            return
+
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if not self.started:
+            self.started = True
+            if self.passthrough or (len(body) < self.minimum_size and not more_body):
+                self.passthrough = True
+                await self.send(self.initial_message)
+                await self.send(message)
+                return
+
+            headers = MutableHeaders(raw=self.initial_message["headers"])
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            message["body"] = self._compress(body, finish=not more_body)
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(message["body"]))
+            await self.send(self.initial_message)
+            await self.send(message)
+        elif self.passthrough:
+            await self.send(message)
+        else:
+            message["body"] = self._compress(body, finish=not more_body)
+            await self.send(message)
+
+
+class MetricsMiddleware:
+    """
+    Record latency and in-flight count of http requests, labeled by route template
+    so path parameters and static file names do not create new series.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    @staticmethod
+    def _route(scope: Scope) -> str:
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return "other"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = self._route(scope)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.inc(route)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.dec(route)
+            HTTP_REQUEST_SECONDS.observe(
+                scope["method"], route, status, value=time.perf_counter() - start
+            )
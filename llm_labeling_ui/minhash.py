@@ -0,0 +1,104 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+class MinHash:
+    def __init__(self, num_perm: int = 128, ngram: int = 5, seed: int = 1):
+        self.num_perm = num_perm
+        self.ngram = ngram
+        rng = np.random.RandomState(seed)
+        # a * h + b stays below 2**64 for 32 bit shingle hashes, so no overflow in uint64
+        self.a = rng.randint(1, 1 << 32, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 32, size=(num_perm, 1), dtype=np.uint64)
+
+    def shingle_hashes(self, text: str) -> np.ndarray:
+        """
+        32 bit polynomial hashes of all character n-grams of text, computed on the
+        code point array without building the n-gram strings.
+        """
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(
+            np.uint64
+        )
+        k = min(self.ngram, len(codes))
+        if k == 0:
+            return np.empty(0, dtype=np.uint64)
+        n = len(codes) - k + 1
+        h = np.zeros(n, dtype=np.uint64)
+        for j in range(k):
+            h = h * np.uint64(1000003) + codes[j : j + n]
+        h ^= h >> np.uint64(32)
+        return np.unique(h & _MAX_HASH)
+
+    def __call__(self, text: str, chunk_size: int = 8192) -> np.ndarray:
+        signature = np.full(self.num_perm, _MAX_HASH, dtype=np.uint64)
+        hashes = self.shingle_hashes(text)
+        for i in range(0, len(hashes), chunk_size):
+            phv = (self.a * hashes[None, i : i + chunk_size] + self.b) % _MERSENNE_PRIME
+            signature = np.minimum(signature, (phv & _MAX_HASH).min(axis=1))
+        return signature.astype(np.uint32)
+
+
+class MinHashLSH:
+    """
+    Banded LSH index over MinHash signatures. Every band bucket keeps one representative,
+    an added signature is compared with the representative of each of its buckets once,
+    so building the index is linear in the number of documents, also when most of them
+    are duplicates. Candidates whose estimated jaccard similarity is below threshold are
+    not merged. Documents without shingles (empty text) are grouped with each other and
+    kept out of the buckets.
+    """
+
+    def __init__(self, num_perm: int = 128, bands: int = 32, threshold: float = 0.7):
+        assert num_perm % bands == 0, "num_perm must be divisible by bands"
+        self.rows = num_perm // bands
+        self.bands = bands
+        self.threshold = threshold
+        self.keys: List[str] = []
+        self.signatures: List[np.ndarray] = []
+        self.parents: List[int] = []
+        self.buckets: List[Dict[bytes, int]] = [{} for _ in range(bands)]
+        # first document without shingles
+        self.empty: Optional[int] = None
+
+    def _find(self, i: int) -> int:
+        while self.parents[i] != i:
+            self.parents[i] = self.parents[self.parents[i]]
+            i = self.parents[i]
+        return i
+
+    def _union(self, i: int, j: int):
+        root, other_root = self._find(i), self._find(j)
+        if root != other_root:
+            self.parents[max(root, other_root)] = min(root, other_root)
+
+    def add(self, key: str, signature: np.ndarray):
+        index = len(self.keys)
+        self.keys.append(key)
+        self.signatures.append(signature)
+        self.parents.append(index)
+        if (signature == _MAX_HASH).all():
+            # every empty text has this signature, it would fill every bucket
+            if self.empty is None:
+                self.empty = index
+            else:
+                self._union(index, self.empty)
+            return
+
+        for band, bucket in enumerate(self.buckets):
+            band_key = signature[band * self.rows : (band + 1) * self.rows].tobytes()
+            other = bucket.setdefault(band_key, index)
+            if other == index or self._find(index) == self._find(other):
+                continue
+            if np.mean(signature == self.signatures[other]) < self.threshold:
+                continue
+            self._union(index, other)
+
+    def groups(self) -> List[List[str]]:
+        groups: Dict[int, List[str]] = {}
+        for i, key in enumerate(self.keys):
+            groups.setdefault(self._find(i), []).append(key)
+        return [it for it in groups.values() if len(it) > 1]
@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable, Optional, Set, Tuple
+
+from loguru import logger
+
+from llm_labeling_ui.metrics import (
+    PAGE_CACHE_BYTES,
+    PAGE_CACHE_PREFETCHES,
+    PAGE_CACHE_REQUESTS,
+)
+
+
+class PageCache:
+    """
+    LRU of encoded responses, bounded by their total size.
+
+    Every entry is stored with the write generation of the db it was read from, see
+    DBManager.get_write_generations. A lookup with a newer generation drops the entry,
+    so any write to the db invalidates the pages read before it.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, prefetch_workers: int = 1):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Hashable, Tuple[Hashable, bytes]]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=prefetch_workers, thread_name_prefix="prefetch"
+        )
+        self.prefetching: Set[Hashable] = set()
+        self.closed = False
+
+    def _pop(self, key: Hashable):
+        _, value = self.entries.pop(key)
+        self.size -= len(value)
+
+    def get(self, kind: str, key: Hashable, generation: Hashable) -> Optional[bytes]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] != generation:
+                self._pop(key)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        PAGE_CACHE_REQUESTS.inc(kind, "miss" if entry is None else "hit")
+        return None if entry is None else entry[1]
+
+    def put(self, key: Hashable, generation: Hashable, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._pop(key)
+            self.entries[key] = (generation, value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+            PAGE_CACHE_BYTES.set(value=self.size)
+
+    def get_or_load(
+        self, kind: str, key: Hashable, generation: Hashable, load: Callable[[], bytes]
+    ) -> bytes:
+        value = self.get(kind, key, generation)
+        if value is None:
+            value = load()
+            self.put(key, generation, value)
+        return value
+
+    def prefetch(
+        self, kind: str, key: Hashable, generation: Hashable, load: Callable[[], bytes]
+    ) -> bool:
+        """
+        Load and cache the value in the background, unless it is cached already.
+        Returns whether load was scheduled, never after close().
+        """
+        if self.max_bytes <= 0:
+            return False
+
+        def run():
+            try:
+                self.put(key, generation, load())
+                PAGE_CACHE_PREFETCHES.inc(kind)
+            except Exception as e:
+                logger.warning(f"prefetch failed: {e}")
+            finally:
+                with self.lock:
+                    self.prefetching.discard(key)
+
+        with self.lock:
+            # close() shuts the executor down under the lock, submit can't race it
+            if self.closed:
+                return False
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == generation:
+                return False
+            if key in self.prefetching:
+                return False
+            self.prefetching.add(key)
+            self.executor.submit(run)
+        return True
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.executor.shutdown(wait=False)
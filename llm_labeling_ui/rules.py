@@ -0,0 +1,214 @@
+"""
+Apply many literal / regex replacements to conversations in one pass.
+
+A rule file is a json list of rules:
+
+    [
+        {"search": "As an AI language model, ", "role": "assistant"},
+        {"search": "ChatGPT", "replace": "the assistant", "ignoreCase": true},
+        {"search": "\\[(\\d+)\\]", "replace": "(\\1)", "regex": true}
+    ]
+
+replace defaults to "" (delete the string). role is user, assistant, system (the
+prompt) or all (the default, which also covers the conversation name).
+
+All rules of a role are compiled into one regex. Literal rules become a single branch
+built from their character trie, so the regex engine walks shared prefixes once
+instead of trying every literal at every position. Matches do not overlap: the
+leftmost match wins, at the same position literals win over regex rules (the longest
+literal first), then regex rules in file order.
+"""
+import json
+import re
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from pydantic import BaseModel, parse_obj_as
+
+ROLES = ["user", "assistant", "system", "all"]
+# text fields of a conversation: name, prompt (system) and messages by role
+SCOPES = ["name", "system", "user", "assistant"]
+
+_LITERALS_GROUP = "_literals"
+# numbered backreferences would point to another group once rules are combined
+_NUMBERED_BACKREF = re.compile(r"\\[1-9]")
+
+
+class Rule(BaseModel):
+    search: str
+    replace: str = ""
+    regex: bool = False
+    ignoreCase: bool = False
+    role: str = "all"
+    # shown in the report instead of search
+    name: str = ""
+
+    def label(self) -> str:
+        return self.name or self.search
+
+
+def load_rules(path: Path) -> List[Rule]:
+    with open(path, "r", encoding="utf-8") as f:
+        return parse_obj_as(List[Rule], json.load(f))
+
+
+def trie_pattern(words: List[str]) -> str:
+    """
+    Regex matching any of words, built from their character trie. A word wins over
+    its prefixes, e.g. ["ab", "abc"] gives `ab(?:c)?`.
+    """
+    trie: Dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def build(node: Dict) -> str:
+        out = ""
+        # chains of single children are the common case, not recursed into
+        keys = [k for k in node if k]
+        while len(keys) == 1 and "" not in node:
+            out += re.escape(keys[0])
+            node = node[keys[0]]
+            keys = [k for k in node if k]
+        if not keys:
+            return out
+        branches = "|".join(re.escape(k) + build(node[k]) for k in sorted(keys))
+        return out + f"(?:{branches})" + ("?" if "" in node else "")
+
+    return build(trie)
+
+
+class _Matcher:
+    """Combined regex of the rules of one scope"""
+
+    def __init__(self, rules: List[Tuple[int, Rule]]):
+        # exact literal -> rule index, first rule wins for duplicates
+        self.literals: Dict[str, int] = {}
+        # group name -> rule index, compiled rule
+        self.others: Dict[str, Tuple[int, "re.Pattern"]] = {}
+
+        branches = []
+        for i, rule in rules:
+            if not rule.regex and not rule.ignoreCase:
+                self.literals.setdefault(rule.search, i)
+                continue
+            search = rule.search if rule.regex else re.escape(rule.search)
+            flags = re.IGNORECASE if rule.ignoreCase else 0
+            group = f"_rule{i}"
+            self.others[group] = (i, re.compile(search, flags))
+            branches.append(f"(?P<{group}>{'(?i:' if flags else '(?:'}{search}))")
+        if self.literals:
+            literals = f"(?P<{_LITERALS_GROUP}>{trie_pattern(list(self.literals))})"
+            branches.insert(0, literals)
+        self.pattern = re.compile("|".join(branches)) if branches else None
+
+
+class RuleSet:
+    def __init__(self, rules: List[Rule]):
+        for i, rule in enumerate(rules):
+            if rule.role not in ROLES:
+                raise ValueError(f"rule {i}: role must be one of {ROLES}")
+            if not rule.search:
+                raise ValueError(f"rule {i}: search is empty")
+            if rule.regex:
+                if _NUMBERED_BACKREF.search(rule.search):
+                    raise ValueError(
+                        f"rule {i}: numbered backreferences are not supported in "
+                        "search, use a named group, e.g. (?P<x>a)(?P=x)"
+                    )
+                try:
+                    re.compile(rule.search)
+                except re.error as e:
+                    raise ValueError(f"rule {i}: invalid regex {rule.search!r}: {e}")
+
+        self.rules = rules
+        # matches and matched conversations per rule
+        self.hits = [0] * len(rules)
+        self.conversation_hits = [0] * len(rules)
+        self.matchers: Dict[str, _Matcher] = {}
+        for scope in SCOPES:
+            scope_rules = [
+                (i, it)
+                for i, it in enumerate(rules)
+                if it.role == "all" or it.role == scope
+            ]
+            try:
+                self.matchers[scope] = _Matcher(scope_rules)
+            except re.error as e:
+                raise ValueError(
+                    f"failed to combine rules, group names must be unique: {e}"
+                )
+
+    def apply(self, scope: str, text: str, hits: Dict[int, int]) -> str:
+        """Apply the rules of scope to text, matches per rule index are added to hits"""
+        matcher = self.matchers[scope]
+        if matcher.pattern is None or not text:
+            return text
+
+        def replace(m: "re.Match") -> str:
+            if m.lastgroup == _LITERALS_GROUP:
+                i = matcher.literals[m.group()]
+                hits[i] = hits.get(i, 0) + 1
+                return self.rules[i].replace
+            i, pattern = matcher.others[m.lastgroup]
+            hits[i] = hits.get(i, 0) + 1
+            rule = self.rules[i]
+            if not rule.regex:
+                return rule.replace
+            # same pattern at the same position, so the same match with its own groups
+            return pattern.match(m.string, m.start()).expand(rule.replace)
+
+        return matcher.pattern.sub(replace, text)
+
+    def apply_conversation(self, data: Dict) -> List[Tuple[str, str, str]]:
+        """
+        Apply all rules to conversation data in place.
+
+        Returns: (field, old text, new text) of the changed fields
+        """
+        hits: Dict[int, int] = {}
+        changes = []
+
+        def update(field: str, scope: str, obj: Dict, key: str):
+            old = obj.get(key)
+            if not isinstance(old, str):
+                return
+            new = self.apply(scope, old, hits)
+            if new != old:
+                obj[key] = new
+                changes.append((field, old, new))
+
+        update("name", "name", data, "name")
+        update("prompt", "system", data, "prompt")
+        for index, m in enumerate(data.get("messages", [])):
+            if m.get("role") in ["system", "user", "assistant"]:
+                update(f"messages[{index}] {m['role']}", m["role"], m, "content")
+
+        for i, count in hits.items():
+            self.hits[i] += count
+            self.conversation_hits[i] += 1
+        return changes
+
+
+def diff_snippet(old: str, new: str, context: int = 60) -> Tuple[str, str]:
+    """The part of old and new around their first difference"""
+    start = 0
+    while start < min(len(old), len(new)) and old[start] == new[start]:
+        start += 1
+    end = 0
+    while (
+        end < min(len(old), len(new)) - start
+        and old[len(old) - end - 1] == new[len(new) - end - 1]
+    ):
+        end += 1
+    begin = max(0, start - context)
+
+    def cut(text: str) -> str:
+        stop = min(len(text), len(text) - end + context)
+        prefix = "..." if begin > 0 else ""
+        suffix = "..." if stop < len(text) else ""
+        return prefix + text[begin:stop] + suffix
+
+    return cut(old), cut(new)
@@ -1,5 +1,6 @@
 import uuid
-from typing import List
+from datetime import datetime
+from typing import Any, Dict, List, Optional
 from pathlib import Path
 
 from pydantic import BaseModel, Field
@@ -39,6 +40,8 @@ class ChatRequest(BaseModel):
     org: str
     prompt: str = ""
     temperature: float = 1.0
+    # frame each chunk as a server-sent event instead of raw text
+    sse: bool = False
 
 
 class ModelInfo(SQLModel):
@@ -91,6 +94,25 @@ class ChatBotUIHistory(BaseModel):
 
 class Config(BaseModel):
     web_app_dir: Path
+    # precompressed variants of web_app_dir files, see static_files.precompress_static
+    static_cache_dir: Optional[Path] = None
+    openai_api_base: str = "https://api.openai.com/v1"
+    # max concurrent chat streams per worker
+    chat_concurrency: int = 16
+    # seconds to wait for a chat slot or for the next chunk of a stream
+    chat_timeout: float = 60
+    # seconds update_conversation writes are buffered and coalesced, 0 writes through,
+    # the buffer is per worker process so it's only used with a single worker
+    write_delay: float = 0
+    # statements slower than this are logged with their query plan
+    slow_query_seconds: float = 0.5
+    # max size of cached conversation pages per worker
+    page_cache_mb: int = 64
+    # submit_job is refused when this many jobs are waiting
+    max_queued_jobs: int = 16
+    # --data is a directory of datasets
+    max_open_datasets: int = 8
+    dataset_idle_seconds: float = 600
 
 
 class GetConversionsRequest(BaseModel):
@@ -99,6 +121,10 @@ class GetConversionsRequest(BaseModel):
     searchTerm: str = ""
     messageCountFilterCount: int = 0
     messageCountFilterMode: str = MESSAGE_FILTER_NONE
+    clusterRunId: Optional[int] = None
+    clusterGroupId: Optional[int] = None
+    # filter expression, see llm_labeling_ui/filters.py
+    filter: str = ""
 
 
 class GetConversionsResponse(BaseModel):
@@ -108,6 +134,108 @@ class GetConversionsResponse(BaseModel):
     totalConversations: int
 
 
+class ConversationSummary(BaseModel):
+    id: str
+    name: str
+    messageCount: int
+    tags: dict = {}
+    folderId: Optional[str] = None
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+
+
+class GetConversationSummariesResponse(BaseModel):
+    page: int
+    totalPages: int
+    conversations: List[ConversationSummary]
+    totalConversations: int
+
+
+class PatchOp(BaseModel):
+    # set_content, insert_message, delete_message, set_tag, set_field
+    op: str
+    # message index, negative indexes from the end are not supported
+    index: Optional[int] = Field(None, ge=0)
+    content: Optional[str] = None
+    message: Optional[Message] = None
+    key: Optional[str] = None
+    field: Optional[str] = None
+    value: Any = None
+
+
+class PatchConversationRequest(BaseModel):
+    id: str
+    ops: List[PatchOp]
+    # version the ops are based on, updated_at in iso format, "0" if never updated.
+    # None skips the version check.
+    version: Optional[str] = None
+
+
+class PatchConversationResponse(BaseModel):
+    version: str
+
+
+class ConversationSelection(BaseModel):
+    """
+    Conversations selected by ids and/or a filter, at least one of them must be set.
+    """
+
+    ids: Optional[List[str]] = None
+    searchTerm: str = ""
+    messageCountFilterCount: int = 0
+    messageCountFilterMode: str = MESSAGE_FILTER_NONE
+    clusterRunId: Optional[int] = None
+    clusterGroupId: Optional[int] = None
+    tags: Dict[str, Any] = {}
+    filter: str = ""
+
+    def is_empty(self) -> bool:
+        return (
+            self.ids is None
+            and not self.searchTerm
+            and self.messageCountFilterMode == MESSAGE_FILTER_NONE
+            and self.clusterRunId is None
+            and not self.tags
+            and not self.filter
+        )
+
+    def filters(self) -> Dict:
+        """Keyword arguments of DBManager._filter"""
+        return {
+            "search_term": self.searchTerm,
+            "messageCountFilterCount": self.messageCountFilterCount,
+            "messageCountFilterMode": self.messageCountFilterMode,
+            "cluster_run_id": self.clusterRunId,
+            "cluster_group_id": self.clusterGroupId,
+            "tags": self.tags,
+            "filter_expr": self.filter,
+        }
+
+
+class BulkDeleteRequest(ConversationSelection):
+    pass
+
+
+class BulkTagRequest(ConversationSelection):
+    # tags to set, None removes the tag
+    setTags: Dict[str, Any]
+
+
+class BulkMoveRequest(ConversationSelection):
+    # None moves the conversations out of their folder
+    folderId: Optional[str] = None
+
+
+class BulkResponse(BaseModel):
+    count: int
+
+
+class SubmitJobRequest(BaseModel):
+    # see llm_labeling_ui.jobs.JOBS
+    name: str
+    params: Dict = {}
+
+
 class SplitConversationRequest(BaseModel):
     conversation: Conversation
     messageIndex: int
@@ -121,3 +249,35 @@ class CountTokensRequest(BaseModel):
 class CountTokensResponse(BaseModel):
     promptTokenCount: int
     messagesTokenCounts: List[int]
+
+
+class ClusterRun(BaseModel):
+    id: int
+    name: str
+    meta: dict
+
+
+class GetClusterGroupsRequest(BaseModel):
+    runId: int
+    page: int = 0
+    pageSize: int = 50
+    minSize: int = 1
+
+
+class ClusterGroup(BaseModel):
+    groupId: int
+    size: int
+
+
+class GetClusterGroupsResponse(BaseModel):
+    groups: List[ClusterGroup]
+
+
+class GetConversationClusterGroupRequest(BaseModel):
+    runId: int
+    conversationId: str
+
+
+class GetConversationClusterGroupResponse(BaseModel):
+    groupId: Optional[int]
+    conversationIds: List[str]
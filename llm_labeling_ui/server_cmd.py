@@ -1,15 +1,27 @@
 import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import List
 
 import typer
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from gunicorn.app.base import BaseApplication
 from loguru import logger
 import typer
 
+from llm_labeling_ui.datasets import DatasetMiddleware, DatasetPool
 from llm_labeling_ui.db_schema import DBManager
+from llm_labeling_ui.jobs import JobWorkerSupervisor
+from llm_labeling_ui.middleware import CompressionMiddleware, MetricsMiddleware
 from llm_labeling_ui.schema import Config
+from llm_labeling_ui.static_files import precompress_static
 
 app = typer.Typer(
     add_completion=False,
@@ -22,11 +34,11 @@ web_app_dir = CURRENT_DIR / "out"
 
 
 class StandaloneApplication(BaseApplication):
-    def __init__(self, app, options, config, db, tokenizer):
+    def __init__(self, app, options, config, db_path, tokenizer):
         self.options = options or {}
         self.app = app
         self.config = config
-        self.db = db
+        self.db_path = db_path
         self.tokenizer = tokenizer
         super().__init__()
 
@@ -45,7 +57,7 @@ class StandaloneApplication(BaseApplication):
 
 
 def app_factory():
-    app = FastAPI()
+    app = FastAPI(default_response_class=ORJSONResponse)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
@@ -53,48 +65,332 @@ def app_factory():
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    app.add_middleware(CompressionMiddleware)
+    # outside compression, so the latency includes it
+    app.add_middleware(MetricsMiddleware)
+    # before the routing and metrics see the path
+    app.add_middleware(DatasetMiddleware)
     return app
 
 
 def post_worker_init(worker):
     from llm_labeling_ui.api import Api
 
-    api = Api(worker.app.app, worker.app.config, worker.app.db, worker.app.tokenizer)
+    # db engine and tokenizer are created after fork, connections must not be shared
+    # between worker processes
+    config = worker.app.config
+    db = None
+    datasets = None
+    if worker.app.db_path.is_dir():
+        datasets = DatasetPool(
+            worker.app.db_path,
+            max_open=config.max_open_datasets,
+            idle_seconds=config.dataset_idle_seconds,
+            write_delay=config.write_delay,
+            slow_query_seconds=config.slow_query_seconds,
+        )
+    else:
+        db = DBManager(worker.app.db_path, slow_query_seconds=config.slow_query_seconds)
+    api = Api(worker.app.app, config, db, worker.app.tokenizer, datasets=datasets)
     api.app.include_router(api.router)
 
 
+def prepare_db(data: Path) -> Path:
+    if data.suffix == ".json":
+        db_path = data.with_suffix(".sqlite")
+    elif data.suffix == ".sqlite":
+        db_path = data
+    else:
+        raise ValueError(f"unknown file type {data}")
+
+    if not db_path.exists():
+        logger.info(f"create db at {db_path}")
+        db = DBManager(db_path)
+        db = db.create_from_json_file(data)
+    else:
+        logger.warning(f"loading db from {db_path}, data may be different from {data}")
+        db = DBManager(db_path)
+    db.enable_wal()
+    db.close()
+    return db_path
+
+
 @app.command(help="Start the web server")
 def start(
     host: str = typer.Option("0.0.0.0"),
     port: int = typer.Option(8000),
     data: Path = typer.Option(
-        ..., exists=True, dir_okay=False, help="json or sqlite file"
+        ...,
+        exists=True,
+        help="json or sqlite file, or a directory of them served as datasets at "
+        "/datasets/<name>/",
     ),
     tokenizer: str = typer.Option(None),
+    workers: int = typer.Option(
+        1, help="Number of worker processes, each one opens its own db connection"
+    ),
+    openai_api_base: str = typer.Option(
+        "https://api.openai.com/v1",
+        envvar="OPENAI_API_BASE",
+        help="Base url of OpenAI compatible api",
+    ),
+    chat_concurrency: int = typer.Option(
+        16, help="Max concurrent chat streams per worker"
+    ),
+    chat_timeout: float = typer.Option(
+        60, help="Seconds to wait for a chat slot or for the next chunk of a stream"
+    ),
+    write_delay: float = typer.Option(
+        0,
+        help="Seconds conversation updates are buffered and written in one transaction, "
+        "0 writes every update immediately. Only used with a single worker",
+    ),
+    slow_query_ms: float = typer.Option(
+        500, help="Log sqlite statements slower than this with their query plan"
+    ),
+    max_queued_jobs: int = typer.Option(
+        16, help="Max background jobs waiting for the job worker"
+    ),
+    page_cache_mb: int = typer.Option(
+        64, help="Max MB of cached conversation pages per worker, 0 disables it"
+    ),
+    max_open_datasets: int = typer.Option(
+        8, help="Max datasets open at once per worker, when --data is a directory"
+    ),
+    dataset_idle_seconds: float = typer.Option(
+        600, help="Close datasets not used for this long, when --data is a directory"
+    ),
 ):
-    config = Config(web_app_dir=web_app_dir)
+    if workers > 1 and write_delay > 0:
+        # the buffer is per worker, the others would read stale conversations and a
+        # late flush would overwrite their writes
+        logger.warning(f"--write-delay is ignored with {workers} workers")
+        write_delay = 0
+    config = Config(
+        web_app_dir=web_app_dir,
+        # once in the main process, the workers only read the files
+        static_cache_dir=precompress_static(web_app_dir),
+        openai_api_base=openai_api_base,
+        chat_concurrency=chat_concurrency,
+        chat_timeout=chat_timeout,
+        write_delay=write_delay,
+        slow_query_seconds=slow_query_ms / 1000,
+        max_queued_jobs=max_queued_jobs,
+        page_cache_mb=page_cache_mb,
+        max_open_datasets=max_open_datasets,
+        dataset_idle_seconds=dataset_idle_seconds,
+    )
+    db_path = data if data.is_dir() else prepare_db(data)
+    # one process runs tag/dedup jobs submitted by /api/jobs, one job at a time, the
+    # gunicorn master restarts it when it exits
+    job_worker = JobWorkerSupervisor(db_path)
     options = {
         "bind": f"{host}:{port}",
-        # 'workers': workers,
+        "workers": workers,
         "worker_class": "uvicorn.workers.UvicornWorker",
         "timeout": 120,
         "post_worker_init": post_worker_init,
+        "when_ready": lambda server: job_worker.start(),
+        "on_exit": lambda server: job_worker.stop(),
         "capture_output": True,
     }
+    StandaloneApplication(app_factory(), options, config, db_path, tokenizer).run()
 
-    if data.suffix == ".json":
-        db_path = data.with_suffix(".sqlite")
-    elif data.suffix == ".sqlite":
-        db_path = data
-    else:
-        raise ValueError(f"unknown file type {data}")
 
-    if not db_path.exists():
-        logger.info(f"create db at {db_path}")
-        db = DBManager(db_path)
-        db = db.create_from_json_file(data)
-    else:
-        logger.warning(f"loading db from {db_path}, data may be different from {data}")
+def _create_synthetic_db(db_path: Path, count: int, max_turns: int = 5):
+    from sqlmodel import Session
+    from llm_labeling_ui.db_schema import Conversation
+
+    words = [f"word{i}" for i in range(2000)]
+    db = DBManager(db_path)
+    with Session(db.engine) as session:
+        for _ in range(count):
+            conv = Conversation()
+            messages = [
+                {
+                    "role": "user" if i % 2 == 0 else "assistant",
+                    "content": " ".join(
+                        random.choices(words, k=random.randint(20, 200))
+                    ),
+                }
+                for i in range(random.randint(1, max_turns) * 2)
+            ]
+            conv.data = {
+                "id": str(conv.id),
+                "name": messages[0]["content"][:20],
+                "messages": messages,
+                "model": {},
+                "prompt": "",
+                "temperature": 1,
+                "folderId": None,
+            }
+            session.add(conv)
+        session.commit()
+    db.close()
+
+
+def _wait_ready(url: str, workers: int, timeout: float):
+    import json
+    import urllib.request
+
+    pids = set()
+    deadline = time.time() + timeout
+    while time.time() < deadline and len(pids) < workers:
+        try:
+            with urllib.request.urlopen(f"{url}/api/ready", timeout=1) as res:
+                pids.add(json.loads(res.read())["pid"])
+        except Exception:
+            time.sleep(0.2)
+    if not pids:
+        raise TimeoutError(f"server {url} is not ready after {timeout}s")
+    if len(pids) < workers:
+        logger.warning(f"only {len(pids)}/{workers} workers answered readiness check")
+
+
+def _run_load(url: str, concurrency: int, duration: float, total_pages: int):
+    import json
+    import urllib.request
+
+    deadline = time.time() + duration
+
+    def client() -> List[float]:
+        latencies = []
+        while time.time() < deadline:
+            body = json.dumps({"page": random.randint(0, total_pages - 1)}).encode()
+            req = urllib.request.Request(
+                f"{url}/api/conversations",
+                data=body,
+                headers={"Content-Type": "application/json"},
+            )
+            start = time.time()
+            with urllib.request.urlopen(req, timeout=30) as res:
+                res.read()
+            latencies.append(time.time() - start)
+        return latencies
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: client(), range(concurrency)))
+    return sorted(it for latencies in results for it in latencies)
+
+
+@app.command(
+    help="Measure request throughput of the server with different worker counts "
+    "on a synthetic db"
+)
+def load_test(
+    workers: List[int] = typer.Option([1, 2, 4], help="Worker counts to test"),
+    conversations: int = typer.Option(5000, help="Conversations in synthetic db"),
+    concurrency: int = typer.Option(16, help="Concurrent clients"),
+    duration: float = typer.Option(10, help="Seconds of load per worker count"),
+    port: int = typer.Option(8765),
+):
+    from rich import print
+    from rich.table import Table
+
+    table = Table(title=f"POST /api/conversations, {concurrency} concurrent clients")
+    for column in ["workers", "requests", "req/s", "p50 ms", "p99 ms"]:
+        table.add_column(column)
+
+    url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / "synthetic.sqlite"
+        logger.info(f"Create synthetic db with {conversations} conversations")
+        _create_synthetic_db(db_path, conversations)
+
+        for n in workers:
+            cmd = [
+                sys.executable,
+                "-c",
+                "import llm_labeling_ui; llm_labeling_ui.entry_point()",
+            ]
+            cmd += [
+                "server",
+                "start",
+                "--data",
+                str(db_path),
+                "--port",
+                str(port),
+                "--workers",
+                str(n),
+            ]
+            proc = subprocess.Popen(
+                cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                _wait_ready(url, n, timeout=60)
+                latencies = _run_load(
+                    url, concurrency, duration, max(conversations // 50, 1)
+                )
+            finally:
+                proc.terminate()
+                proc.wait()
+
+            count = len(latencies)
+            table.add_row(
+                str(n),
+                str(count),
+                f"{count / duration:.1f}",
+                f"{latencies[count // 2] * 1000:.1f}" if count else "-",
+                f"{latencies[int(count * 0.99)] * 1000:.1f}" if count else "-",
+            )
+            logger.info(f"workers: {n}, requests: {count}")
+
+    print(table)
+
+
+@app.command(
+    help="Compare encoding /api/conversations pages from db objects and from raw "
+    "stored json"
+)
+def bench_read(
+    conversations: int = typer.Option(1000, help="Conversations in synthetic db"),
+    max_turns: int = typer.Option(
+        100, help="Max user/assistant turns per conversation"
+    ),
+    page_size: int = typer.Option(50),
+    rounds: int = typer.Option(10, help="Pages read by each method"),
+):
+    import orjson
+    from fastapi.encoders import jsonable_encoder
+    from rich import print
+    from rich.table import Table
+    from llm_labeling_ui.schema import GetConversionsResponse
+
+    def objects(db: DBManager, page: int) -> bytes:
+        # previous /api/conversations: orm objects, pydantic validation, json encoding
+        res = GetConversionsResponse(
+            conversations=db.get_conversations(page=page, page_size=page_size),
+            page=page,
+            totalPages=0,
+            totalConversations=0,
+        )
+        return orjson.dumps(jsonable_encoder(res))
+
+    def raw(db: DBManager, page: int) -> bytes:
+        return db.get_conversations_json(page=page, page_size=page_size)
+
+    table = Table(title=f"{page_size} conversations per page, up to {max_turns} turns")
+    for column in ["method", "ms/page", "bytes/page"]:
+        table.add_column(column)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / "synthetic.sqlite"
+        logger.info(f"Create synthetic db with {conversations} conversations")
+        _create_synthetic_db(db_path, conversations, max_turns)
         db = DBManager(db_path)
+        total_pages = max(conversations // page_size, 1)
+
+        first_objects = orjson.loads(objects(db, 0))["conversations"]
+        first_raw = orjson.loads(raw(db, 0))
+        assert first_objects == first_raw, "raw json differs from object encoding"
+
+        for name, method in [("objects", objects), ("raw json", raw)]:
+            start = time.time()
+            size = 0
+            for i in range(rounds):
+                size += len(method(db, i % total_pages))
+            elapsed = time.time() - start
+            table.add_row(name, f"{elapsed / rounds * 1000:.1f}", str(size // rounds))
+        db.close()
 
-    StandaloneApplication(app_factory(), options, config, db, tokenizer).run()
+    print(table)
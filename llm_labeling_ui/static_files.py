@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import importlib.metadata
+import mimetypes
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+from loguru import logger
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_CACHE_ROOT = Path.home() / ".cache" / "llm-labeling-ui" / "static"
+# text assets worth compressing, fonts and images are compressed already
+COMPRESS_SUFFIXES = [".html", ".js", ".css", ".json", ".svg", ".txt", ".map", ".ico"]
+# file names contain a content hash, a new build never changes them
+IMMUTABLE_PREFIX = "_next/static/"
+
+
+def _package_version() -> str:
+    try:
+        return importlib.metadata.version("llm-labeling-ui")
+    except importlib.metadata.PackageNotFoundError:
+        # running from a source checkout
+        return "dev"
+
+
+def static_cache_dir(directory: Path) -> Path:
+    """
+    Cache dir of the variants of directory, one per install location and package
+    version, so installs never serve each other's files.
+    """
+    key = f"{directory.resolve()}\0{_package_version()}"
+    return STATIC_CACHE_ROOT / hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+
+def precompress_static(
+    directory: Path, cache_dir: Optional[Path] = None, min_size: int = 1024
+) -> Path:
+    """
+    Write `.gz` (and `.br` if brotli is installed) variants of the text assets in
+    directory to cache_dir, mirroring its layout. Variants older than their source are
+    rewritten, so this is cheap when nothing changed.
+
+    Args:
+        cache_dir: Defaults to static_cache_dir(directory)
+
+    Returns: cache_dir
+    """
+    if cache_dir is None:
+        cache_dir = static_cache_dir(directory)
+    count = 0
+    for src in directory.glob("**/*"):
+        if not src.is_file() or src.suffix not in COMPRESS_SUFFIXES:
+            continue
+        stat = src.stat()
+        if stat.st_size < min_size:
+            continue
+        rel = src.relative_to(directory)
+        targets = [(cache_dir / f"{rel}.gz", "gzip")]
+        if brotli is not None:
+            targets.append((cache_dir / f"{rel}.br", "br"))
+        for dst, encoding in targets:
+            if dst.exists() and dst.stat().st_mtime >= stat.st_mtime:
+                continue
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            data = src.read_bytes()
+            if encoding == "br":
+                data = brotli.compress(data, quality=11)
+            else:
+                data = gzip.compress(data, compresslevel=9, mtime=0)
+            # written to a temporary file first, other workers may be reading
+            tmp = dst.with_name(dst.name + f".{os.getpid()}.tmp")
+            tmp.write_bytes(data)
+            tmp.replace(dst)
+            count += 1
+    if count:
+        logger.info(f"precompressed {count} static files to {cache_dir}")
+    return cache_dir
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles which serves the precompressed variant of a file when the client
+    accepts it, and sets cache headers: hashed bundle files are cached forever,
+    everything else is revalidated with ETag/Last-Modified.
+    """
+
+    def __init__(self, *args, cache_dir: Optional[Path] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_dir = cache_dir
+
+    def _variant(
+        self, full_path: str, accept_encoding: str
+    ) -> Tuple[Optional[str], Optional[str], Optional[os.stat_result]]:
+        if self.cache_dir is None:
+            return None, None, None
+        rel = os.path.relpath(full_path, self.directory)
+        for encoding, suffix in [("br", ".br"), ("gzip", ".gz")]:
+            if encoding not in accept_encoding:
+                continue
+            path = os.path.join(self.cache_dir, rel + suffix)
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                continue
+            return encoding, path, stat_result
+        return None, None, None
+
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        media_type = mimetypes.guess_type(str(full_path))[0] or "text/plain"
+        encoding, variant_path, variant_stat = self._variant(
+            str(full_path), request_headers.get("accept-encoding", "")
+        )
+
+        headers = {}
+        if os.path.relpath(full_path, self.directory).startswith(IMMUTABLE_PREFIX):
+            headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            headers["Cache-Control"] = "no-cache"
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+            full_path, stat_result = variant_path, variant_stat
+        if self.cache_dir is not None:
+            headers["Vary"] = "Accept-Encoding"
+
+        response = FileResponse(
+            full_path,
+            status_code=status_code,
+            headers=headers,
+            media_type=media_type,
+            stat_result=stat_result,
+            method=scope["method"],
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -6,6 +6,8 @@ import typer
 from rich.progress import track
 
 from llm_labeling_ui.db_schema import DBManager
+from llm_labeling_ui.filters import FILTER_HELP
+from llm_labeling_ui.utils import check_filter
 
 app = typer.Typer(
     add_completion=False,
@@ -17,16 +19,20 @@ app = typer.Typer(
 @app.command(help="Language Classification")
 def lang(
     db_path: Path = typer.Option(..., exists=True, dir_okay=False),
+    filter_expr: str = typer.Option(
+        "", "--filter", help=FILTER_HELP, callback=check_filter
+    ),
 ):
     from llm_labeling_ui.lang_classification import LanguageClassifier
 
     lang_classifier = LanguageClassifier()
     db = DBManager(db_path)
-    conversions_count = db.count_conversations()
+    conversions_count = db.count_conversations(filter_expr=filter_expr)
     logger.info(f"Total conversations: {conversions_count}")
     page_size = 256
     total_pages = math.ceil(conversions_count / page_size)
-    for convs in track(db.gen_conversations(batch_size=page_size), total=total_pages):
+    pages = db.iter_conversation_pages(page_size, filter_expr)
+    for convs in track(pages, total=total_pages):
         for conv in convs:
             tags = conv.data.get("tags", {})
             if tags.get("lang"):
@@ -39,6 +45,9 @@ def lang(
 @app.command(help="Traditional or Simplified Chinese Classification")
 def is_traditional_zh(
     db_path: Path = typer.Option(..., exists=True, dir_okay=False),
+    filter_expr: str = typer.Option(
+        "", "--filter", help=FILTER_HELP, callback=check_filter
+    ),
 ):
     import opencc
 
@@ -51,13 +60,14 @@ def is_traditional_zh(
         return False
 
     db = DBManager(db_path)
-    conversions_count = db.count_conversations()
+    conversions_count = db.count_conversations(filter_expr=filter_expr)
     logger.info(f"Total conversations: {conversions_count}")
     page_size = 256
     total_pages = math.ceil(conversions_count / page_size)
 
     is_traditional_count = 0
-    for convs in track(db.gen_conversations(batch_size=page_size), total=total_pages):
+    pages = db.iter_conversation_pages(page_size, filter_expr)
+    for convs in track(pages, total=total_pages):
         for conv in convs:
             tags = conv.data.get("tags", {})
             is_traditional = is_traditional_chinese(conv.merged_text(role="user"))
@@ -1,12 +1,19 @@
 import distutils
+import hashlib
 import random
+import threading
+import time
 import typing
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any, Dict, List, Union
 
 from rich.console import Console
 from rich.markdown import Markdown
 from rich.prompt import Prompt
 
+from llm_labeling_ui.metrics import TOKENIZER_SECONDS, TOKENIZER_TEXTS
+
 if typing.TYPE_CHECKING:
     from llm_labeling_ui.db_schema import Conversation
 
@@ -16,49 +23,121 @@ MESSAGE_FILTER_GREATER = "message-count-greater"
 MESSAGE_FILTER_LESS = "message-count-less"
 
 
+class ConversationCursor:
+    """
+    Ids of the conversations selected by the count_conversations arguments, in the
+    order of get_conversations. Ids are read a page at a time when first indexed, so a
+    viewer can start on a broad search without reading all of it.
+    """
+
+    def __init__(self, db, page_size: int = 200, max_pages: int = 16, **filters):
+        self.db = db
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.filters = filters
+        self.count = db.count_conversations(**filters)
+        self.pages: "OrderedDict[int, List[str]]" = OrderedDict()
+        # indexed from the viewer and its prefetch thread
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> List[str]:
+        """The id group at index, empty if the conversation was deleted meanwhile"""
+        page, offset = divmod(index, self.page_size)
+        with self.lock:
+            ids = self.pages.get(page)
+            if ids is None:
+                ids = self.db.get_conversation_ids(page, self.page_size, **self.filters)
+                self.pages[page] = ids
+                while len(self.pages) > self.max_pages:
+                    self.pages.popitem(last=False)
+            else:
+                self.pages.move_to_end(page)
+        return ids[offset : offset + 1]
+
+
 def interactive_view_conversations(
-    db, id_groups: Union[List[List[str]], List["Conversation"]], max_messages=-1
+    db,
+    id_groups: Union[List[List[str]], List["Conversation"], ConversationCursor],
+    max_messages=-1,
+    prefetch: int = 3,
 ):
+    """
+    id_groups: groups of conversation ids shown together, conversations or a
+    ConversationCursor. The next prefetch groups are read in a background thread
+    while the current one is shown.
+    """
     if len(id_groups) == 0:
         return
-    if not isinstance(id_groups[0], list):
+    if isinstance(id_groups, list) and not isinstance(id_groups[0], list):
         id_groups = [[str(c.id)] for c in id_groups]
+    total = len(id_groups)
     index = 0
 
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="view-prefetch")
+    # group index -> conversations of the groups around index
+    loading: Dict[int, Future] = {}
+
+    def load_group(i: int) -> List["Conversation"]:
+        return db.get_conversations_by_ids(id_groups[i])
+
+    def load(i: int) -> Future:
+        if i not in loading:
+            loading[i] = executor.submit(load_group, i)
+        return loading[i]
+
     console = Console()
-    while True:
-        group = id_groups[index]
-        conversations = db.get_conversations_by_ids(group)
-
-        markdown_str = ""
-        for conv_i, conv in enumerate(conversations):
-            markdown_str += f"# {index}-{conv_i}/{len(id_groups)} message count {len(conv.data['messages'])}\n\n"
-            if max_messages == -1:
-                max_messages = len(conv.data["messages"])
-            for m in conv.data["messages"][0:max_messages]:
-                markdown_str += f"## {m['role']}\n\n{m['content']}\n\n"
-
-        md = Markdown(markdown_str)
-        console.print(md)
-
-        choice = Prompt.ask(
-            f"{index}/{len(id_groups)}",
-            choices=["h", "l", "r", "q"],
-            default="l",
-        )
-        if choice == "h":
-            index -= 1
-            if index < 0:
-                index = len(id_groups) - 1
-        elif choice == "l":
-            index += 1
-            if index >= len(id_groups):
-                index = 0
-        elif choice == "r":
-            random_index = random.randint(0, len(id_groups) - 1)
-            index = random_index
-        elif choice == "q":
-            break
+    try:
+        while True:
+            # the current group is submitted first, the single worker reads it first
+            current = load(index)
+            window = {(index + i) % total for i in range(-1, prefetch + 1)}
+            for i in range(1, prefetch + 1):
+                load((index + i) % total)
+            for i in list(loading):
+                if i not in window:
+                    loading.pop(i).cancel()
+            conversations = current.result()
+
+            markdown_str = ""
+            if not conversations:
+                markdown_str += f"# {index}/{total} deleted\n\n"
+            for conv_i, conv in enumerate(conversations):
+                messages = conv.data["messages"]
+                markdown_str += (
+                    f"# {index}-{conv_i}/{total} message count {len(messages)}\n\n"
+                )
+                limit = len(messages) if max_messages == -1 else max_messages
+                for m in messages[0:limit]:
+                    markdown_str += f"## {m['role']}\n\n{m['content']}\n\n"
+
+            md = Markdown(markdown_str)
+            console.print(md)
+
+            choice = Prompt.ask(
+                f"{index}/{total}",
+                choices=["h", "l", "r", "q"],
+                default="l",
+            )
+            if choice == "h":
+                index -= 1
+                if index < 0:
+                    index = total - 1
+            elif choice == "l":
+                index += 1
+                if index >= total:
+                    index = 0
+            elif choice == "r":
+                random_index = random.randint(0, total - 1)
+                index = random_index
+            elif choice == "q":
+                break
+    finally:
+        for it in loading.values():
+            it.cancel()
+        executor.shutdown(wait=False)
 
 
 def str_to_bool(text) -> bool:
@@ -80,3 +159,93 @@ def parse_tag(text: str) -> Dict[str, Any]:
     for i in range(0, len(splits), 2):
         tags[splits[i]] = str_to_bool(splits[i + 1])
     return tags
+
+
+def check_filter(expr: str) -> str:
+    """typer callback of --filter options"""
+    import typer
+
+    from llm_labeling_ui.filters import FilterSyntaxError, parse_filter
+
+    try:
+        parse_filter(expr)
+    except FilterSyntaxError as e:
+        raise typer.BadParameter(str(e))
+    return expr
+
+
+def merge_filters(*exprs: str) -> str:
+    """and of filter expressions, empty ones are skipped"""
+    exprs = [it for it in exprs if it]
+    if len(exprs) == 1:
+        return exprs[0]
+    return " and ".join(f"({it})" for it in exprs)
+
+
+class TokenCounter:
+    """
+    Token count of texts with a bounded LRU cache keyed by text digest. Cache misses are
+    tokenized with the tokenizer's batch API, split into batches run on a thread pool
+    (fast tokenizers release the GIL).
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        max_size: int = 100000,
+        workers: int = 4,
+        batch_size: int = 256,
+    ):
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def _tokenize(self, texts: List[str]) -> List[int]:
+        start = time.perf_counter()
+        counts = [len(it) for it in self.tokenizer(texts)["input_ids"]]
+        TOKENIZER_SECONDS.observe(value=time.perf_counter() - start)
+        return counts
+
+    def count(self, texts: List[str]) -> List[int]:
+        if self.tokenizer is None:
+            return [0] * len(texts)
+
+        keys = [self._key(it) for it in texts]
+        counts: Dict[bytes, int] = {}
+        misses: Dict[bytes, str] = {}
+        with self.lock:
+            for key, text in zip(keys, texts):
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    counts[key] = self.cache[key]
+                else:
+                    misses[key] = text
+
+        TOKENIZER_TEXTS.inc("hit", amount=len(texts) - len(misses))
+        TOKENIZER_TEXTS.inc("miss", amount=len(misses))
+        if misses:
+            miss_keys = list(misses.keys())
+            miss_texts = list(misses.values())
+            batches = [
+                miss_texts[i : i + self.batch_size]
+                for i in range(0, len(miss_texts), self.batch_size)
+            ]
+            miss_counts = [
+                n for it in self.executor.map(self._tokenize, batches) for n in it
+            ]
+            with self.lock:
+                for key, n in zip(miss_keys, miss_counts):
+                    counts[key] = n
+                    self.cache[key] = n
+                    self.cache.move_to_end(key)
+                while len(self.cache) > self.max_size:
+                    self.cache.popitem(last=False)
+
+        return [counts[key] for key in keys]
@@ -0,0 +1,171 @@
+import threading
+import time
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from llm_labeling_ui.db_schema import DBManager
+
+
+class WriteBehindBuffer:
+    """
+    Coalesce conversation updates per id and write them in one transaction.
+
+    The web page saves the whole conversation on every edit, put() only keeps the latest
+    data of each id. A background thread flushes the pending updates `delay` seconds after
+    the first one arrived, or as soon as `max_pending` ids are waiting. get() returns the
+    pending data so reads in the same process see their own writes before the flush.
+
+    The buffer is per process, only use it with a single server worker: another worker
+    would read stale data and a late flush would overwrite its writes.
+    A failed flush is retried `max_retries` times, then the updates are dropped.
+    """
+
+    def __init__(
+        self,
+        db: DBManager,
+        delay: float = 0.5,
+        max_pending: int = 1000,
+        max_retries: int = 3,
+    ):
+        self.db = db
+        self.delay = delay
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.pending: Dict[str, Dict] = {}
+        # guards pending, flush_lock serializes flushes so a newer write is never
+        # overwritten by an older flush
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.written = 0
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.errors = 0
+        # consecutive failed flushes
+        self.failures = 0
+        self.dropped = 0
+        self.missing = 0
+
+        self.thread = threading.Thread(
+            target=self._run, name="write-behind", daemon=True
+        )
+        self.thread.start()
+
+    def put(self, id: str, data: Dict):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("write buffer is closed")
+            if id in self.pending:
+                self.coalesced += 1
+            self.pending[id] = data
+            self.submitted += 1
+            pending_count = len(self.pending)
+        if pending_count == 1 or pending_count >= self.max_pending:
+            self.wakeup.set()
+
+    def get(self, id: str) -> Optional[Dict]:
+        with self.lock:
+            return self.pending.get(id)
+
+    def discard(self, ids: List[str]):
+        """Drop pending updates, e.g. before the conversations are deleted"""
+        with self.lock:
+            for id in ids:
+                self.pending.pop(id, None)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                pending, self.pending = self.pending, {}
+
+            start = time.perf_counter()
+            try:
+                missing = self.db.update_conversations_data(pending)
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                    self.failures += 1
+                    if self.failures > self.max_retries:
+                        self.failures = 0
+                        self.dropped += len(pending)
+                        logger.error(
+                            f"Dropped {len(pending)} conversation updates after "
+                            f"{self.max_retries + 1} failed writes: {e}, "
+                            f"ids: {', '.join(pending)}"
+                        )
+                    else:
+                        logger.error(
+                            f"Failed to write {len(pending)} conversations: {e}"
+                        )
+                        # keep the newer data of ids updated during the flush
+                        pending.update(self.pending)
+                        self.pending = pending
+                raise
+            elapsed = time.perf_counter() - start
+            if missing:
+                logger.warning(
+                    f"Skipped updates of {len(missing)} conversations that don't "
+                    f"exist: {', '.join(missing)}"
+                )
+
+            with self.lock:
+                self.failures = 0
+                self.missing += len(missing)
+                self.written += len(pending) - len(missing)
+                self.flushes += 1
+                self.flush_seconds += elapsed
+                self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if self.closed:
+                break
+            if len(self) < self.max_pending:
+                time.sleep(self.delay)
+            try:
+                self.flush()
+            except Exception:
+                # retry after the next delay
+                self.wakeup.set()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "submitted": self.submitted,
+                "written": self.written,
+                "flushes": self.flushes,
+                "errors": self.errors,
+                "dropped": self.dropped,
+                "missing": self.missing,
+                "coalesced": self.coalesced,
+                # share of updates replaced by a newer one before they were written
+                "coalescingRatio": self.coalesced / self.submitted
+                if self.submitted
+                else 0,
+                "avgFlushMs": self.flush_seconds / self.flushes * 1000
+                if self.flushes
+                else 0,
+                "maxFlushMs": self.max_flush_seconds * 1000,
+            }
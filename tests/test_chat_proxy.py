@@ -0,0 +1,153 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from llm_labeling_ui.api import Api
+from llm_labeling_ui.db_schema import DBManager
+from llm_labeling_ui.schema import Config
+
+CHAT_REQUEST = {
+    "model": {
+        "id": "gpt-3.5-turbo",
+        "name": "GPT-3.5",
+        "maxLength": 12000,
+        "tokenLimit": 4000,
+    },
+    "messages": [{"role": "user", "content": "hi"}],
+    "key": "sk-test",
+    "org": "",
+    "prompt": "be brief",
+}
+
+
+def sse_body(*events) -> bytes:
+    lines = [
+        f"data: {it if isinstance(it, str) else json.dumps(it)}\n\n" for it in events
+    ]
+    return "".join(lines + ["data: [DONE]\n\n"]).encode()
+
+
+def delta(content: str) -> dict:
+    return {"choices": [{"delta": {"content": content}}]}
+
+
+@pytest.fixture
+def upstream():
+    """Stub OpenAI server, set its response and read the requests it received"""
+
+    class Upstream:
+        status_code = 200
+        body = sse_body(delta("Hel"), delta("lo"))
+        requests = []
+
+        def handler(self, request: httpx.Request) -> httpx.Response:
+            self.requests.append(request)
+            return httpx.Response(self.status_code, content=self.body)
+
+    return Upstream()
+
+
+def make_app(tmp_path, upstream, **config) -> FastAPI:
+    app = FastAPI()
+    api = Api(
+        app,
+        Config(web_app_dir=tmp_path, **config),
+        DBManager(tmp_path / "db.sqlite"),
+    )
+    api.http_client = httpx.AsyncClient(
+        base_url="http://upstream/v1",
+        transport=httpx.MockTransport(upstream.handler),
+    )
+    app.include_router(api.router)
+    return app
+
+
+@pytest.fixture
+def client(tmp_path, upstream):
+    with TestClient(make_app(tmp_path, upstream)) as client:
+        yield client
+
+
+def test_chat_streams_content(client, upstream):
+    res = client.post("/api/chat", json=CHAT_REQUEST)
+    assert res.status_code == 200
+    assert res.text == "Hello"
+
+    request = upstream.requests[0]
+    assert request.url.path == "/v1/chat/completions"
+    assert request.headers["authorization"] == "Bearer sk-test"
+    body = json.loads(request.content)
+    assert body["stream"] is True
+    assert body["messages"][0] == {"role": "system", "content": "be brief"}
+
+
+def test_chat_sse_framing(client, upstream):
+    res = client.post("/api/chat", json={**CHAT_REQUEST, "sse": True})
+    assert res.status_code == 200
+    assert res.text == (
+        'data: {"content": "Hel"}\n\n' 'data: {"content": "lo"}\n\n' "data: [DONE]\n\n"
+    )
+
+
+def test_chat_skips_malformed_events(client, upstream):
+    upstream.body = sse_body(delta("a"), "{not json", "[1]", delta("b"))
+    res = client.post("/api/chat", json=CHAT_REQUEST)
+    assert res.status_code == 200
+    assert res.text == "ab"
+
+
+def test_chat_upstream_error(client, upstream):
+    upstream.status_code = 500
+    upstream.body = b'{"error": "boom"}'
+    res = client.post("/api/chat", json=CHAT_REQUEST)
+    assert res.status_code == 503
+
+
+def test_chat_client_disconnects_before_stream(tmp_path, upstream):
+    app = make_app(tmp_path, upstream, chat_concurrency=1, chat_timeout=0.5)
+
+    async def disconnect_before_body():
+        messages = [
+            {"type": "http.request", "body": json.dumps(CHAT_REQUEST).encode()},
+            {"type": "http.disconnect"},
+        ]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+            if message["type"] == "http.response.start":
+                # the disconnect is seen before the first chunk is sent
+                await asyncio.sleep(0.1)
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": "/api/chat",
+            "raw_path": b"/api/chat",
+            "root_path": "",
+            "query_string": b"",
+            "headers": [(b"content-type", b"application/json")],
+            "client": ("test", 1),
+            "server": ("test", 80),
+        }
+        await app(scope, receive, send)
+        return sent
+
+    sent = asyncio.run(disconnect_before_body())
+    assert "http.response.body" not in sent
+
+    # the only chat slot was released
+    with TestClient(app) as client:
+        res = client.post("/api/chat", json=CHAT_REQUEST)
+    assert res.status_code == 200
+    assert res.text == "Hello"
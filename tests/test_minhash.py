@@ -0,0 +1,55 @@
+import random
+
+from llm_labeling_ui.minhash import MinHash, MinHashLSH
+
+
+def random_text(rng: random.Random, words: int = 80) -> str:
+    return " ".join(f"w{rng.randint(0, 100000)}" for _ in range(words))
+
+
+def test_groups_near_duplicates():
+    rng = random.Random(0)
+    minhash = MinHash()
+    lsh = MinHashLSH(threshold=0.7)
+    base = random_text(rng)
+    docs = {
+        "a": base,
+        "a-suffix": base + " w1 w2",
+        "a-prefix": "w3 " + base,
+        "b": random_text(rng),
+        "c": random_text(rng),
+    }
+    for key, text in docs.items():
+        lsh.add(key, minhash(text))
+    assert sorted(map(sorted, lsh.groups())) == [["a", "a-prefix", "a-suffix"]]
+
+
+def test_buckets_stay_bounded_for_many_duplicates():
+    rng = random.Random(0)
+    minhash = MinHash()
+    lsh = MinHashLSH()
+    text = random_text(rng)
+    signature = minhash(text)
+    for i in range(3000):
+        lsh.add(f"dup{i}", signature)
+    other = minhash(random_text(rng))
+    lsh.add("other", other)
+
+    # one representative per bucket, adding a duplicate never rescans members
+    for bucket in lsh.buckets:
+        assert all(isinstance(it, int) for it in bucket.values())
+        assert len(bucket) <= 2
+    groups = lsh.groups()
+    assert len(groups) == 1
+    assert len(groups[0]) == 3000
+
+
+def test_empty_texts_are_grouped_outside_buckets():
+    minhash = MinHash()
+    lsh = MinHashLSH()
+    for i in range(3):
+        lsh.add(f"empty{i}", minhash(""))
+    lsh.add("text", minhash(random_text(random.Random(0))))
+
+    assert sorted(map(sorted, lsh.groups())) == [["empty0", "empty1", "empty2"]]
+    assert all(len(bucket) == 1 for bucket in lsh.buckets)
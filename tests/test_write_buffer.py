@@ -0,0 +1,112 @@
+import time
+import uuid
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from llm_labeling_ui.api import Api
+from llm_labeling_ui.db_schema import Conversation as DBConversation, DBManager
+from llm_labeling_ui.schema import Config
+from llm_labeling_ui.write_buffer import WriteBehindBuffer
+
+
+def conversation_data(id: str, name: str, content: str) -> dict:
+    return {
+        "id": id,
+        "name": name,
+        "messages": [{"role": "user", "content": content}],
+        "model": {
+            "id": "gpt-3.5-turbo",
+            "name": "GPT-3.5",
+            "maxLength": 12000,
+            "tokenLimit": 4000,
+        },
+        "prompt": "",
+        "temperature": 1,
+        "folderId": None,
+    }
+
+
+@pytest.fixture
+def db(tmp_path):
+    return DBManager(tmp_path / "db.sqlite")
+
+
+@pytest.fixture
+def conv_id(db):
+    id = uuid.uuid4()
+    db.create_conversation(
+        DBConversation(id=id, data=conversation_data(str(id), "created", "hi"))
+    )
+    return str(id)
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_buffered_write_does_not_overwrite_patch(tmp_path, db, conv_id):
+    app = FastAPI()
+    api = Api(app, Config(web_app_dir=tmp_path, write_delay=0.2), db)
+    app.include_router(api.router)
+    with TestClient(app) as client:
+        res = client.post(
+            "/api/update_conversation",
+            json=conversation_data(conv_id, "buffered", "hi"),
+        )
+        assert res.status_code == 200
+        assert len(api.write_buffer) == 1
+
+        res = client.post(
+            "/api/patch_conversation",
+            json={
+                "id": conv_id,
+                "ops": [{"op": "set_content", "index": 0, "content": "patched"}],
+            },
+        )
+        assert res.status_code == 200
+        # the patch flushed the buffered write first, nothing is left to overwrite it
+        assert len(api.write_buffer) == 0
+        time.sleep(0.4)
+
+        data = client.get(f"/api/conversation/{conv_id}").json()["data"]
+        assert data["name"] == "buffered"
+        assert data["messages"][0]["content"] == "patched"
+
+    data = db.get_conversation(conv_id).data
+    assert data["name"] == "buffered"
+    assert data["messages"][0]["content"] == "patched"
+
+
+def test_failed_writes_are_dropped_after_retries(db, conv_id):
+    class FailingDB:
+        def update_conversations_data(self, datas):
+            raise RuntimeError("disk I/O error")
+
+    buffer = WriteBehindBuffer(FailingDB(), delay=0.01, max_retries=2)
+    buffer.put(conv_id, conversation_data(conv_id, "lost", "hi"))
+    wait_for(lambda: buffer.stats()["dropped"] == 1)
+    buffer.close()
+
+    stats = buffer.stats()
+    assert stats["errors"] == 3
+    assert stats["pending"] == 0
+    assert stats["written"] == 0
+
+
+def test_updates_of_missing_conversations_are_counted(db, conv_id):
+    buffer = WriteBehindBuffer(db, delay=0.05)
+    missing_id = str(uuid.uuid4())
+    buffer.put(conv_id, conversation_data(conv_id, "updated", "hi"))
+    buffer.put(missing_id, conversation_data(missing_id, "missing", "hi"))
+    buffer.close()
+
+    stats = buffer.stats()
+    assert stats["written"] == 1
+    assert stats["missing"] == 1
+    assert db.get_conversation(conv_id).data["name"] == "updated"
+    assert db.get_conversation(missing_id) is None